@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+"""
+ICAP Server Benchmark Suite
+Runs standard load scenarios against icap_server.py backed by a local
+clamd stand-in and compares the results with a stored baseline
+"""
+
+__version__ = "1.1.9"
+__author__ = "Roland Imme"
+
+import socket
+import socketserver
+import subprocess
+import argparse
+import contextlib
+import platform
+import json
+import random
+import sys
+import threading
+import time
+import timeit
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from icap_faultproxy import FaultProxy, Faults
+from icap_test import (
+    Colors, EICAR_STRING, ICAPClient, ICAPResponseParser, LatencyHistogram, LoadGenerator,
+    OptionsCache, Payload, compare_results, export_results, launch_server, new_result_document,
+    parse_size,
+)
+
+# Standard scenarios: keyword arguments for LoadGenerator plus payload spec
+SCENARIOS = {
+    'options-rate': {
+        'method': 'OPTIONS', 'keep_alive': True,
+    },
+    'reqmod-small': {
+        'method': 'REQMOD', 'payload_size': 4 * 1024,
+    },
+    'reqmod-small-keepalive': {
+        'method': 'REQMOD', 'payload_size': 4 * 1024, 'keep_alive': True,
+    },
+    'respmod-large': {
+        'method': 'RESPMOD', 'payload_size': 8 * 1024 * 1024, 'concurrency': 2,
+    },
+    'eicar-mix': {
+        'method': 'REQMOD', 'payload_size': 16 * 1024, 'eicar_ratio': 0.2, 'eicar_at': 'start',
+    },
+}
+
+# Pairs reported side by side as (baseline scenario, variant)
+SCENARIO_PAIRS = [('reqmod-small', 'reqmod-small-keepalive')]
+
+
+class FakeClamdHandler(socketserver.StreamRequestHandler):
+    """Handler speaking the subset of the clamd protocol the ICAP server uses"""
+
+    def read_command(self) -> Optional[bytes]:
+        """Read one z- (NUL terminated) or n- (newline terminated) command"""
+        command = bytearray()
+        while True:
+            char = self.rfile.read(1)
+            if not char:
+                return None
+            if char in (b'\0', b'\n'):
+                return bytes(command)
+            command += char
+
+    def handle(self):
+        """Answer PING, VERSION and INSTREAM"""
+        command = self.read_command()
+        if command is None:
+            return
+        name = command.lstrip(b'zn')
+        if name == b'PING':
+            self.wfile.write(b'PONG\0')
+        elif name == b'VERSION':
+            self.wfile.write(self.server.version.encode('ascii') + b'\0')
+        elif name == b'INSTREAM':
+            infected = self.read_stream()
+            with self.server.lock:
+                self.server.scans += 1
+            if self.server.scan_delay:
+                with self.server.cores:
+                    time.sleep(self.server.scan_delay)
+            if infected:
+                self.wfile.write(b'stream: Win.Test.EICAR_HDB-1 FOUND\0')
+            else:
+                self.wfile.write(b'stream: OK\0')
+        else:
+            self.wfile.write(b'UNKNOWN COMMAND\0')
+
+    def read_stream(self) -> bool:
+        """Consume INSTREAM chunks; returns True if EICAR was seen"""
+        eicar = EICAR_STRING.encode('latin-1')
+        tail = b''
+        found = False
+        while True:
+            size = int.from_bytes(self.rfile.read(4), 'big')
+            if size == 0:
+                return found
+            data = self.rfile.read(size)
+            if not found:
+                # Keep a short tail so matches spanning chunks are found
+                window = tail + data
+                found = eicar in window
+                tail = window[-(len(eicar) - 1):]
+
+
+class FakeClamd(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Local clamd stand-in
+
+    Detects the EICAR string anywhere in the stream and can add a fixed
+    delay per scan to emulate a loaded daemon. With a capacity, only that
+    many delays run at once and further scans queue, so scan latency rises
+    once more scans are sent than the daemon has cores.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, scan_delay: float = 0.0,
+                 version: str = 'ClamAV 1.3.1/27400/Mon Jan 1 00:00:00 2026', capacity: int = 0):
+        """
+        Args:
+            host: Address to listen on
+            port: Port to listen on (0 picks a free port)
+            scan_delay: Seconds to wait before answering INSTREAM
+            version: Answer to the VERSION command
+            capacity: Scan delays served at once (0 = unlimited)
+        """
+        super().__init__((host, port), FakeClamdHandler)
+        self.scan_delay = scan_delay
+        self.cores = threading.Semaphore(capacity) if capacity > 0 else contextlib.nullcontext()
+        self.version = version
+        self.scans = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        """Port the stand-in listens on"""
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def free_port() -> int:
+    """Return a currently unused local TCP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, clamd_port: int, extra_args: List[str]) -> subprocess.Popen:
+    """Launch icap_server.py against the clamd stand-in"""
+    return launch_server(port, ['--clamd-host', '127.0.0.1', '--clamd-port', str(clamd_port)] + extra_args)
+
+
+def run_scenario(name: str, host: str, port: int, service: str, duration: float,
+                 concurrency: int) -> Dict[str, any]:
+    """
+    Run one benchmark scenario
+
+    Returns:
+        Result metrics of the scenario
+    """
+    spec = dict(SCENARIOS[name])
+    payload_size = spec.pop('payload_size', None)
+    eicar_at = spec.pop('eicar_at', None)
+    spec.setdefault('concurrency', concurrency)
+    if payload_size is not None:
+        spec['payload'] = Payload(payload_size)
+        if eicar_at:
+            spec['threat_payload'] = Payload(payload_size, eicar_at=eicar_at)
+    generator = LoadGenerator(host, port, service, duration=duration,
+                              options_cache=OptionsCache(), **spec)
+    return generator.run().summary()
+
+
+def pipeline_sweep(host: str, port: int, service: str, depths: List[int], latency_ms: float,
+                   duration: float, connections: int, payload_size: int) -> Dict[str, Dict[str, any]]:
+    """
+    Measure throughput against pipeline depth over a slow link
+
+    Requests go through a FaultProxy adding latency_ms to every chunk in
+    both directions, so each request/response round trip costs at least
+    twice that. Depth 1 waits for each response before sending the next
+    request; all depths send complete bodies without preview.
+
+    Returns:
+        Result metrics per run, keyed 'pipeline-<depth>'
+    """
+    proxy = FaultProxy(('127.0.0.1', 0), (host, port), Faults(latency_ms=latency_ms))
+    proxy.start()
+    runs = {}
+    try:
+        for depth in depths:
+            print(f"Running pipeline depth {depth}...", flush=True)
+            generator = LoadGenerator('127.0.0.1', proxy.port, service, concurrency=connections,
+                                      duration=duration, keep_alive=True,
+                                      payload=Payload(payload_size), options_cache=OptionsCache(),
+                                      pipeline_depth=depth)
+            runs[f"pipeline-{depth}"] = dict(generator.run().summary(), depth=depth)
+    finally:
+        proxy.shutdown()
+    return runs
+
+
+def print_pipeline_sweep(runs: Dict[str, Dict[str, any]], latency_ms: float, width: int = 40):
+    """Chart pipeline throughput relative to the unpipelined run"""
+    results = list(runs.values())
+    if not results:
+        return
+    base = results[0]['throughput'] or 1
+    top = max(result['throughput'] for result in results) or 1
+    print(f"\nPipelining over a {latency_ms * 2:g}ms round-trip link")
+    for result in results:
+        bar = '=' * max(1, round(result['throughput'] / top * width)) if result['throughput'] else ''
+        print(f"  depth {result['depth']:>3}  {result['throughput']:>8.1f} req/s  "
+              f"{result['throughput'] / base:>5.1f}x  {bar}")
+
+
+def streaming_probe(host: str, port: int, service: str, size: int) -> Dict[str, any]:
+    """
+    Send one RESPMOD and time the first and last byte of its response
+
+    The body is sent from a separate thread while the response is read,
+    as a proxy relaying a download does, so a server streaming the body
+    back is not held up by an unread socket.
+
+    Returns:
+        Status code, time to first byte and total time (ms), and the
+        number of body bytes returned
+    """
+    http_request = f"GET /download/probe.bin HTTP/1.1\r\nHost: {host}\r\n\r\n"
+    http_response = (f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                     f"Content-Length: {size}\r\n\r\n")
+    head = (f"RESPMOD icap://{host}:{port}/{service} ICAP/1.0\r\n"
+            f"Host: {host}:{port}\r\nAllow: 204\r\n"
+            f"Encapsulated: req-hdr=0, res-hdr={len(http_request)}, "
+            f"res-body={len(http_request) + len(http_response)}\r\n\r\n"
+            f"{http_request}{http_response}").encode('latin-1')
+
+    def send():
+        try:
+            sock.sendall(head)
+            for data in Payload(size).iter_chunks():
+                sock.sendall(b'%x\r\n' % len(data) + data + b'\r\n')
+            sock.sendall(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+    parser = ICAPResponseParser()
+    with socket.create_connection((host, port), timeout=120) as sock:
+        start = time.monotonic()
+        threading.Thread(target=send, daemon=True).start()
+        first = None
+        while not parser.done:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError(f"Connection closed after {len(parser.leftover)} unparsed bytes")
+            if first is None:
+                first = time.monotonic()
+            parser.feed(data)
+        end = time.monotonic()
+    return {'size': size, 'status': parser.response.status_code,
+            'ttfb_ms': round((first - start) * 1000, 1), 'total_ms': round((end - start) * 1000, 1),
+            'body_bytes': len(parser.response.body)}
+
+
+def ttfb_sweep(targets: Dict[str, int], service: str, sizes: List[int],
+               bandwidth: int) -> Dict[str, Dict[str, any]]:
+    """
+    Measure time to first byte of RESPMOD responses against body size
+
+    Requests pass a FaultProxy limiting the upload to `bandwidth` bytes per
+    second, emulating a proxy that receives the download from a slower
+    origin. A server answering after the scan has a first byte time that
+    grows with the size; a streaming server answers within its window.
+
+    Args:
+        targets: Label -> port of a local server to measure
+        service: ICAP service path
+        sizes: Body sizes in bytes
+        bandwidth: Upload bytes per second (0 = unlimited)
+
+    Returns:
+        Result per run, keyed '<label>-<size>'
+    """
+    runs = {}
+    for label, port in targets.items():
+        proxy = FaultProxy(('127.0.0.1', 0), ('127.0.0.1', port),
+                           Faults(bandwidth=bandwidth, direction='upstream'))
+        proxy.start()
+        try:
+            for size in sizes:
+                print(f"Running {label} {size} bytes...", flush=True)
+                runs[f"{label}-{size}"] = dict(streaming_probe('127.0.0.1', proxy.port, service, size),
+                                               mode=label)
+        finally:
+            proxy.shutdown()
+    return runs
+
+
+def print_ttfb_sweep(runs: Dict[str, Dict[str, any]], bandwidth: int):
+    """Print first byte and total times per mode and size"""
+    rate = f"{bandwidth / 1024 ** 2:g} MiB/s" if bandwidth else "unlimited"
+    print(f"\nRESPMOD time to first byte (upload {rate})")
+    print(f"  {'mode':<10} {'size':>12} {'status':>7} {'first byte ms':>14} {'total ms':>10} {'returned':>12}")
+    for result in runs.values():
+        print(f"  {result['mode']:<10} {result['size']:>12} {result['status']:>7} "
+              f"{result['ttfb_ms']:>14.1f} {result['total_ms']:>10.1f} {result['body_bytes']:>12}")
+
+
+def wait_for_istag(port: int, timeout: float = 30.0) -> bool:
+    """Wait until a launched server reports clamd's signature version as its ISTag"""
+    client = ICAPClient('127.0.0.1', port, 'avscan')
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        success, _, response = client.send_options()
+        if success and response.headers.get('istag', '').strip('"').startswith('clamav-'):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def fleet_run(clamd: FakeClamd, nodes: int, objects: int, payload_size: int, concurrency: int,
+              peers: bool, extra_args: List[str]) -> Dict[str, any]:
+    """
+    Scan the same objects twice across a fleet of local servers
+
+    Every server gets a verdict cache; with peers, each one shares it with
+    all the others. The first pass sends object i to server i, the second
+    pass sends it to the next server, so every repeat is a local miss and
+    only a peer can save the clamd scan. Every tenth object carries EICAR.
+
+    Returns:
+        clamd scans, wrong verdicts, latency per pass and the summed cache
+        counters of all servers (peer lookup percentiles are the worst node's)
+    """
+    ports = [free_port() for _ in range(nodes)]
+    peer_ports = [free_port() for _ in range(nodes)]
+    processes = []
+    try:
+        for index, port in enumerate(ports):
+            args = extra_args + ['--verdict-cache', '100000']
+            if peers:
+                args += ['--peer-port', str(peer_ports[index]), '--peer-secret', 'icap-bench']
+                for other, peer_port in enumerate(peer_ports):
+                    if other != index:
+                        args += ['--peer', f"127.0.0.1:{peer_port}"]
+            processes.append(start_server(port, clamd.port, args))
+        if not all(wait_for_istag(port) for port in ports):
+            raise RuntimeError("Servers did not pick up the clamd version")
+
+        bodies = [random.Random(index).randbytes(payload_size) for index in range(objects)]
+        for index in range(0, objects, 10):
+            bodies[index] = EICAR_STRING.encode('latin-1') + bodies[index]
+        scans_before = clamd.scans
+        result = {'nodes': nodes, 'objects': objects, 'peers': peers, 'wrong_verdicts': 0, 'errors': 0}
+        lock = threading.Lock()
+        for name, offset in (('first', 0), ('repeat', 1)):
+            work = iter(range(objects))
+            histogram = LatencyHistogram()
+
+            def worker():
+                clients = {}
+                local = LatencyHistogram()
+                while True:
+                    with lock:
+                        index = next(work, None)
+                    if index is None:
+                        break
+                    port = ports[(index + offset) % nodes]
+                    client = clients.get(port)
+                    if client is None:
+                        client = clients[port] = ICAPClient('127.0.0.1', port, 'avscan', keep_alive=True)
+                    success, _, response = client.send_request(bodies[index], f"object-{index}.bin")
+                    with lock:
+                        if not success:
+                            result['errors'] += 1
+                            continue
+                        if (response.status_code == 403) != (index % 10 == 0):
+                            result['wrong_verdicts'] += 1
+                    local.record(response.elapsed)
+                for client in clients.values():
+                    client.close()
+                with lock:
+                    histogram.merge(local)
+
+            threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            result[f"{name}_p50_ms"] = round(histogram.percentile(50) * 1000, 2)
+            result[f"{name}_p99_ms"] = round(histogram.percentile(99) * 1000, 2)
+        result['clamd_scans'] = clamd.scans - scans_before
+
+        totals = {}
+        for port in ports:
+            _, _, response = ICAPClient('127.0.0.1', port, 'avscan').send_options()
+            for item in response.headers.get('x-verdict-cache', '').split(';'):
+                key, _, value = item.strip().partition('=')
+                if not value:
+                    continue
+                value = float(value)
+                if key.endswith('_ms'):
+                    totals[key] = max(totals.get(key, 0.0), value)
+                elif not key.endswith('_pct'):
+                    totals[key] = totals.get(key, 0) + int(value)
+        lookups = totals.get('hits', 0) + totals.get('misses', 0)
+        cross_node = totals.get('remote_hits', 0) + totals.get('peer_hits', 0)
+        totals['cross_node_pct'] = round(cross_node / lookups * 100, 1) if lookups else 0.0
+        result.update(totals)
+        return result
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def print_fleet(runs: Dict[str, Dict[str, any]]):
+    """Print clamd scans, hit counts and latencies of the fleet runs side by side"""
+    print(f"\nVerdict cache across a fleet")
+    print(f"  {'run':<10} {'scans':>6} {'hits':>6} {'pushed':>7} {'asked':>6} {'cross-node':>11} "
+          f"{'lookup p50/p99 ms':>18} {'first p50':>10} {'repeat p50':>11} {'wrong':>6}")
+    for name, result in runs.items():
+        lookup = f"{result.get('peer_p50_ms', 0):.2f}/{result.get('peer_p99_ms', 0):.2f}" if result['peers'] else '-'
+        print(f"  {name:<10} {result['clamd_scans']:>6} {result.get('hits', 0):>6} "
+              f"{result.get('remote_hits', 0):>7} {result.get('peer_hits', 0):>6} "
+              f"{result['cross_node_pct']:>10.1f}% {lookup:>18} "
+              f"{result['first_p50_ms']:>10.2f} {result['repeat_p50_ms']:>11.2f} {result['wrong_verdicts']:>6}")
+    print("  (pushed: hits on verdicts published by a peer; asked: misses answered by a peer query)")
+
+
+class _DiscardingWriter:
+    """wfile stand-in that drops everything written"""
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+def micro_benchmark(iterations: int = 100000) -> Dict[str, float]:
+    """
+    Measure the cost of building and writing single ICAP responses
+
+    Calls the server's response writers on a handler without a socket,
+    next to the previous approach of formatting and encoding the whole
+    response string per call, for comparison.
+
+    Returns:
+        Nanoseconds per response by writer
+    """
+    import icap_server
+    icap_server.logger.setLevel('WARNING')
+    handler = icap_server.ICAPRequestHandler.__new__(icap_server.ICAPRequestHandler)
+    handler.server = SimpleNamespace(istag=icap_server.ISTagSource(), preview_size=1024,
+                                     body_budget=icap_server.ByteBudget(1), hash_index=None,
+                                     verdict_cache=None, schedulers={}, tls_stats=None,
+                                     read_deadlines=icap_server.ReadDeadlines())
+    handler.service = icap_server.ServiceConfig('echo', 'echo')
+    handler.wfile = _DiscardingWriter()
+    handler.request_id = '0123456789abcdef'
+    handler.trickle = None
+    handler.capture_record = None
+    handler.timings = [('queue', 0.0001), ('receive', 0.0003), ('clamd', 0.0021)]
+    handler.received_at = time.monotonic()
+
+    def format_and_encode():
+        # Previous writer: whole response (with a fake Date) formatted and
+        # encoded per call, log line built even when INFO is disabled
+        phases = ', '.join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in handler.timings)
+        response = (
+            "ICAP/1.0 204 No Modifications Needed\r\n"
+            "ISTag: \"python-icap-1.0\"\r\n"
+            "Date: Thu, 01 Jan 2026 00:00:00 GMT\r\n"
+            f"X-Request-ID: {handler.request_id}\r\n"
+            f"Server-Timing: {phases}\r\n"
+            "\r\n"
+        )
+        start = time.monotonic()
+        handler.wfile.write(response.encode('utf-8'))
+        phases = ' '.join(f"{name}={seconds * 1000:.2f}ms" for name, seconds
+                          in handler.timings + [('write', time.monotonic() - start)])
+        icap_server.logger.info(f"[{handler.request_id}] {response[9:12]} {phases}")
+
+    def options():
+        # handle_options records a receive phase per call
+        handler.handle_options({})
+        handler.timings.pop()
+
+    writers = {
+        'clean (previous)': format_and_encode,
+        'clean': handler.send_clean_response,
+        'threat': lambda: handler.send_threat_response('Win.Test.EICAR_HDB-1\0'),
+        'error': lambda: handler.send_error(500, 'Internal Server Error'),
+        'options': options,
+    }
+    results = {}
+    for name, writer in writers.items():
+        seconds = min(timeit.repeat(writer, number=iterations, repeat=3))
+        results[name] = seconds / iterations * 1e9
+    return results
+
+
+def print_results(results: Dict[str, any]):
+    """Print scenario results as a table"""
+    print(f"\n{'='*96}")
+    print("Benchmark Results")
+    print(f"{'='*96}")
+    print(f"{'Scenario':<24} {'req/s':>10} {'MiB/s':>9} {'p50 ms':>9} {'p90 ms':>9} "
+          f"{'p99 ms':>9} {'errors':>7} {'threats':>8}")
+    for name, result in results['runs'].items():
+        print(f"{name:<24} {result['throughput']:>10.1f} {result['byte_rate'] / 1024 ** 2:>9.2f} "
+              f"{result['latency_p50_ms']:>9.2f} {result['latency_p90_ms']:>9.2f} "
+              f"{result['latency_p99_ms']:>9.2f} {result['errors']:>7} {result['threats']:>8}")
+    for first, second in SCENARIO_PAIRS:
+        if first in results['runs'] and second in results['runs']:
+            a, b = results['runs'][first], results['runs'][second]
+            if a['throughput']:
+                print(f"\n{second} vs {first}: "
+                      f"{(b['throughput'] / a['throughput'] - 1) * 100:+.1f}% throughput, "
+                      f"p50 {a['latency_p50_ms']:.2f}ms -> {b['latency_p50_ms']:.2f}ms")
+    print(f"{'='*96}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ICAP Server Benchmark Suite - standard scenarios with baseline comparison'
+    )
+    parser.add_argument('--version', action='version',
+                        version=f'%(prog)s {__version__}')
+    parser.add_argument('--micro', action='store_true',
+                        help='Only run the response writer micro-benchmark')
+    parser.add_argument('--pipeline-sweep', metavar='DEPTHS',
+                        help='Instead of the scenarios, measure throughput per pipeline depth '
+                             '(e.g. 1,2,4,8,16) over a simulated-latency link')
+    parser.add_argument('--link-latency', type=float, default=10.0,
+                        help='One-way latency in ms of the --pipeline-sweep link (default: 10)')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='Connections of the --pipeline-sweep load (default: 1)')
+    parser.add_argument('--payload-size', type=int, default=4 * 1024,
+                        help='Body size in bytes of the --pipeline-sweep requests (default: 4096)')
+    parser.add_argument('--ttfb-sweep', metavar='SIZES',
+                        help='Instead of the scenarios, measure RESPMOD time to first byte per body '
+                             'size (e.g. 1M,8M,32M); a launched server is measured without and '
+                             'with --trickle-window')
+    parser.add_argument('--trickle-window', default='1M',
+                        help='Tail window of the streaming server in --ttfb-sweep (default: 1M)')
+    parser.add_argument('--upload-rate', type=parse_size, default='10M',
+                        help='Upload bytes per second in --ttfb-sweep (default: 10M)')
+    parser.add_argument('--fleet', type=int, metavar='NODES',
+                        help='Instead of the scenarios, scan a set of objects twice across NODES '
+                             'launched servers, with isolated and with peer-shared verdict caches')
+    parser.add_argument('--fleet-objects', type=int, default=200,
+                        help='Distinct objects scanned in --fleet (default: 200)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma separated scenarios (default: all of {", ".join(SCENARIOS)})')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='Seconds per scenario (default: 5)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Concurrent requests per scenario (default: 8)')
+    parser.add_argument('--host',
+                        help='Benchmark an already running server instead of launching one')
+    parser.add_argument('--port', type=int, default=1344,
+                        help='Port of the already running server (default: 1344)')
+    parser.add_argument('--service', default='avscan',
+                        help='ICAP service path (default: avscan)')
+    parser.add_argument('--clamd-delay', type=float, default=0.0,
+                        help='Milliseconds the clamd stand-in waits per scan (default: 0)')
+    parser.add_argument('--clamd-capacity', type=int, default=0,
+                        help='Scans the clamd stand-in delays at once, queueing the rest '
+                             '(default: 0 = unlimited)')
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help='Extra argument for the launched icap_server.py (repeatable)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='Write JSON results to FILE (readable by "icap_test.py compare")')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare against a stored JSON result file')
+    parser.add_argument('--max-throughput-drop', type=float, default=10.0,
+                        help='Allowed throughput decrease vs. baseline in percent (default: 10)')
+    parser.add_argument('--max-latency-increase', type=float, default=20.0,
+                        help='Allowed p50/p99 latency increase vs. baseline in percent (default: 20)')
+
+    args = parser.parse_args()
+
+    if args.micro:
+        print(f"\nICAP Response Writer Micro-Benchmark")
+        print(f"{'='*60}")
+        for name, nanoseconds in micro_benchmark().items():
+            print(f"{name:<24} {nanoseconds / 1000:>8.2f} µs/response")
+        print(f"{'='*60}")
+        return
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"✗ Unknown scenario(s): {', '.join(unknown)}")
+        sys.exit(2)
+    depths = []
+    if args.pipeline_sweep:
+        try:
+            depths = [int(depth) for depth in args.pipeline_sweep.split(',')]
+        except ValueError:
+            print(f"✗ Invalid pipeline depths: {args.pipeline_sweep}")
+            sys.exit(2)
+    sizes = []
+    if args.ttfb_sweep:
+        try:
+            sizes = [parse_size(size) for size in args.ttfb_sweep.split(',')]
+        except ValueError:
+            print(f"✗ Invalid sizes: {args.ttfb_sweep}")
+            sys.exit(2)
+
+    if args.fleet:
+        if args.host or args.fleet < 2:
+            print("✗ --fleet launches its own servers and needs at least 2")
+            sys.exit(2)
+        clamd = FakeClamd(scan_delay=args.clamd_delay / 1000, capacity=args.clamd_capacity)
+        clamd.start()
+        print(f"\nICAP Benchmark Suite")
+        print(f"Fleet of {args.fleet} servers, {args.fleet_objects} objects of {args.payload_size} bytes")
+        print(f"{'='*60}")
+        results = new_result_document('benchmark', f"fleet of {args.fleet}")
+        results.update({'python': platform.python_version(), 'platform': platform.platform(),
+                        'clamd_delay_ms': args.clamd_delay})
+        try:
+            for name, peers in (('isolated', False), ('shared', True)):
+                print(f"Running {name}...", flush=True)
+                results['fleet'] = results.get('fleet', {})
+                results['fleet'][name] = fleet_run(clamd, args.fleet, args.fleet_objects,
+                                                   args.payload_size, args.concurrency, peers,
+                                                   args.server_arg)
+        finally:
+            clamd.shutdown()
+        print_fleet(results['fleet'])
+        if args.output:
+            export_results(results, args.output, 'json')
+            print(f"\n✓ Results written to {args.output}")
+        return
+
+    clamd = None
+    servers = []
+    targets = {}
+    if args.host:
+        host, port = args.host, args.port
+        targets['target'] = port
+    else:
+        clamd = FakeClamd(scan_delay=args.clamd_delay / 1000, capacity=args.clamd_capacity)
+        clamd.start()
+        host, port = '127.0.0.1', free_port()
+        servers.append(start_server(port, clamd.port, args.server_arg))
+        targets['buffered'] = port
+        if sizes:
+            targets['streamed'] = free_port()
+            servers.append(start_server(targets['streamed'], clamd.port,
+                                        args.server_arg + ['--trickle-window', args.trickle_window]))
+
+    print(f"\nICAP Benchmark Suite")
+    print(f"Target: icap://{host}:{port}/{args.service}")
+    print(f"{'='*60}")
+
+    results = new_result_document('benchmark', f"icap://{host}:{port}/{args.service}")
+    results.update({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'duration': args.duration,
+        'concurrency': args.concurrency,
+        'clamd_delay_ms': args.clamd_delay,
+        'clamd_capacity': args.clamd_capacity,
+    })
+    try:
+        if sizes:
+            results['upload_rate'] = args.upload_rate
+            results['ttfb'] = ttfb_sweep(targets, args.service, sizes, args.upload_rate)
+        elif depths:
+            results['link_latency_ms'] = args.link_latency
+            results['runs'] = pipeline_sweep(host, port, args.service, depths, args.link_latency,
+                                             args.duration, args.connections, args.payload_size)
+        else:
+            for name in names:
+                print(f"Running {name}...", flush=True)
+                results['runs'][name] = run_scenario(name, host, port, args.service,
+                                                          args.duration, args.concurrency)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        if clamd is not None:
+            clamd.shutdown()
+
+    if results['runs']:
+        print_results(results)
+    if sizes:
+        print_ttfb_sweep(results['ttfb'], args.upload_rate)
+    if depths:
+        print_pipeline_sweep(results['runs'], args.link_latency)
+
+    if args.output:
+        export_results(results, args.output, 'json')
+        print(f"\n✓ Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        lines, regressions = compare_results(results, baseline, args.max_throughput_drop,
+                                             args.max_latency_increase)
+        print(f"\nComparison with {args.baseline} (version {baseline.get('version', '?')}):")
+        for line in lines:
+            print(f"  {line}")
+        if regressions:
+            print(f"\n{Colors.FAIL}✗ Performance regressions:{Colors.ENDC}")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print(f"\n✓ No regressions beyond thresholds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+"""
+ICAP Fault-Injection Proxy
+TCP proxy that injects latency, bandwidth limits, resets, partial writes,
+stalls and garbage between icap_test.py and the ICAP server or between the
+ICAP server and clamd, optionally scripted by a scenario file while a load
+run measures throughput collapse and recovery
+"""
+
+__version__ = "1.1.9"
+__author__ = "Roland Imme"
+
+import socket
+import socketserver
+import argparse
+import json
+import csv
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from icap_test import (
+    Colors, LatencyHistogram, LoadGenerator, LoadStats, OptionsCache, Payload,
+    export_results, new_result_document, parse_size,
+)
+
+
+class Faults:
+    """
+    Faults applied to proxied data
+
+    'upstream' is data from the client to the target, 'downstream' the
+    answers flowing back. Latency delays every chunk without lowering
+    throughput; the other faults act on the byte stream of one connection
+    direction. stall_after and truncate_after count the bytes forwarded
+    since these faults took effect, so a scenario phase applies them to
+    open keep-alive connections from the phase start; reset_after counts
+    from the start of the connection, whose reset was decided on connect.
+    """
+
+    FIELDS = {
+        'latency_ms': 0.0,       # Delay added to every chunk
+        'jitter_ms': 0.0,        # Random extra delay up to this value
+        'bandwidth': 0,          # Bytes per second per connection direction (0 = unlimited)
+        'fragment': 0,           # Forward in writes of at most this many bytes (0 = as read)
+        'stall_after': 0,        # Pause once after this many bytes ...
+        'stall_ms': 0.0,         # ... for this long
+        'truncate_after': 0,     # Close the connection after this many bytes (0 = never)
+        'reset_rate': 0.0,       # Fraction of connections that are reset ...
+        'reset_after': 0,        # ... after this many bytes
+        'garbage_rate': 0.0,     # Fraction of chunks replaced by random bytes
+        'direction': 'both',     # 'upstream', 'downstream' or 'both'
+    }
+
+    def __init__(self, **values):
+        unknown = set(values) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fault(s): {', '.join(sorted(unknown))}")
+        for name, default in self.FIELDS.items():
+            value = values.get(name, default)
+            if isinstance(default, int) and isinstance(value, str):
+                value = parse_size(value)
+            setattr(self, name, value if name == 'direction' else type(default)(value))
+        if self.direction not in ('upstream', 'downstream', 'both'):
+            raise ValueError(f"Invalid direction: {self.direction}")
+
+    def applies(self, direction: str) -> bool:
+        """Whether the faults act on the given direction"""
+        return self.direction in ('both', direction)
+
+    def describe(self) -> str:
+        """Short text listing the active faults"""
+        active = [f"{name}={getattr(self, name)}" for name, default in self.FIELDS.items()
+                  if getattr(self, name) != default]
+        return ', '.join(active) or 'none'
+
+
+class Scenario:
+    """
+    Timed sequence of fault phases
+
+    Scenario files are JSON documents::
+
+        {
+          "duration": 40,
+          "phases": [
+            {"at": 0, "name": "baseline"},
+            {"at": 10, "name": "slow clamd", "faults": {"latency_ms": 200}},
+            {"at": 25, "name": "recovery"}
+          ]
+        }
+
+    Each phase starts 'at' seconds into the run and lasts until the next
+    one; a phase without faults passes traffic through unchanged.
+    """
+
+    def __init__(self, phases: List[Dict[str, any]], duration: float):
+        """
+        Args:
+            phases: Phase dictionaries with 'at', 'name' and 'faults'
+            duration: Total run time in seconds
+        """
+        self.phases = []
+        for index, phase in enumerate(sorted(phases, key=lambda phase: phase.get('at', 0))):
+            self.phases.append({
+                'at': float(phase.get('at', 0)),
+                'name': phase.get('name', f"phase-{index + 1}"),
+                'faults': Faults(**phase.get('faults', {})),
+                'clean': not phase.get('faults'),
+            })
+        if not self.phases or self.phases[0]['at'] > 0:
+            self.phases.insert(0, {'at': 0.0, 'name': 'baseline', 'faults': Faults(), 'clean': True})
+        self.duration = duration
+
+    @classmethod
+    def load(cls, path: str) -> 'Scenario':
+        """Read a scenario file"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        phases = data.get('phases', [])
+        duration = data.get('duration') or (max(phase.get('at', 0) for phase in phases) + 10 if phases else 10)
+        return cls(phases, float(duration))
+
+    def phase_at(self, elapsed: float) -> Dict[str, any]:
+        """Return the phase active at the given time"""
+        current = self.phases[0]
+        for phase in self.phases:
+            if phase['at'] <= elapsed:
+                current = phase
+        return current
+
+
+class FaultProxyHandler(socketserver.BaseRequestHandler):
+    """Forward one client connection to the target, applying the current faults"""
+
+    # Chunks buffered per direction before reading blocks (back-pressure)
+    QUEUE_CHUNKS = 64
+
+    def handle(self):
+        """Connect to the target and pump both directions until either side closes"""
+        client = self.request
+        try:
+            upstream = socket.create_connection(self.server.target, timeout=10)
+        except OSError as e:
+            self.server.log(f"Target unreachable: {e}")
+            return
+        upstream.settimeout(None)
+        self.upstream = upstream
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        faults = self.server.faults
+        self.reset_at = None
+        if faults.reset_rate and random.random() < faults.reset_rate:
+            self.reset_at = faults.reset_after
+        self.closed = threading.Event()
+        self.queues = []
+        pumps = [
+            threading.Thread(target=self.pump, args=(client, upstream, 'upstream'), daemon=True),
+            threading.Thread(target=self.pump, args=(upstream, client, 'downstream'), daemon=True),
+        ]
+        for pump in pumps:
+            pump.start()
+        for pump in pumps:
+            pump.join()
+        for sock in (client, upstream):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def pump(self, source: socket.socket, target: socket.socket, direction: str):
+        """
+        Copy one direction of the connection
+
+        A reader thread stamps each chunk with its arrival time so latency
+        is added per chunk without serializing reads behind the delay.
+        """
+        chunks = queue.Queue(self.QUEUE_CHUNKS)
+        self.queues.append(chunks)
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b''
+                while not self.closed.is_set():
+                    try:
+                        chunks.put((time.monotonic(), data), timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if not data or self.closed.is_set():
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        # Bytes over the connection, and since the current faults took effect
+        forwarded = 0
+        counted = 0
+        current = None
+        stalled = False
+        while not self.closed.is_set():
+            try:
+                arrived, data = chunks.get(timeout=1)
+            except queue.Empty:
+                continue
+            if not data or self.closed.is_set():
+                break
+            faults = self.server.faults
+            if faults is not current:
+                current, counted, stalled = faults, 0, False
+            if not faults.applies(direction):
+                if not self.send(target, data):
+                    break
+                forwarded += len(data)
+                counted += len(data)
+                continue
+
+            delay = faults.latency_ms + random.uniform(0, faults.jitter_ms)
+            if delay:
+                wait = arrived + delay / 1000 - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            if faults.garbage_rate and random.random() < faults.garbage_rate:
+                data = os.urandom(len(data))
+
+            if not stalled and faults.stall_after and counted + len(data) > faults.stall_after:
+                split = faults.stall_after - counted
+                if not self.send(target, data[:split], faults):
+                    break
+                forwarded += split
+                counted += split
+                data = data[split:]
+                stalled = True
+                time.sleep(faults.stall_ms / 1000)
+
+            # Cut the chunk where a connection-level fault fires
+            cut, rst = None, False
+            if self.reset_at is not None and forwarded + len(data) >= self.reset_at:
+                cut, rst = self.reset_at - forwarded, True
+            if faults.truncate_after and counted + len(data) >= faults.truncate_after:
+                if cut is None or faults.truncate_after - counted < cut:
+                    cut, rst = faults.truncate_after - counted, False
+            if cut is not None:
+                self.send(target, data[:max(0, cut)], faults)
+                self.abort(rst)
+                break
+            if not self.send(target, data, faults):
+                break
+            forwarded += len(data)
+            counted += len(data)
+
+        if not self.closed.is_set():
+            try:
+                target.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def send(self, sock: socket.socket, data: bytes, faults: Optional[Faults] = None) -> bool:
+        """
+        Send data, split into fragments and paced to the bandwidth cap
+
+        Returns:
+            False if the peer is gone
+        """
+        if not data:
+            return True
+        step = len(data)
+        if faults is not None and faults.fragment:
+            step = faults.fragment
+        try:
+            for offset in range(0, len(data), step):
+                piece = data[offset:offset + step]
+                start = time.monotonic()
+                sock.sendall(piece)
+                if faults is not None and faults.bandwidth:
+                    wait = len(piece) / faults.bandwidth - (time.monotonic() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+        except OSError:
+            return False
+        return True
+
+    def abort(self, rst: bool):
+        """
+        Drop the connection on both sides
+
+        With rst the client side is reset (as a crashing peer would do);
+        otherwise both sides see an orderly close.
+        """
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        for chunks in self.queues:
+            # Wake writers waiting for data
+            try:
+                chunks.put_nowait((0.0, b''))
+            except queue.Full:
+                pass
+        if rst:
+            # Linger time 0 makes the final close() in handle() send RST
+            # instead of FIN; SHUT_RD only wakes the blocked reader
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        for sock, how in ((self.request, socket.SHUT_RD if rst else socket.SHUT_RDWR),
+                          (self.upstream, socket.SHUT_RDWR)):
+            try:
+                sock.shutdown(how)
+            except OSError:
+                pass
+        self.server.count('resets' if rst else 'truncations')
+
+
+class FaultProxy(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCP proxy injecting faults into forwarded connections
+
+    The active faults can be replaced at any time; running connections see
+    the new faults with their next chunk.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, listen: Tuple[str, int], target: Tuple[str, int], faults: Optional[Faults] = None,
+                 verbose: bool = False):
+        """
+        Args:
+            listen: (host, port) to accept connections on (port 0 picks one)
+            target: (host, port) connections are forwarded to
+            faults: Initial faults (default: none)
+            verbose: Print proxy events
+        """
+        super().__init__(listen, FaultProxyHandler)
+        self.target = target
+        self.faults = faults or Faults()
+        self.verbose = verbose
+        self.counters = {'connections': 0, 'resets': 0, 'truncations': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        """Port the proxy listens on"""
+        return self.server_address[1]
+
+    def process_request(self, request, client_address):
+        """Count the connection, then forward it in a new thread"""
+        self.count('connections')
+        super().process_request(request, client_address)
+
+    def count(self, name: str):
+        """Increment an event counter"""
+        with self._lock:
+            self.counters[name] += 1
+
+    def log(self, message: str):
+        """Print a proxy event when verbose"""
+        if self.verbose:
+            print(f"{Colors.WARNING}[proxy] {message}{Colors.ENDC}", flush=True)
+
+    def start(self):
+        """Serve in a background thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def parse_address(value: str, default_port: int) -> Tuple[str, int]:
+    """Parse 'host:port' (or 'host') into a tuple"""
+    host, _, port = value.rpartition(':') if ':' in value else (value, '', '')
+    return host or '127.0.0.1', int(port) if port else default_port
+
+
+def run_scenario(proxy: FaultProxy, scenario: Scenario, generator: Optional[LoadGenerator],
+                 interval: float = 1.0) -> List[Dict[str, any]]:
+    """
+    Apply the scenario's phases to the proxy while an optional load runs
+
+    Args:
+        proxy: Running fault proxy
+        scenario: Phases to apply
+        generator: Load to run for the scenario duration, or None to only
+            switch faults (e.g. for manual testing)
+        interval: Seconds between samples
+
+    Returns:
+        One sample per interval with the phase name and load metrics
+    """
+    stats = LoadStats()
+    runner = None
+    if generator is not None:
+        runner = threading.Thread(target=generator.run, args=(stats,), daemon=True)
+    start = time.monotonic()
+    if runner is not None:
+        runner.start()
+
+    samples = []
+    phase = None
+    last_time = start
+    last = LoadStats()
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= scenario.duration and (runner is None or not runner.is_alive()):
+            break
+        current = scenario.phase_at(elapsed)
+        if current is not phase:
+            phase = current
+            proxy.faults = phase['faults']
+            print(f"[{elapsed:7.1f}s] Phase '{phase['name']}': faults {phase['faults'].describe()}", flush=True)
+        if runner is not None:
+            runner.join(interval)
+        else:
+            time.sleep(min(interval, max(0.01, scenario.duration - elapsed)))
+        now = time.monotonic()
+        snapshot = stats.snapshot()
+        requests = snapshot.counters['requests'] - last.counters['requests']
+        latency = snapshot.histogram.since(last.histogram)
+        sample = {
+            'elapsed': round(now - start, 1),
+            'phase': phase['name'],
+            'requests': requests,
+            'throughput': round(requests / (now - last_time), 1) if now > last_time else 0.0,
+            'errors': snapshot.counters['errors'] - last.counters['errors'],
+            'threats': snapshot.counters['threats'] - last.counters['threats'],
+            'p50_ms': round(latency.percentile(50) * 1000, 2),
+            'p99_ms': round(latency.percentile(99) * 1000, 2),
+            'status_codes': {code: count - last.status_codes.get(code, 0)
+                             for code, count in snapshot.status_codes.items()
+                             if count - last.status_codes.get(code, 0)},
+            '_latency': latency,
+        }
+        samples.append(sample)
+        last, last_time = snapshot, now
+        if generator is not None:
+            print(f"[{sample['elapsed']:7.1f}s] {sample['throughput']:8.1f} req/s  errors {sample['errors']:<5} "
+                  f"p99 {sample['p99_ms']:.1f}ms", flush=True)
+    proxy.faults = Faults()
+    return samples
+
+
+def analyze_phases(scenario: Scenario, samples: List[Dict[str, any]],
+                   recovered_ratio: float = 0.9) -> Dict[str, Dict[str, any]]:
+    """
+    Summarize each phase and measure collapse and recovery
+
+    Throughput of each phase is compared with the first fault-free phase.
+    For a fault-free phase following a faulted one, the recovery time is
+    the time from the phase start until the first interval reaching
+    recovered_ratio of the baseline throughput without errors.
+
+    Returns:
+        Metrics per phase name, in scenario order
+    """
+    results = {}
+    baseline = None
+    previous_faulted = False
+    for phase in scenario.phases:
+        phase_samples = [sample for sample in samples if sample['phase'] == phase['name']]
+        if not phase_samples:
+            continue
+        latency = LatencyHistogram()
+        for sample in phase_samples:
+            latency.merge(sample['_latency'])
+        status_codes = {}
+        for sample in phase_samples:
+            for code, count in sample['status_codes'].items():
+                status_codes[code] = status_codes.get(code, 0) + count
+        throughput = sum(sample['throughput'] for sample in phase_samples) / len(phase_samples)
+        result = {
+            'faults': phase['faults'].describe(),
+            'throughput': round(throughput, 2),
+            'min_throughput': min(sample['throughput'] for sample in phase_samples),
+            'requests': sum(sample['requests'] for sample in phase_samples),
+            'errors': sum(sample['errors'] for sample in phase_samples),
+            'threats': sum(sample['threats'] for sample in phase_samples),
+            'latency_p50_ms': round(latency.percentile(50) * 1000, 3),
+            'latency_p99_ms': round(latency.percentile(99) * 1000, 3),
+            'status_codes': ', '.join(f"{code}={count}" for code, count in sorted(status_codes.items())),
+        }
+        if baseline is None and phase['clean']:
+            baseline = throughput
+        if baseline:
+            result['throughput_ratio'] = round(throughput / baseline, 3)
+        if phase['clean'] and previous_faulted and baseline:
+            result['recovery_s'] = None
+            for sample in phase_samples:
+                if sample['throughput'] >= baseline * recovered_ratio and not sample['errors']:
+                    result['recovery_s'] = round(sample['elapsed'] - phase['at'], 1)
+                    break
+        previous_faulted = not phase['clean']
+        results[phase['name']] = result
+    return results
+
+
+def print_phase_results(results: Dict[str, Dict[str, any]], proxy: FaultProxy):
+    """Print the per-phase degradation table"""
+    print(f"\n{'='*100}")
+    print("Fault Scenario Results")
+    print(f"{'='*100}")
+    print(f"{'Phase':<20} {'req/s':>9} {'min':>8} {'vs base':>8} {'errors':>7} {'p99 ms':>9} "
+          f"{'recovery':>9}  status codes")
+    for name, result in results.items():
+        ratio = f"{result['throughput_ratio'] * 100:.0f}%" if 'throughput_ratio' in result else '-'
+        if 'recovery_s' not in result:
+            recovery = '-'
+        elif result['recovery_s'] is None:
+            recovery = f"{Colors.FAIL}never{Colors.ENDC}"
+        else:
+            recovery = f"{result['recovery_s']:.1f}s"
+        print(f"{name:<20} {result['throughput']:>9.1f} {result['min_throughput']:>8.1f} {ratio:>8} "
+              f"{result['errors']:>7} {result['latency_p99_ms']:>9.2f} {recovery:>9}  {result['status_codes']}")
+    counters = proxy.counters
+    print(f"\nProxy: {counters['connections']} connections, {counters['resets']} resets, "
+          f"{counters['truncations']} truncations")
+    print(f"{'='*100}")
+
+
+def write_timeline(samples: List[Dict[str, any]], path: str):
+    """Write the per-interval samples as CSV"""
+    columns = ['elapsed', 'phase', 'requests', 'throughput', 'errors', 'threats', 'p50_ms', 'p99_ms']
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ICAP Fault-Injection Proxy - degrade connections to the ICAP server or clamd'
+    )
+    parser.add_argument('--version', action='version',
+                        version=f'%(prog)s {__version__}')
+    parser.add_argument('--listen', default='127.0.0.1:13310',
+                        help='Address to accept connections on (default: 127.0.0.1:13310)')
+    parser.add_argument('--target', required=True,
+                        help='Address to forward to, e.g. clamav:3310 or 127.0.0.1:1344')
+    parser.add_argument('--scenario', metavar='FILE',
+                        help='JSON scenario file with timed fault phases')
+    for name, default in Faults.FIELDS.items():
+        option = '--' + name.replace('_', '-')
+        if name == 'direction':
+            parser.add_argument(option, choices=['upstream', 'downstream', 'both'], default=default,
+                                help='Direction static faults apply to (default: both)')
+        else:
+            parser.add_argument(option, type=parse_size if isinstance(default, int) else float, default=default,
+                                help=f'Static fault {name} (default: {default})')
+    parser.add_argument('--load', metavar='HOST:PORT',
+                        help='Run ICAP load against HOST:PORT during the scenario '
+                             '(the proxy itself when it fronts the ICAP server)')
+    parser.add_argument('--service', default='avscan',
+                        help='ICAP service path for --load (default: avscan)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Concurrent requests for --load (default: 8)')
+    parser.add_argument('--payload-size', type=parse_size,
+                        help='Synthetic body size for --load (e.g. 64K)')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='Reuse connections in --load')
+    parser.add_argument('--timeline', metavar='FILE',
+                        help='Write per-second samples as CSV')
+    parser.add_argument('--output', metavar='FILE',
+                        help='Export per-phase results (.json, .csv or .prom)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Print proxy events')
+
+    args = parser.parse_args()
+
+    try:
+        static = Faults(**{name: getattr(args, name) for name in Faults.FIELDS})
+        scenario = Scenario.load(args.scenario) if args.scenario else None
+    except (OSError, ValueError) as e:
+        print(f"✗ {e}")
+        sys.exit(2)
+
+    proxy = FaultProxy(parse_address(args.listen, 13310), parse_address(args.target, 3310),
+                       static, verbose=args.verbose)
+    proxy.start()
+    print(f"\nICAP Fault-Injection Proxy")
+    print(f"Listening on {proxy.server_address[0]}:{proxy.port} -> {proxy.target[0]}:{proxy.target[1]}")
+    print(f"{'='*60}")
+
+    if scenario is None:
+        print(f"Faults: {static.describe()} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            proxy.shutdown()
+        return
+
+    generator = None
+    if args.load:
+        host, port = parse_address(args.load, 1344)
+        payload = Payload(args.payload_size) if args.payload_size is not None else None
+        generator = LoadGenerator(host, port, args.service, concurrency=args.concurrency,
+                                  requests=None, duration=scenario.duration,
+                                  options_cache=OptionsCache(), payload=payload,
+                                  keep_alive=args.keep_alive)
+    try:
+        samples = run_scenario(proxy, scenario, generator)
+    except KeyboardInterrupt:
+        proxy.shutdown()
+        sys.exit(130)
+    proxy.shutdown()
+
+    if generator is None:
+        return
+    results = analyze_phases(scenario, samples)
+    print_phase_results(results, proxy)
+    if args.timeline:
+        write_timeline(samples, args.timeline)
+        print(f"✓ Timeline written to {args.timeline}")
+    if args.output:
+        document = new_result_document('faults', f"icap://{args.load}/{args.service}")
+        document['scenario'] = args.scenario
+        document['runs'] = results
+        export_results(document, args.output)
+        print(f"✓ Results exported to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,33 @@ __author__ = "Roland Imme"
 
 import socket
 import socketserver
+import ssl
 import threading
 import logging
 import argparse
+import base64
+import copy
+import gzip
+import hashlib
+import hmac
+import heapq
+import http.server
+import io
+import itertools
+import json
+import mmap
+import os
+import random
+import re
+import struct
 import sys
-from typing import Tuple, Optional
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, deque
+from email.utils import formatdate
+from urllib.parse import urlsplit
+from typing import Tuple, Optional, Dict, Iterable, Iterator, List
 
 # Configure logging
 logging.basicConfig(
@@ -54,31 +76,40 @@ class ClamAVClient:
         """
         Scan bytes with ClamAV
         
+        Returns:
+            Tuple of (is_infected, virus_name)
+        """
+        return self.scan_stream((data,))
+    
+    def scan_stream(self, chunks: Iterable[bytes]) -> Tuple[bool, str]:
+        """
+        Scan data with ClamAV, streaming it chunk by chunk (INSTREAM)
+        
+        Args:
+            chunks: Data to scan, e.g. from BodyBuffer.iter_chunks()
+        
         Returns:
             Tuple of (is_infected, virus_name)
         """
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect((self.host, self.port))
-            
-            # Send INSTREAM command
-            sock.sendall(b'zINSTREAM\0')
-            
-            # Send data in chunks
-            chunk_size = 4096
-            for i in range(0, len(data), chunk_size):
-                chunk = data[i:i + chunk_size]
-                size = len(chunk)
-                # Send chunk size (4 bytes, network byte order) + chunk
-                sock.sendall(size.to_bytes(4, 'big') + chunk)
-            
-            # Send zero-length chunk to signal end
-            sock.sendall(b'\x00\x00\x00\x00')
-            
-            # Receive response
-            response = sock.recv(4096).decode('utf-8', errors='ignore')
-            sock.close()
+            with socket.create_connection((self.host, self.port), timeout=10) as sock:
+                # Send INSTREAM command
+                sock.sendall(b'zINSTREAM\0')
+                
+                # Send data in chunks
+                chunk_size = 4096
+                for data in chunks:
+                    view = memoryview(data)
+                    for i in range(0, len(view), chunk_size):
+                        chunk = view[i:i + chunk_size]
+                        # Send chunk size (4 bytes, network byte order) + chunk
+                        sock.sendall(len(chunk).to_bytes(4, 'big') + chunk)
+                
+                # Send zero-length chunk to signal end
+                sock.sendall(b'\x00\x00\x00\x00')
+                
+                # Receive response
+                response = sock.recv(4096).decode('utf-8', errors='ignore').rstrip('\0\n')
             
             logger.debug(f"ClamAV response: {response}")
             
@@ -96,88 +127,2255 @@ class ClamAVClient:
             logger.error(f"Error scanning with ClamAV: {e}")
             return False, f'Error: {str(e)}'
     
-    def ping(self) -> bool:
-        """Check if ClamAV is reachable"""
+    def ping(self) -> bool:
+        """Check if ClamAV is reachable"""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect((self.host, self.port))
+            sock.sendall(b'zPING\0')
+            response = sock.recv(1024)
+            sock.close()
+            return b'PONG' in response
+        except Exception as e:
+            logger.debug(f"ClamAV ping failed: {e}")
+            return False
+    
+    def version(self) -> Optional[str]:
+        """
+        Query the engine and signature version
+        
+        Returns:
+            Version string such as 'ClamAV 1.3.1/27400/Mon Jan  1 08:00:00 2026',
+            or None if clamd is unreachable
+        """
+        try:
+            with socket.create_connection((self.host, self.port), timeout=5) as sock:
+                sock.sendall(b'zVERSION\0')
+                response = sock.recv(1024)
+            return response.rstrip(b'\0\n').decode('utf-8', errors='ignore') or None
+        except Exception as e:
+            logger.warning(f"ClamAV version query failed: {e}")
+            return None
+
+
+def istag_from_version(version: str) -> Optional[str]:
+    """
+    Derive an ISTag value from the clamd VERSION answer
+    
+    The tag combines engine version and signature database version (e.g.
+    'clamav-1.3.1-27400'), so it changes whenever signatures are updated.
+    ISTag values are limited to 32 characters (RFC 3507).
+    
+    Returns:
+        Tag without quotes, or None if the version cannot be parsed
+    """
+    match = re.match(r'ClamAV\s+([^/\s]+)(?:/(\d+))?', version)
+    if not match:
+        return None
+    engine, database = match.groups()
+    tag = f"clamav-{engine}-{database}" if database else f"clamav-{engine}"
+    return re.sub(r'[^A-Za-z0-9._-]', '_', tag)[:32]
+
+
+class ISTagSource:
+    """
+    Current ISTag, refreshed from clamd in the background
+    
+    The header line is built once per change, so responses only copy it.
+    Until clamd answers VERSION the static fallback tag is used.
+    """
+    
+    FALLBACK = 'python-icap-1.0'
+    
+    def __init__(self, clamav: Optional[ClamAVClient] = None, interval: float = 60.0):
+        """
+        Args:
+            clamav: Client used for the VERSION query
+            interval: Seconds between refreshes (0 disables the background refresh)
+        """
+        self.clamav = clamav
+        self.interval = interval
+        self.version = None
+        self._stop = threading.Event()
+        self._set(self.FALLBACK)
+    
+    def _set(self, tag: str):
+        self.tag = tag
+        self.header = f'ISTag: "{tag}"\r\n'.encode('ascii')
+    
+    def refresh(self) -> bool:
+        """
+        Query clamd and update the tag
+        
+        Returns:
+            True if the tag changed
+        """
+        if self.clamav is None:
+            return False
+        version = self.clamav.version()
+        tag = istag_from_version(version) if version else None
+        if tag is None or tag == self.tag:
+            return False
+        logger.info(f"ISTag changed: {self.tag} -> {tag} ({version})")
+        self.version = version
+        self._set(tag)
+        return True
+    
+    def start(self):
+        """Refresh periodically in a background thread"""
+        if self.interval <= 0:
+            return
+        
+        def run():
+            while not self._stop.wait(self.interval):
+                self.refresh()
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def stop(self):
+        """Stop the background refresh"""
+        self._stop.set()
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size such as '512', '64K', '256M' or '2G' into bytes"""
+    match = re.fullmatch(r'([0-9]*\.?[0-9]+)\s*([KMG]?)(I?B)?', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+class ByteBudget:
+    """
+    Server-wide budget for request body bytes held in memory
+    
+    Handlers reserve bytes before buffering body data and release them
+    when the request is done. A reservation that does not fit waits for
+    other requests to release bytes, up to a timeout.
+    """
+    
+    def __init__(self, limit: int):
+        """
+        Args:
+            limit: Maximum body bytes in memory across all requests
+        """
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self.counters = {'waits': 0, 'spooled': 0, 'oversized': 0}
+        self._condition = threading.Condition()
+    
+    def acquire(self, size: int, timeout: float = 0.0) -> bool:
+        """
+        Reserve bytes, waiting up to timeout seconds for room
+        
+        Returns:
+            True if the bytes were reserved
+        """
+        with self._condition:
+            if self.in_use + size > self.limit:
+                if size > self.limit or timeout <= 0:
+                    return False
+                self.counters['waits'] += 1
+                self.waiting += 1
+                try:
+                    if not self._condition.wait_for(lambda: self.in_use + size <= self.limit, timeout):
+                        return False
+                finally:
+                    self.waiting -= 1
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+            return True
+    
+    def release(self, size: int):
+        """Return reserved bytes to the budget"""
+        if size:
+            with self._condition:
+                self.in_use -= size
+                self._condition.notify_all()
+    
+    def count(self, name: str):
+        """Increment an event counter"""
+        with self._condition:
+            self.counters[name] += 1
+    
+    def stats(self) -> Dict[str, int]:
+        """Current usage and counters"""
+        with self._condition:
+            return dict(self.counters, in_use=self.in_use, limit=self.limit, peak=self.peak,
+                        waiting=self.waiting)
+
+
+class BodyBuffer:
+    """
+    Request body held in memory within the byte budget, spooled to disk beyond it
+    
+    Data stays in memory while the request is below its own memory cap and
+    the global budget has room (optionally after waiting). Otherwise the
+    buffered data moves to a temporary file and the rest of the body is
+    appended there, so memory use does not depend on body sizes.
+    """
+    
+    def __init__(self, budget: ByteBudget, memory_limit: int, max_size: int = 0,
+                 keep_head: bool = False, wait: float = 0.0, spool_dir: Optional[str] = None,
+                 store: bool = True):
+        """
+        Args:
+            budget: Server-wide byte budget
+            memory_limit: Bytes this request may hold in memory
+            max_size: Largest body accepted (0 = unlimited); beyond it the
+                body is marked oversized
+            keep_head: Keep the first max_size bytes of an oversized body
+                instead of discarding all of it
+            wait: Seconds to wait for budget before spooling
+            spool_dir: Directory for spool files (default: system temp dir)
+            store: Keep the data; False only counts and hashes it
+        """
+        self.budget = budget
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self.keep_head = keep_head
+        self.wait = wait
+        self.spool_dir = spool_dir
+        self.store = store
+        self.pieces = []
+        self.in_memory = 0
+        self.size = 0
+        self.received = 0
+        self.oversized = False
+        self.spool = None
+        self.sha256 = hashlib.sha256()
+    
+    def write(self, data: bytes):
+        """Append body data"""
+        self.received += len(data)
+        self.sha256.update(data)
+        if self.max_size and self.received > self.max_size:
+            if not self.oversized:
+                self.oversized = True
+                self.budget.count('oversized')
+                if not self.keep_head:
+                    self.discard()
+            if not self.keep_head:
+                return
+            data = data[:max(0, self.max_size - self.size)]
+            if not data:
+                return
+        self.size += len(data)
+        if not self.store:
+            return
+        if self.spool is None:
+            if (self.in_memory + len(data) <= self.memory_limit
+                    and self.budget.acquire(len(data), self.wait)):
+                self.pieces.append(data)
+                self.in_memory += len(data)
+                return
+            self._spill()
+        self.spool.write(data)
+    
+    def _spill(self):
+        """Move the buffered data to a spool file and release its budget"""
+        self.spool = tempfile.TemporaryFile(dir=self.spool_dir)
+        for piece in self.pieces:
+            self.spool.write(piece)
+        self.pieces = []
+        self.budget.release(self.in_memory)
+        self.in_memory = 0
+        self.budget.count('spooled')
+        logger.info(f"Spooling request body to disk after {self.size} bytes")
+    
+    def iter_chunks(self, chunk_size: int = 65536) -> Iterator[bytes]:
+        """Yield the buffered body"""
+        if self.spool is None:
+            yield from self.pieces
+            return
+        self.spool.seek(0)
+        while True:
+            data = self.spool.read(chunk_size)
+            if not data:
+                return
+            yield data
+    
+    def discard(self):
+        """Drop the buffered data"""
+        self.budget.release(self.in_memory)
+        self.pieces = []
+        self.in_memory = 0
+        self.size = 0
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+    
+    def close(self):
+        """Release memory, budget and spool file"""
+        self.discard()
+
+
+class TrickleStream:
+    """
+    RESPMOD body sent back to the client while it is still received and scanned
+    
+    The handler thread writes received data here (it is also appended to
+    the body buffer for the scan); a writer thread sends everything but the
+    last `window` bytes as chunks of the 200 response, so the client's
+    first bytes do not wait for the end of the body or the verdict. Once
+    the verdict is in, finish() sends the held-back tail and the final
+    chunk, abort() stops without it so the client discards the truncated
+    object.
+    
+    Unsent data beyond the window is limited to `limit` bytes; if the
+    client does not read the response for `timeout` seconds while the
+    limit is reached, receiving fails. Clients must therefore read the
+    response while they are still sending the body.
+    """
+    
+    def __init__(self, wfile, body: BodyBuffer, window: int, limit: int, timeout: float = 30.0):
+        """
+        Args:
+            wfile: Connection (or response slot) the chunks are written to
+            body: Buffer that receives a copy of the data for the scan
+            window: Bytes held back until the verdict
+            limit: Unsent bytes beyond the window before receiving waits
+            timeout: Seconds receiving waits for the client to read
+        """
+        self.wfile = wfile
+        self.body = body
+        self.window = window
+        self.limit = limit
+        self.timeout = timeout
+        self.pending = deque()
+        self.unsent = 0
+        self.sent = 0
+        self.finished = False
+        self.aborted = False
+        self.failed = False
+        self._condition = threading.Condition()
+        self._thread = None
+    
+    @property
+    def received(self) -> int:
+        return self.body.received
+    
+    def write(self, data: bytes):
+        """Append received body data"""
+        self.body.write(data)
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self.failed or self.unsent <= self.window + self.limit, self.timeout):
+                self.failed = True
+                self._condition.notify_all()
+                raise ConnectionError(f"Client did not read the streamed response for {self.timeout}s")
+            if self.failed:
+                raise ConnectionError("Client closed the streamed response")
+            self.pending.append(data)
+            self.unsent += len(data)
+            self._condition.notify_all()
+    
+    def start(self):
+        """Start sending; the response headers must have been written"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _take(self) -> Optional[List[bytes]]:
+        """Wait for data that may be sent; None once the stream is over"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.aborted or self.failed or self.finished
+                                     or self.unsent > self.window)
+            if self.aborted or self.failed:
+                return None
+            allowed = self.unsent if self.finished else self.unsent - self.window
+            if allowed <= 0:
+                return None
+            pieces = []
+            while allowed > 0:
+                data = self.pending.popleft()
+                if len(data) > allowed:
+                    self.pending.appendleft(data[allowed:])
+                    data = data[:allowed]
+                pieces.append(data)
+                allowed -= len(data)
+                self.unsent -= len(data)
+            self._condition.notify_all()
+            return pieces
+    
+    def _run(self):
+        try:
+            while True:
+                pieces = self._take()
+                if pieces is None:
+                    break
+                for data in pieces:
+                    self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+                    self.sent += len(data)
+            if not (self.aborted or self.failed):
+                self.wfile.write(b'0\r\n\r\n')
+        except OSError as e:
+            logger.debug(f"Streamed response failed: {e}")
+            with self._condition:
+                self.failed = True
+                self._condition.notify_all()
+    
+    def finish(self) -> bool:
+        """
+        Send the held-back tail and end the response
+        
+        Returns:
+            True if the whole body reached the client
+        """
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+        # Wait as long as the client keeps reading
+        while self._thread is not None and self._thread.is_alive():
+            sent = self.sent
+            self._thread.join(self.timeout)
+            if self._thread.is_alive() and self.sent == sent:
+                self.fail()
+                break
+        return not self.failed and self.sent == self.received
+    
+    def fail(self):
+        """Mark the received body incomplete, so the response is never completed"""
+        with self._condition:
+            self.failed = True
+            self._condition.notify_all()
+    
+    def abort(self):
+        """
+        Stop sending; the response stays without its final chunk
+        
+        A write blocked on a client that does not read is left to fail
+        when the handler closes the connection.
+        """
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(self.timeout)
+
+
+# Known-hash index file: header, Bloom filter bits, then sorted records of
+# SHA-256 digest plus verdict byte (b'A' allow, b'D' deny)
+HASH_INDEX_MAGIC = b'ICAPHIX1'
+HASH_INDEX_HEADER = struct.Struct('>8sQII')
+HASH_INDEX_RECORD = 33
+
+
+def read_hash_list(path: str) -> Iterator[bytes]:
+    """
+    Read SHA-256 digests from a text file
+    
+    One hex digest per line; further columns (as in sha256sum output),
+    blank lines and '#' comments are ignored.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            value = line.split()[0]
+            try:
+                digest = bytes.fromhex(value)
+            except ValueError:
+                digest = b''
+            if len(digest) != 32:
+                raise ValueError(f"{path}:{number}: not a SHA-256 digest: {value}")
+            yield digest
+
+
+def build_hash_index(output: str, allow_paths: List[str], deny_paths: List[str],
+                     bloom_bits: int = 10) -> int:
+    """
+    Build a hash index file from allow and deny lists
+    
+    A digest on both lists is denied. The file is written under a
+    temporary name and renamed into place, so a running server reloads
+    either the old or the new index, never a partial one.
+    
+    Args:
+        output: Index file to write
+        allow_paths: Text files with known-clean digests
+        deny_paths: Text files with known-bad digests
+        bloom_bits: Bloom filter bits per entry (0 for no filter)
+    
+    Returns:
+        Number of entries written
+    """
+    verdicts = {}
+    for path in allow_paths:
+        for digest in read_hash_list(path):
+            verdicts.setdefault(digest, b'A')
+    for path in deny_paths:
+        for digest in read_hash_list(path):
+            verdicts[digest] = b'D'
+    count = len(verdicts)
+    size = bloom_bits * count if bloom_bits and count else 0
+    # About 0.7 bits per entry per hash function minimizes false positives
+    hashes = max(1, min(8, round(bloom_bits * 0.693))) if size else 0
+    bloom = bytearray((size + 7) // 8)
+    for digest in verdicts:
+        for bit in _bloom_bits(digest, size, hashes):
+            bloom[bit // 8] |= 1 << (bit % 8)
+    temp_path = f"{output}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(HASH_INDEX_HEADER.pack(HASH_INDEX_MAGIC, count, size, hashes))
+        f.write(bloom)
+        for digest in sorted(verdicts):
+            f.write(digest + verdicts[digest])
+    os.replace(temp_path, output)
+    return count
+
+
+def _bloom_bits(digest: bytes, size: int, hashes: int) -> Iterator[int]:
+    """Bloom filter bit positions; the digest itself supplies the hash values"""
+    for i in range(hashes):
+        yield int.from_bytes(digest[4 * i:4 * i + 4], 'big') % size
+
+
+class HashIndex:
+    """
+    Memory-mapped known-hash index with atomic reload
+    
+    Lookups binary-search the sorted records of the mapped file after an
+    optional Bloom filter check, so the index costs page cache rather than
+    heap and unknown digests are usually rejected with a few bit tests.
+    A watcher thread maps a replaced file and swaps it in; lookups in
+    flight keep using the previous mapping.
+    """
+    
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Index file built with build_hash_index()
+        """
+        self.path = path
+        self._current = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.counters = {'lookups': 0, 'allow': 0, 'deny': 0, 'bloom_rejects': 0,
+                         'bloom_false_positives': 0, 'reloads': 0}
+        self.lookup_ns = 0
+        self.max_lookup_ns = 0
+        self.entries = 0
+        self.load()
+    
+    def load(self) -> bool:
+        """
+        Map the index file if it changed since the last load
+        
+        Returns:
+            True if a new index was mapped
+        
+        Raises:
+            OSError, ValueError: If the file cannot be read or is invalid
+        """
+        stat = os.stat(self.path)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self._signature:
+            return False
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        if len(data) < HASH_INDEX_HEADER.size:
+            raise ValueError(f"Hash index too short: {self.path}")
+        magic, count, size, hashes = HASH_INDEX_HEADER.unpack_from(data)
+        bloom_offset = HASH_INDEX_HEADER.size
+        records_offset = bloom_offset + (size + 7) // 8
+        if magic != HASH_INDEX_MAGIC or len(data) != records_offset + count * HASH_INDEX_RECORD:
+            raise ValueError(f"Invalid hash index: {self.path}")
+        self._current = (data, count, size, hashes, bloom_offset, records_offset)
+        self._signature = signature
+        self.entries = count
+        with self._lock:
+            self.counters['reloads'] += 1
+        logger.info(f"Hash index loaded: {count} entries from {self.path}")
+        return True
+    
+    def lookup(self, digest: bytes) -> Optional[str]:
+        """
+        Look up a SHA-256 digest
+        
+        Returns:
+            'allow', 'deny' or None if the digest is unknown
+        """
+        start = time.perf_counter_ns()
+        data, count, size, hashes, bloom_offset, records_offset = self._current
+        verdict = None
+        outcome = None
+        if size and not all(data[bloom_offset + bit // 8] & (1 << (bit % 8))
+                            for bit in _bloom_bits(digest, size, hashes)):
+            outcome = 'bloom_rejects'
+        else:
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                offset = records_offset + middle * HASH_INDEX_RECORD
+                key = data[offset:offset + 32]
+                if key < digest:
+                    low = middle + 1
+                elif key > digest:
+                    high = middle
+                else:
+                    verdict = 'allow' if data[offset + 32:offset + 33] == b'A' else 'deny'
+                    outcome = verdict
+                    break
+            if verdict is None and size:
+                outcome = 'bloom_false_positives'
+        elapsed = time.perf_counter_ns() - start
+        with self._lock:
+            self.counters['lookups'] += 1
+            if outcome:
+                self.counters[outcome] += 1
+            self.lookup_ns += elapsed
+            self.max_lookup_ns = max(self.max_lookup_ns, elapsed)
+        return verdict
+    
+    def start_watcher(self, interval: float):
+        """Reload the index in a background thread when the file changes"""
+        if interval <= 0:
+            return
+        
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.load()
+                except (OSError, ValueError) as e:
+                    logger.error(f"Hash index reload failed, keeping previous index: {e}")
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def stats(self) -> Dict[str, any]:
+        """Counters and lookup latency"""
+        with self._lock:
+            lookups = self.counters['lookups']
+            return dict(self.counters, entries=self.entries,
+                        mean_lookup_us=round(self.lookup_ns / lookups / 1000, 2) if lookups else 0,
+                        max_lookup_us=round(self.max_lookup_ns / 1000, 2))
+
+
+class VerdictCache:
+    """
+    Scan verdicts by body SHA-256 for the current signature version
+    
+    A bounded LRU in front of clamd: content scanned again under the same
+    signatures gets the same verdict, so it is answered from memory. The
+    signature version is the current ISTag; entries are dropped when it
+    changes, and nothing is cached while clamd's version is unknown. Only
+    definite verdicts (clean or a threat name) are stored, never errors.
+    With peers attached (see PeerVerdicts), a local miss is asked of the
+    peers before clamd, and fresh verdicts are published to them.
+    """
+    
+    def __init__(self, size: int, istag: ISTagSource):
+        """
+        Args:
+            size: Most verdicts kept
+            istag: Source of the current signature version
+        """
+        self.size = size
+        self.istag = istag
+        self.peers = None
+        self.signature = None
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'remote_hits': 0, 'stored': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+    
+    def current_signature(self) -> Optional[str]:
+        """Signature version verdicts are valid for, None while unknown"""
+        tag = self.istag.tag
+        return None if tag == ISTagSource.FALLBACK else tag
+    
+    def _valid(self, signature: str) -> bool:
+        """Whether signature is current; clears the cache when the version moved (lock held)"""
+        current = self.current_signature()
+        if current != self.signature:
+            self.entries.clear()
+            self.signature = current
+        return current is not None and signature == current
+    
+    def get(self, digest: bytes, signature: str, count: bool = True) -> Optional[Tuple[bool, str]]:
+        """
+        Local verdict for a digest
+        
+        Args:
+            digest: SHA-256 of the body
+            signature: Signature version the verdict must be valid for
+            count: Count the lookup as a hit or miss (not for peer queries)
+        
+        Returns:
+            (is_infected, name) like ClamAVClient.scan_stream, or None
+        """
+        with self._lock:
+            entry = self.entries.get(digest) if self._valid(signature) else None
+            if entry is not None:
+                self.entries.move_to_end(digest)
+            if count:
+                self.counters['hits' if entry is not None else 'misses'] += 1
+                self.counters['remote_hits'] += entry is not None and entry[1]
+            return entry[0] if entry is not None else None
+    
+    def put(self, digest: bytes, verdict: Tuple[bool, str], signature: str, remote: bool = False) -> bool:
+        """
+        Store a verdict computed under the given signature version
+        
+        A peer's verdict never replaces one clamd gave this server.
+        
+        Args:
+            remote: The verdict came from a peer (its hits count as remote_hits)
+        
+        Returns:
+            False if nothing was stored (version not current, or a remote
+            verdict for a digest with a local one)
+        """
+        with self._lock:
+            if not self._valid(signature):
+                return False
+            if remote:
+                entry = self.entries.get(digest)
+                if entry is not None and not entry[1]:
+                    return False
+            self.entries[digest] = (verdict, remote)
+            self.entries.move_to_end(digest)
+            self.counters['stored'] += 1
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counters['evicted'] += 1
+            return True
+    
+    def lookup(self, digest: bytes) -> Tuple[Optional[Tuple[bool, str]], str]:
+        """
+        Verdict from the local cache, else from the peers
+        
+        Returns:
+            (verdict or None, 'local' or 'peer' as where it came from)
+        """
+        signature = self.current_signature()
+        if signature is None:
+            return None, 'local'
+        verdict = self.get(digest, signature)
+        if verdict is not None or self.peers is None:
+            return verdict, 'local'
+        verdict = self.peers.lookup(digest, signature)
+        if verdict is not None:
+            self.put(digest, verdict, signature, remote=True)
+        return verdict, 'peer'
+    
+    def store(self, digest: bytes, verdict: Tuple[bool, str]):
+        """Store a fresh clamd verdict and publish it to the peers"""
+        signature = self.current_signature()
+        if signature is not None and self.put(digest, verdict, signature) and self.peers is not None:
+            self.peers.publish(digest, verdict, signature)
+    
+    def stats(self) -> Dict[str, any]:
+        """
+        Local counters, merged with the peer counters if peers are attached
+        
+        cross_node_pct is the share of lookups answered with another
+        server's verdict, from a published entry or a peer query.
+        """
+        with self._lock:
+            stats = dict(self.counters, entries=len(self.entries))
+        if self.peers is not None:
+            stats.update(self.peers.stats())
+            lookups = stats['hits'] + stats['misses']
+            cross_node = stats['remote_hits'] + stats['peer_hits']
+            stats['cross_node_pct'] = round(cross_node / lookups * 100, 1) if lookups else 0.0
+        return stats
+
+
+class PeerVerdicts:
+    """
+    Verdict cache shared with peer ICAP servers over UDP
+    
+    A local miss is asked of all peers at once; the first answer for the
+    same digest and signature version wins, and once every peer has said
+    it does not know, or after the timeout, the body goes to clamd. Fresh
+    clamd verdicts are published to every peer. One datagram per message:
+    
+        Q <id> <signature> <sha256>              query
+        H <id> <signature> <sha256> <verdict>    answer (C, or I <name>)
+        M <id>                                   not known
+        P <signature> <sha256> <verdict>         publish
+    
+    Queries and publishes are only taken from the configured peer
+    addresses, and answers only from a peer's own port. With a shared
+    secret every datagram also carries an HMAC-SHA256 tag and datagrams
+    without a valid one are dropped. Without a secret, a spoofed source
+    address is enough to plant verdicts, so main() requires an explicit
+    --peer-insecure for that. Peer verdicts never replace local ones.
+    """
+    
+    DATAGRAM = 1024
+    SAMPLES = 1024
+    VIRUS_NAME = re.compile(r'[\x21-\x7e]{1,128}')
+    
+    def __init__(self, cache: VerdictCache, address: Tuple[str, int], peers: List[Tuple[str, int]],
+                 timeout: float = 0.02, secret: Optional[str] = None):
+        """
+        Args:
+            cache: Local cache answering peer queries and storing their verdicts
+            address: (host, port) the UDP socket binds to
+            peers: (host, port) of every peer, resolved once here
+            timeout: Seconds a lookup waits for the peers
+            secret: Shared secret authenticating datagrams (None for none)
+        """
+        self.cache = cache
+        self.peers = [(socket.gethostbyname(host), port) for host, port in peers]
+        self.peer_hosts = {host for host, _ in self.peers}
+        self.timeout = timeout
+        self.secret = secret.encode('utf-8') if secret else None
+        self.counters = {'peer_hits': 0, 'peer_misses': 0, 'peer_timeouts': 0, 'published': 0,
+                         'received': 0, 'served_hits': 0, 'served_misses': 0, 'rejected': 0}
+        self.latencies = deque(maxlen=self.SAMPLES)
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        cache.peers = self
+    
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+    
+    def _sign(self, message: str) -> bytes:
+        if self.secret is not None:
+            message += ' ' + hmac.new(self.secret, message.encode('ascii'), hashlib.sha256).hexdigest()[:32]
+        return message.encode('ascii')
+    
+    def _verify(self, data: bytes) -> Optional[List[str]]:
+        """Fields of a well-formed, authentic datagram, else None"""
+        try:
+            message = data.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+        if self.secret is not None:
+            message, _, tag = message.rpartition(' ')
+            expected = hmac.new(self.secret, message.encode('ascii'), hashlib.sha256).hexdigest()[:32]
+            if not hmac.compare_digest(tag, expected):
+                return None
+        return message.split(' ')
+    
+    @staticmethod
+    def _encode(verdict: Tuple[bool, str]) -> str:
+        is_infected, name = verdict
+        return f"I {name}" if is_infected else "C"
+    
+    @classmethod
+    def _decode(cls, fields: List[str]) -> Optional[Tuple[bool, str]]:
+        if fields == ['C']:
+            return False, 'Clean'
+        if len(fields) == 2 and fields[0] == 'I' and cls.VIRUS_NAME.fullmatch(fields[1]):
+            return True, fields[1]
+        return None
+    
+    def start(self):
+        """Answer peer queries and take published verdicts in a background thread"""
+        threading.Thread(target=self._serve, daemon=True).start()
+    
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(self.DATAGRAM)
+            except OSError:
+                return
+            fields = self._verify(data) if address[0] in self.peer_hosts else None
+            try:
+                if fields and fields[0] == 'Q' and len(fields) == 4:
+                    _, ident, signature, digest = fields
+                    verdict = self.cache.get(bytes.fromhex(digest), signature, count=False)
+                    if verdict is not None:
+                        reply = f"H {ident} {signature} {digest} {self._encode(verdict)}"
+                    else:
+                        reply = f"M {ident}"
+                    self.sock.sendto(self._sign(reply), address)
+                    self._count('served_hits' if verdict is not None else 'served_misses')
+                    continue
+                if fields and fields[0] == 'P' and len(fields) >= 4:
+                    verdict = self._decode(fields[3:])
+                    if verdict is not None and self.cache.put(bytes.fromhex(fields[2]), verdict,
+                                                              fields[1], remote=True):
+                        self._count('received')
+                        continue
+            except (ValueError, OSError) as e:
+                logger.debug(f"Peer datagram from {address[0]}: {e}")
+            self._count('rejected')
+    
+    def lookup(self, digest: bytes, signature: str) -> Optional[Tuple[bool, str]]:
+        """
+        Ask all peers for a verdict, waiting at most the timeout
+        
+        Returns:
+            (is_infected, name) from the first peer that knows it, or None
+        """
+        ident = os.urandom(4).hex()
+        query = self._sign(f"Q {ident} {signature} {digest.hex()}")
+        answer = ['H', ident, signature, digest.hex()]
+        start = time.monotonic()
+        verdict, outcome = None, 'peer_timeouts'
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            pending = 0
+            for peer in self.peers:
+                try:
+                    sock.sendto(query, peer)
+                    pending += 1
+                except OSError:
+                    pass
+            if not pending:
+                outcome = 'peer_misses'
+            while pending:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, address = sock.recvfrom(self.DATAGRAM)
+                except socket.timeout:
+                    break
+                except OSError:
+                    continue
+                if address not in self.peers:
+                    continue
+                fields = self._verify(data)
+                if not fields:
+                    continue
+                if fields[:4] == answer:
+                    verdict = self._decode(fields[4:])
+                    if verdict is not None:
+                        outcome = 'peer_hits'
+                        break
+                if fields[:4] == answer or fields == ['M', ident]:
+                    pending -= 1
+                    if not pending:
+                        outcome = 'peer_misses'
+        with self._lock:
+            self.counters[outcome] += 1
+            self.latencies.append(time.monotonic() - start)
+        return verdict
+    
+    def publish(self, digest: bytes, verdict: Tuple[bool, str], signature: str):
+        """Send a fresh verdict to every peer (fire and forget)"""
+        if verdict[0] and not self.VIRUS_NAME.fullmatch(verdict[1]):
+            return
+        message = self._sign(f"P {signature} {digest.hex()} {self._encode(verdict)}")
+        for peer in self.peers:
+            try:
+                self.sock.sendto(message, peer)
+            except OSError as e:
+                logger.debug(f"Publishing verdict to {peer[0]}:{peer[1]} failed: {e}")
+        self._count('published')
+    
+    def stats(self) -> Dict[str, float]:
+        """Counters, cross-node hit rate and lookup latency percentiles (ms)"""
+        with self._lock:
+            ordered = sorted(self.latencies)
+            counters = dict(self.counters)
+        lookups = counters['peer_hits'] + counters['peer_misses'] + counters['peer_timeouts']
+        
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2) if ordered else 0.0
+        
+        return dict(counters,
+                    peer_hit_pct=round(counters['peer_hits'] / lookups * 100, 1) if lookups else 0.0,
+                    peer_p50_ms=percentile(0.5), peer_p99_ms=percentile(0.99))
+
+
+class AdaptiveLimit:
+    """
+    Concurrent scan limit for one clamd, adjusted from observed scan latency
+    
+    Gradient control in the style of TCP Vegas: every finished scan gives
+    a latency sample, normalized per MiB of body so a changing size mix
+    does not look like congestion. The baseline is the lowest sample of
+    the previous window of scans (so it follows signature reloads and
+    slower hosts), the current latency a short moving average. Each scan
+    moves the limit toward limit * gradient + sqrt(limit), where gradient
+    = tolerance * baseline / current, clamped to 0.5..1: below the
+    tolerance the square root adds headroom, above it the limit shrinks
+    until the latency increase balances the headroom. Scan errors cut the
+    limit by a tenth (multiplicative decrease). The limit only grows while
+    at least half of it is in use.
+    """
+    
+    # Bytes per latency normalization unit
+    NORMALIZE = 1024 ** 2
+    # Weight of the newest sample in the current latency
+    SMOOTHING = 0.1
+    # Samples per baseline window
+    WINDOW = 500
+    # Weight of a new limit against the previous one
+    LIMIT_SMOOTHING = 0.2
+    ERROR_BACKOFF = 0.9
+    
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 100, tolerance: float = 1.5):
+        """
+        Args:
+            initial: Starting limit
+            minimum: Lowest limit
+            maximum: Highest limit
+            tolerance: Latency increase over the baseline that is accepted
+                before the limit shrinks
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.latency = None
+        self.baseline = None
+        self.window_min = None
+        self.samples = 0
+        self.counters = {'increases': 0, 'decreases': 0, 'errors': 0}
+    
+    def update(self, seconds: float, size: int, in_flight: int, ok: bool = True) -> int:
+        """
+        Adjust the limit after a finished scan (caller holds the scheduler lock)
+        
+        Args:
+            seconds: Time the scan took
+            size: Body size in bytes
+            in_flight: Scans running when this one finished, itself included
+            ok: False if clamd failed to answer
+        
+        Returns:
+            New limit
+        """
+        before = int(self.limit)
+        if not ok:
+            self.counters['errors'] += 1
+            self.limit = max(self.minimum, self.limit * self.ERROR_BACKOFF)
+        else:
+            sample = seconds / (1 + size / self.NORMALIZE)
+            self.latency = sample if self.latency is None else (
+                self.latency + self.SMOOTHING * (sample - self.latency))
+            self.window_min = sample if self.window_min is None else min(self.window_min, sample)
+            self.baseline = sample if self.baseline is None else min(self.baseline, sample)
+            self.samples += 1
+            if self.samples % self.WINDOW == 0:
+                self.baseline, self.window_min = self.window_min, None
+            gradient = max(0.5, min(1.0, self.tolerance * self.baseline / self.latency))
+            headroom = self.limit ** 0.5 if in_flight * 2 >= self.limit else 0.0
+            target = self.limit * gradient + headroom
+            if target < self.limit or headroom:
+                self.limit += self.LIMIT_SMOOTHING * (target - self.limit)
+                self.limit = min(max(self.limit, self.minimum), self.maximum)
+        after = int(self.limit)
+        if after > before:
+            self.counters['increases'] += 1
+        elif after < before:
+            self.counters['decreases'] += 1
+        return after
+    
+    def stats(self) -> Dict[str, float]:
+        """Current latency, baseline and adjustment counters"""
+        return dict(self.counters,
+                    rtt_ms=round(self.latency * 1000, 2) if self.latency is not None else 0,
+                    base_rtt_ms=round(self.baseline * 1000, 2) if self.baseline is not None else 0)
+
+
+class ScanScheduler:
+    """
+    Fair, size-aware admission of scans to clamd
+    
+    At most `slots` scans run at once. Waiting scans are grouped into flows
+    (one per client address or service) and dispatched by weighted fair
+    queuing: each scan costs its expected clamd time divided by the flow
+    weight, and the flow whose next scan would finish first in virtual
+    time goes next. Small bodies therefore overtake large ones, and a
+    client sending many large bodies only gets its share of clamd time.
+    Within a flow, scans are ordered by a deadline of arrival plus ten
+    times their expected clamd time, so a large body can be overtaken by
+    smaller ones for a while but is not starved.
+    
+    The expected time is learned from finished scans: a per-request
+    overhead (from bodies under 64 KiB) plus a per-byte rate, with sizes
+    capped so multi-GB bodies cannot block a flow for good. With an
+    AdaptiveLimit, `slots` follows the limit it derives from scan latency.
+    
+    A flow with no queued or running scans is dropped after FLOW_TTL
+    seconds idle, or sooner (longest idle first) once there are MAX_FLOWS,
+    so the table does not grow with every client ever seen; a returning
+    client starts at the current virtual time anyway. Busy flows are never
+    dropped.
+    """
+    
+    SMALL_SCAN = 64 * 1024
+    MAX_COST = 64 * 1024 ** 2
+    # Weight of the newest scan in the moving averages of scan time
+    LEARNING_RATE = 0.05
+    # Deadline within a flow, in multiples of the expected scan time
+    DEADLINE_FACTOR = 10
+    # Wait percentiles are reported separately below and above this size
+    SMALL_BODY = 1024 ** 2
+    WAIT_SAMPLES = 512
+    FLOW_TTL = 300.0
+    MAX_FLOWS = 256
+    
+    def __init__(self, slots: int, weights: Optional[Dict[str, float]] = None,
+                 limiter: Optional[AdaptiveLimit] = None):
+        """
+        Args:
+            slots: Concurrent clamd scans (initial value with a limiter)
+            weights: Flow weights by client address or service (default 1)
+            limiter: Adjusts slots from scan latency (None keeps them fixed)
+        """
+        self.limiter = limiter
+        self.slots = int(limiter.limit) if limiter is not None else slots
+        self.weights = weights or {}
+        self.active = 0
+        self.request_seconds = 0.001
+        self.byte_seconds = 1 / (50 * 1024 ** 2)
+        self.virtual_time = 0.0
+        self.flows = {}
+        # Flows with queued scans, so dispatch does not visit idle ones
+        self.backlogged = {}
+        # Time flows with nothing queued or running became idle, oldest first
+        self.idle = OrderedDict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+    
+    def _flow(self, key: str, now: float) -> Dict:
+        """Flow of a key about to get a scan, created if needed (lock held)"""
+        flow = self.flows.get(key)
+        if flow is None:
+            self._evict(now)
+            flow = self.flows[key] = {
+                'weight': self.weights.get(key, 1.0), 'finish': 0.0, 'queue': [],
+                'active': 0, 'dispatched': 0, 'waited': 0, 'wait_max': 0.0,
+                'waits': {'small': deque(maxlen=self.WAIT_SAMPLES),
+                          'large': deque(maxlen=self.WAIT_SAMPLES)},
+            }
+        else:
+            self.idle.pop(key, None)
+        return flow
+    
+    def _evict(self, now: float):
+        """Drop expired idle flows, and the longest idle beyond MAX_FLOWS (lock held)"""
+        while self.idle:
+            key, since = next(iter(self.idle.items()))
+            if now - since < self.FLOW_TTL and len(self.flows) < self.MAX_FLOWS:
+                return
+            del self.idle[key]
+            del self.flows[key]
+    
+    def _expected(self, size: int) -> float:
+        """Expected clamd time of a body in seconds"""
+        return self.request_seconds + min(size, self.MAX_COST) * self.byte_seconds
+    
+    def _cost(self, flow: Dict, size: int) -> float:
+        return self._expected(size) / flow['weight']
+    
+    def _start(self, flow: Dict, size: int):
+        """Account a dispatched scan (lock held)"""
+        start = flow['finish']
+        flow['finish'] = start + self._cost(flow, size)
+        self.virtual_time = max(self.virtual_time, start)
+        flow['active'] += 1
+        flow['dispatched'] += 1
+        self.active += 1
+    
+    def _dispatch(self):
+        """Grant free slots to the waiting scans that finish first (lock held)"""
+        while self.active < self.slots:
+            best_key, best, best_tag = None, None, 0.0
+            for key, flow in self.backlogged.items():
+                size = flow['queue'][0][2]
+                tag = flow['finish'] + self._cost(flow, size)
+                if best is None or tag < best_tag:
+                    best_key, best, best_tag = key, flow, tag
+            if best is None:
+                return
+            _, _, size, granted = heapq.heappop(best['queue'])
+            if not best['queue']:
+                del self.backlogged[best_key]
+            self._start(best, size)
+            granted.set()
+    
+    def acquire(self, key: str, size: int) -> float:
+        """
+        Wait for a scan slot
+        
+        Args:
+            key: Flow of the scan (client address or service)
+            size: Body size in bytes
+        
+        Returns:
+            Seconds spent waiting
+        """
+        start = time.monotonic()
+        with self._lock:
+            flow = self._flow(key, start)
+            if not flow['queue']:
+                # A flow that was idle starts at the current virtual time
+                # instead of using up credit it did not claim
+                flow['finish'] = max(flow['finish'], self.virtual_time)
+            if self.active < self.slots and not self.backlogged:
+                self._start(flow, size)
+                granted = None
+            else:
+                granted = threading.Event()
+                deadline = start + self.DEADLINE_FACTOR * self._expected(size)
+                heapq.heappush(flow['queue'], (deadline, next(self._sequence), size, granted))
+                self.backlogged[key] = flow
+        if granted is not None:
+            granted.wait()
+        waited = time.monotonic() - start
+        with self._lock:
+            flow['waits']['small' if size < self.SMALL_BODY else 'large'].append(waited)
+            if granted is not None:
+                flow['waited'] += 1
+                flow['wait_max'] = max(flow['wait_max'], waited)
+        return waited
+    
+    def release(self, key: str, size: int, seconds: float, ok: bool = True):
+        """
+        Return a scan slot and dispatch the next scan
+        
+        Args:
+            key: Flow of the scan
+            size: Body size in bytes
+            seconds: Time the scan took
+            ok: False if clamd failed to answer (not learned from)
+        """
+        with self._lock:
+            rate = self.LEARNING_RATE
+            if ok and size < self.SMALL_SCAN:
+                self.request_seconds += rate * (seconds - self.request_seconds)
+            elif ok:
+                per_byte = max(0.0, seconds - self.request_seconds) / size
+                self.byte_seconds += rate * (per_byte - self.byte_seconds)
+            if self.limiter is not None:
+                self.slots = self.limiter.update(seconds, size, self.active, ok)
+            flow = self.flows[key]
+            flow['active'] -= 1
+            self.active -= 1
+            self._dispatch()
+            if not flow['active'] and not flow['queue']:
+                self.idle[key] = time.monotonic()
+    
+    def stats(self) -> Dict[str, int]:
+        """Slot usage and waiting scans"""
+        with self._lock:
+            stats = {'slots': self.slots, 'active': self.active,
+                     'queued': sum(len(flow['queue']) for flow in self.backlogged.values()),
+                     'flows': len(self.flows), 'request_ms': round(self.request_seconds * 1000, 2),
+                     'mb_per_s': round(1 / self.byte_seconds / 1024 ** 2, 1) if self.byte_seconds else 0}
+            if self.limiter is not None:
+                stats.update(self.limiter.stats())
+            return stats
+    
+    def flow_stats(self, limit: int = 8) -> List[Tuple[str, Dict[str, float]]]:
+        """
+        Queue metrics of the busiest flows
+        
+        Args:
+            limit: Maximum number of flows
+        
+        Returns:
+            (flow, metrics) pairs, most dispatched scans first; wait
+            percentiles (ms) cover the most recent scans per size class
+        """
+        def p99(samples) -> float:
+            ordered = sorted(samples)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000 if ordered else 0.0
+        
+        with self._lock:
+            busiest = sorted(self.flows.items(), key=lambda item: -item[1]['dispatched'])[:limit]
+            return [(key, {'weight': flow['weight'], 'queued': len(flow['queue']),
+                           'active': flow['active'], 'dispatched': flow['dispatched'],
+                           'waited': flow['waited'], 'wait_max_ms': flow['wait_max'] * 1000,
+                           'small_wait_p99_ms': p99(flow['waits']['small']),
+                           'large_wait_p99_ms': p99(flow['waits']['large'])})
+                    for key, flow in busiest]
+
+
+def parse_weights(values: List[str]) -> Dict[str, float]:
+    """Parse KEY=WEIGHT flow weights"""
+    weights = {}
+    for value in values:
+        key, separator, weight = value.rpartition('=')
+        if not separator or not key or float(weight) <= 0:
+            raise ValueError(f"Invalid weight '{value}', expected KEY=WEIGHT with WEIGHT > 0")
+        weights[key] = float(weight)
+    return weights
+
+
+class ServiceConfig:
+    """
+    One ICAP service path and the pipeline serving it
+    
+    Pipelines:
+        clamd: known-hash index (if loaded), then a clamd scan on one of
+            the service's clamd backends (round-robin)
+        hash-only: known-hash index only; unknown bodies are allowed
+        echo: no scan, every body is allowed (answered from the preview
+            when there is one)
+    
+    Each service limits its concurrent scan requests; a request that does
+    not get a slot within queue_timeout seconds is answered with 503.
+    """
+    
+    PIPELINES = ('clamd', 'hash-only', 'echo')
+    
+    def __init__(self, name: str, pipeline: str = 'clamd',
+                 clamd: Optional[List[Tuple[str, int]]] = None, max_connections: int = 100,
+                 queue_timeout: float = 1.0, preview: Optional[int] = None,
+                 methods: Tuple[str, ...] = ('REQMOD', 'RESPMOD'), description: Optional[str] = None,
+                 trickle: Optional[int] = None):
+        """
+        Args:
+            name: Service path (e.g. 'avscan')
+            pipeline: 'clamd', 'hash-only' or 'echo'
+            clamd: (host, port) of the clamd backends for the clamd pipeline
+            max_connections: Concurrent scan requests, advertised in OPTIONS
+            queue_timeout: Seconds to wait for a free slot before answering 503
+            preview: Preview size advertised in OPTIONS (default: server-wide)
+            methods: Allowed ICAP methods besides OPTIONS
+            description: Service header of the OPTIONS response
+            trickle: Tail window in bytes for streamed RESPMOD responses
+                (0 = off, default: server-wide; see TrickleStream)
+        """
+        if pipeline not in self.PIPELINES:
+            raise ValueError(f"Unknown pipeline for service '{name}': {pipeline}")
+        unknown = set(methods) - {'REQMOD', 'RESPMOD'}
+        if unknown:
+            raise ValueError(f"Unknown method(s) for service '{name}': {', '.join(sorted(unknown))}")
+        if pipeline == 'clamd' and not clamd:
+            raise ValueError(f"Service '{name}' needs at least one clamd backend")
+        self.name = name
+        self.pipeline = pipeline
+        self.backends = [ClamAVClient(host, port) for host, port in clamd or []]
+        self.max_connections = max_connections
+        self.queue_timeout = queue_timeout
+        self.preview = preview
+        self.methods = tuple(methods)
+        self.trickle = trickle
+        self.description = description or {
+            'clamd': 'Python ICAP Server with ClamAV',
+            'hash-only': 'Python ICAP Server known-hash check',
+            'echo': 'Python ICAP Server echo (no scan)',
+        }[pipeline]
+        self.options_header = (
+            f"Methods: {', '.join(self.methods)}\r\n"
+            f"Service: {self.description}\r\n"
+            f"Max-Connections: {max_connections}\r\n"
+        ).encode('ascii')
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.counters = {'requests': 0, 'rejected': 0, 'in_flight': 0, 'streamed': 0, 'aborted': 0}
+        self._next_backend = itertools.count()
+        self._lock = threading.Lock()
+    
+    def next_backend(self) -> ClamAVClient:
+        """clamd backend for the next scan (round-robin)"""
+        return self.backends[next(self._next_backend) % len(self.backends)]
+    
+    def acquire(self) -> bool:
+        """Take a request slot, waiting up to queue_timeout"""
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.counters['rejected'] += 1
+            return False
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['in_flight'] += 1
+        return True
+    
+    def release(self):
+        """Return a request slot"""
+        with self._lock:
+            self.counters['in_flight'] -= 1
+        self.slots.release()
+    
+    def count(self, name: str):
+        """Increment an event counter"""
+        with self._lock:
+            self.counters[name] += 1
+    
+    def stats(self) -> Dict[str, int]:
+        """Request counters of the service"""
+        with self._lock:
+            return dict(self.counters, limit=self.max_connections)
+
+
+def parse_backend(value: str, default_port: int = 3310) -> Tuple[str, int]:
+    """Parse a clamd backend given as 'host' or 'host:port'"""
+    host, _, port = value.rpartition(':') if ':' in value else (value, '', '')
+    return host, int(port) if port else default_port
+
+
+def default_services(clamd: Tuple[str, int]) -> Dict[str, ServiceConfig]:
+    """
+    Services used without a services file
+    
+    'avscan' scans with clamd, 'echo' scans nothing, and any other path is
+    served like 'avscan' for compatibility with existing proxy setups.
+    """
+    avscan = ServiceConfig('avscan', 'clamd', [clamd])
+    return {'avscan': avscan, 'echo': ServiceConfig('echo', 'echo'), '*': avscan}
+
+
+def load_services(path: str, clamd: Tuple[str, int], hash_index: bool) -> Dict[str, ServiceConfig]:
+    """
+    Read the service registry from a JSON file
+    
+    The file maps service paths to settings (ServiceConfig arguments, with
+    'clamd' as a list of 'host:port' strings defaulting to --clamd-host)
+    or to the name of another service as an alias. '*' serves unknown
+    paths; without it they are answered with 404::
+    
+        {
+          "avscan": {"pipeline": "clamd", "max_connections": 64},
+          "bulk": {"clamd": ["clamav-bulk:3310"], "max_connections": 8},
+          "hashcheck": {"pipeline": "hash-only"},
+          "downloads": {"trickle": "1M"},
+          "echo": {"pipeline": "echo"},
+          "*": "avscan"
+        }
+    
+    Args:
+        path: Services file
+        clamd: Default clamd backend
+        hash_index: Whether a hash index is loaded (required by hash-only)
+    
+    Returns:
+        Service configurations by path
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not data:
+        raise ValueError(f"{path}: expected an object mapping service paths to settings")
+    services = {}
+    for name, settings in data.items():
+        if isinstance(settings, str):
+            continue
+        settings = dict(settings)
+        pipeline = settings.get('pipeline', 'clamd')
+        if pipeline == 'hash-only' and not hash_index:
+            raise ValueError(f"Service '{name}' uses hash-only but no --hash-index is loaded")
+        backends = settings.pop('clamd', None)
+        if pipeline == 'clamd':
+            settings['clamd'] = [parse_backend(backend) for backend in backends] if backends else [clamd]
+        if 'methods' in settings:
+            settings['methods'] = tuple(settings['methods'])
+        if isinstance(settings.get('trickle'), str):
+            settings['trickle'] = parse_size(settings['trickle'])
+        try:
+            services[name] = ServiceConfig(name, **settings)
+        except TypeError as e:
+            raise ValueError(f"Service '{name}': {e}") from None
+    for name, target in data.items():
+        if isinstance(target, str):
+            if target not in services:
+                raise ValueError(f"Alias '{name}' points to unknown service '{target}'")
+            services[name] = services[target]
+    return services
+
+
+def service_name(uri: str) -> str:
+    """Service path of an ICAP URI (icap://host:port/avscan?mode=x -> 'avscan')"""
+    path = urlsplit(uri).path if '://' in uri else uri
+    return path.strip('/')
+
+
+class _DiscardBody:
+    """Body sink for requests that are rejected before buffering"""
+    
+    def write(self, data: bytes):
+        pass
+
+
+class CaptureWriter:
+    """
+    Sampled incoming requests recorded to a capture file for replay
+    
+    One JSON object per line (gzip-compressed if the path ends in .gz):
+    arrival time, client, method, service, ICAP headers, the raw
+    encapsulated HTTP headers, body size and SHA-256, the body itself
+    (base64) if bodies are captured and it is small enough, and the
+    response status. Streamed RESPMOD responses (see TrickleStream) are
+    recorded when they end, with 'stream' telling whether the body was
+    streamed completely or aborted. `icap_test.py --replay` plays such a file back.
+    Capture files contain HTTP headers (cookies, URLs) and possibly
+    bodies, so they must be handled like the traffic itself. Records are
+    flushed every second, so a killed server loses at most the last one.
+    """
+    
+    # Seconds between flushes of the capture file
+    FLUSH_INTERVAL = 1.0
+    
+    def __init__(self, path: str, rate: float = 1.0, max_body: int = 0):
+        """
+        Args:
+            path: Capture file, appended to
+            rate: Fraction of requests recorded
+            max_body: Largest body stored in the capture (0 = hash and size only)
+        """
+        self.path = path
+        self.rate = rate
+        self.max_body = max_body
+        self.file = gzip.open(path, 'at', encoding='utf-8') if path.endswith('.gz') else \
+            open(path, 'a', encoding='utf-8')
+        self.records = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+    
+    def sample(self) -> bool:
+        """Whether to record the next request"""
+        return self.rate >= 1.0 or random.random() < self.rate
+    
+    def body_fields(self, body: 'BodyBuffer') -> Dict[str, any]:
+        """Size, hash and (if stored and small enough) the data of a received body"""
+        fields = {'size': body.received, 'sha256': body.sha256.hexdigest()}
+        if (self.max_body and body.store and not body.oversized
+                and body.received <= self.max_body):
+            fields['body'] = base64.b64encode(b''.join(body.iter_chunks())).decode('ascii')
+        return fields
+    
+    def write(self, record: Dict[str, any]):
+        """Append one request record"""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self.file.write(line)
+            self.records += 1
+            self._dirty = True
+    
+    def _flush_periodically(self):
+        while not self._stop.wait(self.FLUSH_INTERVAL):
+            with self._lock:
+                if self._dirty:
+                    self.file.flush()
+                    self._dirty = False
+    
+    def close(self):
+        """Flush and close the capture file"""
+        self._stop.set()
+        with self._lock:
+            self.file.close()
+
+
+class HealthMonitor:
+    """
+    Cached liveness and readiness state of the server
+    
+    Each clamd backend is marked up or down by the outcome of real scans
+    and, when no scan confirmed it recently, by a PING from a background
+    thread. After `failure_threshold` consecutive failures a backend is
+    treated as open circuit until it answers again. Readiness requires
+    every clamd service to have a backend that is up and every scan
+    queue to be below `max_queue`; probes only read this state, they
+    never contact clamd themselves.
+    """
+    
+    def __init__(self, services: Dict[str, 'ServiceConfig'], schedulers: Dict[Tuple[str, int], 'ScanScheduler'],
+                 interval: float = 5.0, failure_threshold: int = 3, max_queue: int = 50):
+        """
+        Args:
+            services: Service registry, for the clamd backends to watch
+            schedulers: Scan schedulers by clamd (host, port)
+            interval: Seconds between PINGs of backends without a recent scan
+            failure_threshold: Consecutive failures that mark a backend down
+            max_queue: Waiting scans per clamd above which the server is not ready
+        """
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.max_queue = max_queue
+        self.schedulers = schedulers
+        self.started = time.monotonic()
+        self.backends = {}
+        self.required = []
+        for service in services.values():
+            if service.pipeline != 'clamd':
+                continue
+            addresses = [(backend.host, backend.port) for backend in service.backends]
+            for backend in service.backends:
+                self.backends.setdefault((backend.host, backend.port), {
+                    'client': backend, 'up': False, 'failures': 0,
+                    'last_ok': None, 'last_check': None})
+            if addresses not in self.required:
+                self.required.append(addresses)
+        self.ready = not self.required
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+    
+    def observe(self, host: str, port: int, ok: bool):
+        """
+        Record the outcome of a scan or PING
+        
+        Args:
+            host: clamd host
+            port: clamd port
+            ok: True if clamd answered
+        """
+        state = self.backends.get((host, port))
+        if state is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            was_up = state['up']
+            first_check = state['last_check'] is None
+            state['last_check'] = now
+            if ok:
+                state['failures'] = 0
+                state['last_ok'] = now
+                state['up'] = True
+            else:
+                state['failures'] += 1
+                if state['failures'] >= self.failure_threshold or state['last_ok'] is None:
+                    state['up'] = False
+            changed = was_up != state['up']
+        if first_check and not ok:
+            logger.error(f"✗ ClamAV {host}:{port} not reachable yet - not ready until it answers")
+        if changed:
+            if ok:
+                logger.info(f"✓ ClamAV {host}:{port} is up")
+            else:
+                logger.error(f"✗ ClamAV {host}:{port} is down after {state['failures']} failure(s)")
+            self._update()
+    
+    def _update(self):
+        """Recompute readiness from the backend states"""
+        with self._lock:
+            ready = all(any(self.backends[address]['up'] for address in addresses)
+                        for addresses in self.required)
+            became_ready = ready and not self.ready
+            self.ready = ready
+        if became_ready:
+            for callback in self._callbacks:
+                threading.Thread(target=callback, daemon=True).start()
+    
+    def on_ready(self, callback):
+        """Run `callback` in a thread whenever the backends become ready"""
+        self._callbacks.append(callback)
+    
+    def check(self):
+        """PING every backend without a successful check within the interval"""
+        now = time.monotonic()
+        for (host, port), state in self.backends.items():
+            last_ok = state['last_ok']
+            if state['up'] and last_ok is not None and now - last_ok < self.interval:
+                continue
+            self.observe(host, port, state['client'].ping())
+    
+    def start(self):
+        """Check backends now and then periodically in a background thread"""
+        def run():
+            self.check()
+            while not self._stop.wait(self.interval):
+                self.check()
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def stop(self):
+        """Stop the background checks"""
+        self._stop.set()
+    
+    def status(self) -> Tuple[bool, Dict[str, any]]:
+        """
+        Readiness and the checks behind it, from cached state only
+        
+        Returns:
+            Tuple of (is_ready, details)
+        """
+        now = time.monotonic()
+        checks = {}
+        with self._lock:
+            ready = self.ready
+            for (host, port), state in self.backends.items():
+                checks[f"clamd {host}:{port}"] = {
+                    'ok': state['up'], 'failures': state['failures'],
+                    'circuit': 'open' if state['failures'] >= self.failure_threshold else 'closed',
+                    'last_ok_s': round(now - state['last_ok'], 1) if state['last_ok'] is not None else None}
+        for (host, port), scheduler in self.schedulers.items():
+            queued = scheduler.stats()['queued']
+            ok = queued < self.max_queue
+            checks[f"queue {host}:{port}"] = {'ok': ok, 'queued': queued, 'limit': self.max_queue}
+            ready = ready and ok
+        return ready, {'status': 'ready' if ready else 'not ready',
+                       'uptime_s': round(now - self.started, 1), 'checks': checks}
+
+
+class HealthRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Liveness (/live) and readiness (/ready) probes over HTTP"""
+    
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path in ('/live', '/healthz'):
+            code, details = 200, {'status': 'live',
+                                  'uptime_s': round(time.monotonic() - self.server.monitor.started, 1)}
+        elif path in ('/ready', '/readyz'):
+            ready, details = self.server.monitor.status()
+            code = 200 if ready else 503
+        else:
+            code, details = 404, {'status': 'not found'}
+        body = json.dumps(details).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Health probe: {format % args}")
+
+
+class HealthServer(http.server.ThreadingHTTPServer):
+    """Small HTTP server answering health probes from a HealthMonitor"""
+    daemon_threads = True
+    
+    def __init__(self, server_address, monitor: HealthMonitor):
+        """
+        Args:
+            server_address: (host, port) to listen on
+            monitor: Source of the cached health state
+        """
+        self.monitor = monitor
+        super().__init__(server_address, HealthRequestHandler)
+
+
+class SlowClientError(socket.timeout):
+    """A client missed the read deadline of a request phase or the minimum body rate"""
+    
+    def __init__(self, reason: str):
+        super().__init__(f"{reason} deadline exceeded" if reason != 'rate' else "body rate too low")
+        self.reason = reason
+
+
+class ReadDeadlines:
+    """
+    Read deadlines per request phase, and counters of the clients cut off
+    
+    Phases and what their deadline covers:
+        idle: keep-alive connection waiting for the next request
+        request_line: a new connection until its request line is in, and
+            any request from its first byte to the end of the request line
+        headers: the first byte of a request to the end of the ICAP and
+            encapsulated HTTP headers
+        body: the whole encapsulated body, including the rest after a preview
+            (less the time a 100 Continue is held behind pipelined responses)
+    
+    Below min_rate bytes per second (averaged over the body so far, once
+    RATE_GRACE seconds have passed) the body phase ends as 'rate'. A
+    timeout of 0 disables a phase's deadline.
+    """
+    
+    REASONS = ('idle', 'request_line', 'headers', 'body', 'rate')
+    
+    # Seconds of body transfer before the minimum rate applies
+    RATE_GRACE = 10.0
+    
+    def __init__(self, idle: float = 60.0, request_line: float = 10.0, headers: float = 20.0,
+                 body: float = 600.0, min_rate: int = 1024):
+        """
+        Args:
+            idle: Seconds a keep-alive connection may wait for its next request
+            request_line: Seconds for the request line
+            headers: Seconds for all headers of a request
+            body: Seconds for the whole body
+            min_rate: Lowest average body rate in bytes per second (0 = none)
+        """
+        self.timeouts = {'idle': idle, 'request_line': request_line, 'headers': headers, 'body': body}
+        self.min_rate = min_rate
+        self.counters = dict.fromkeys(self.REASONS, 0)
+        self._lock = threading.Lock()
+    
+    def expired(self, reason: str) -> SlowClientError:
+        """Count a connection cut off for reason and return the error to raise"""
+        with self._lock:
+            self.counters[reason] += 1
+        return SlowClientError(reason)
+    
+    def stats(self) -> Dict[str, int]:
+        """Connections closed per reason"""
+        with self._lock:
+            return dict(self.counters)
+
+
+class GuardedReader(io.RawIOBase):
+    """
+    Socket reader enforcing the ReadDeadlines of the current request phase
+    
+    Each recv gets the time left in the phase as socket timeout, so the
+    deadline holds no matter how the client spreads its bytes. Outside a
+    phase (scanning, responding) the socket blocks as before. A caller
+    that set the socket to non-blocking (timeout 0) gets a non-blocking
+    read, so BufferedReader.peek() can test for pending data.
+    """
+    
+    def __init__(self, sock: socket.socket, deadlines: ReadDeadlines):
+        """
+        Args:
+            sock: Connection to read from
+            deadlines: Shared deadlines and counters
+        """
+        self.sock = sock
+        self.deadlines = deadlines
+        self.phase = None
+        self.started = 0.0
+        self.deadline = None
+        self.received = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def begin(self, phase: str):
+        """
+        Start a phase now; 'headers' right after 'request_line' keeps the
+        request's start, so the headers deadline covers the whole head
+        """
+        now = time.monotonic()
+        if not (phase == 'headers' and self.phase == 'request_line'):
+            self.started = now
+        self.phase = phase
+        timeout = self.deadlines.timeouts[phase]
+        self.deadline = self.started + timeout if timeout > 0 else None
+        self.received = 0
+    
+    def pause(self, seconds: float):
+        """Leave time the client could not send in out of the current phase"""
+        self.started += seconds
+        if self.deadline is not None:
+            self.deadline += seconds
+    
+    def end(self):
+        """Leave the current phase; reads block without a deadline again"""
+        self.phase = None
+        self.sock.settimeout(None)
+    
+    def remaining(self, now: float) -> Tuple[Optional[float], str]:
+        """Seconds left in the phase (None for no limit) and the reason when they run out"""
+        remaining, reason = None, self.phase
+        if self.deadline is not None:
+            remaining = self.deadline - now
+        min_rate = self.deadlines.min_rate
+        if self.phase == 'body' and min_rate > 0:
+            # The rate is missed once too few bytes arrived for the time elapsed
+            due = self.started + max(self.deadlines.RATE_GRACE, self.received / min_rate)
+            if remaining is None or due - now < remaining:
+                remaining, reason = due - now, 'rate'
+        return remaining, reason
+    
+    def readinto(self, buffer) -> Optional[int]:
+        if self.sock.gettimeout() == 0.0:
+            try:
+                return self.sock.recv_into(buffer)
+            except BlockingIOError:
+                return None
+        remaining, reason = None, None
+        if self.phase is not None:
+            remaining, reason = self.remaining(time.monotonic())
+            if remaining is not None and remaining <= 0:
+                raise self.deadlines.expired(reason)
+        self.sock.settimeout(remaining)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            sock.connect((self.host, self.port))
-            sock.sendall(b'zPING\0')
-            response = sock.recv(1024)
-            sock.close()
-            return b'PONG' in response
-        except Exception as e:
-            logger.error(f"ClamAV ping failed: {e}")
-            return False
+            received = self.sock.recv_into(buffer)
+        except socket.timeout:
+            raise self.deadlines.expired(reason) from None
+        if self.phase == 'idle' and received:
+            self.begin('request_line')
+        self.received += received
+        return received
+
+
+class ResponseSequencer:
+    """
+    Writes the responses of pipelined requests in request order
+    
+    Every request on a pipelining connection reserves a slot. A slot at
+    the head writes straight to the connection; later slots buffer until
+    all earlier responses are complete, so a scan that finishes early
+    never overtakes an earlier one.
+    """
+    
+    def __init__(self, wfile):
+        """
+        Args:
+            wfile: Connection writer
+        """
+        self.wfile = wfile
+        self.slots = deque()
+        self.broken = False
+        self._condition = threading.Condition()
+    
+    def reserve(self) -> 'ResponseSlot':
+        """Slot for the next request's response"""
+        slot = ResponseSlot(self)
+        with self._condition:
+            self.slots.append(slot)
+        return slot
+    
+    def at_head(self, slot: 'ResponseSlot') -> bool:
+        """True if all responses before the slot's are written"""
+        with self._condition:
+            return bool(self.slots) and self.slots[0] is slot
+    
+    def wait_head(self, slot: 'ResponseSlot'):
+        """Wait until all responses before the slot's are written"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.broken or self.slots[0] is slot)
+    
+    def _write(self, slot: 'ResponseSlot', data: bytes):
+        with self._condition:
+            if self.broken:
+                raise ConnectionResetError("Connection lost while responses were pending")
+            if self.slots[0] is slot:
+                self.wfile.write(data)
+            else:
+                slot.pending.append(data)
+    
+    def _complete(self, slot: 'ResponseSlot'):
+        with self._condition:
+            slot.done = True
+            try:
+                # Flush the following slots that became the head
+                while self.slots and self.slots[0].done:
+                    self.slots.popleft()
+                    if self.slots:
+                        head = self.slots[0]
+                        if head.pending:
+                            self.wfile.write(b''.join(head.pending))
+                            head.pending.clear()
+            except OSError:
+                # Nobody can receive the remaining responses
+                self.broken = True
+                self.slots.clear()
+            finally:
+                self._condition.notify_all()
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every reserved response is written"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.slots, timeout)
+
+
+class ResponseSlot:
+    """Writer for one response of a ResponseSequencer"""
+    
+    def __init__(self, sequencer: ResponseSequencer):
+        self.sequencer = sequencer
+        self.pending = []
+        self.done = False
+    
+    def write(self, data: bytes):
+        """Write, or buffer while earlier responses are outstanding"""
+        self.sequencer._write(self, data)
+    
+    def close(self):
+        """Mark the response complete"""
+        if not self.done:
+            self.sequencer._complete(self)
+
+
+class TLSStats:
+    """Handshake counters and recent handshake latencies of an ICAPS listener"""
+    
+    SAMPLES = 1024
+    
+    def __init__(self):
+        self.counters = {'handshakes': 0, 'resumed': 0, 'failed': 0}
+        self.latencies = deque(maxlen=self.SAMPLES)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float, resumed: bool):
+        """Count a completed handshake"""
+        with self._lock:
+            self.counters['handshakes'] += 1
+            self.counters['resumed'] += resumed
+            self.latencies.append(seconds)
+    
+    def fail(self):
+        """Count a failed handshake"""
+        with self._lock:
+            self.counters['failed'] += 1
+    
+    def stats(self) -> Dict[str, float]:
+        """Counters, resumption ratio and handshake latency percentiles (ms)"""
+        with self._lock:
+            ordered = sorted(self.latencies)
+            counters = dict(self.counters)
+        handshakes = counters['handshakes']
+        
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2) if ordered else 0.0
+        
+        return dict(counters,
+                    resumption_pct=round(counters['resumed'] / handshakes * 100, 1) if handshakes else 0.0,
+                    p50_ms=percentile(0.5), p99_ms=percentile(0.99))
+
+
+def create_tls_context(cert: str, key: Optional[str] = None) -> ssl.SSLContext:
+    """
+    Server-side TLS context for ICAPS
+    
+    TLS 1.2 and newer. Resumption needs no configuration: OpenSSL issues
+    TLS 1.3 session tickets (and TLS 1.2 tickets and session IDs from its
+    session cache) by default.
+    
+    Args:
+        cert: PEM certificate chain
+        key: PEM private key (default: in the certificate file)
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def parse_encapsulated(value: str) -> Dict[str, int]:
+    """
+    Parse an Encapsulated header value
+    
+    Args:
+        value: Header value (e.g. 'req-hdr=0, req-body=412')
+    
+    Returns:
+        Dictionary mapping section name to byte offset
+    """
+    sections = {}
+    for entry in value.split(','):
+        if '=' in entry:
+            name, offset = entry.split('=', 1)
+            try:
+                sections[name.strip().lower()] = int(offset)
+            except ValueError:
+                logger.warning(f"Invalid Encapsulated entry: {entry.strip()}")
+    return sections
+
+
+# Date header of the current second, shared by all responses
+_date_header = (0, b'')
+
+
+def date_header() -> bytes:
+    """Return the encoded 'Date:' header line, formatted at most once per second"""
+    global _date_header
+    now = int(time.time())
+    second, header = _date_header
+    if second != now:
+        header = f"Date: {formatdate(now, usegmt=True)}\r\n".encode('ascii')
+        _date_header = (now, header)
+    return header
+
+
+_CONTROL_CHARACTERS = {code: ' ' for code in [*range(32), 127]}
+
+
+def header_value(value: str, limit: int = 256) -> bytes:
+    """
+    Encode text for use as a header value
+    
+    Control characters (CR, LF, NUL, ...) are replaced so the value cannot
+    end the header line or inject headers, non-ASCII characters become '?'
+    and the value is truncated to limit characters.
+    """
+    if not (value.isascii() and value.isprintable()):
+        value = value.translate(_CONTROL_CHARACTERS).strip()
+    return value[:limit].encode('ascii', errors='replace')
+
+
+# Request IDs accepted from clients; anything else is replaced
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,64}')
 
 
 class ICAPRequestHandler(socketserver.StreamRequestHandler):
     """Handler for ICAP requests"""
     
-    def __init__(self, *args, **kwargs):
-        self.clamav = ClamAVClient()
-        super().__init__(*args, **kwargs)
+    # Pre-encoded response parts; only Date, ISTag, verdict and trace
+    # headers are spliced in per response
+    CLEAN_STATUS = b"ICAP/1.0 204 No Modifications Needed\r\n"
+    THREAT_STATUS = b"ICAP/1.0 403 Forbidden\r\nX-Violations-Found: 1\r\n"
+    BLOCKED_STATUS = b"ICAP/1.0 403 Forbidden\r\n"
+    OPTIONS_STATUS = (
+        b"ICAP/1.0 200 OK\r\n"
+        b"Options-TTL: 3600\r\n"
+        b"Transfer-Preview: *\r\n"
+        b"Allow: 204\r\n"
+    )
+    TRICKLE_STATUS = b"ICAP/1.0 200 OK\r\n"
+    CONTINUE = b"ICAP/1.0 100 Continue\r\n\r\n"
+    NULL_BODY = b"Encapsulated: null-body=0\r\n"
+    END = b"\r\n"
+    ERROR_STATUS = {}
+    
+    def setup(self):
+        """Prepare per-connection state"""
+        super().setup()
+        # Reads go through the per-phase deadlines (see GuardedReader)
+        self.rfile.close()
+        self.reader = GuardedReader(self.connection, self.server.read_deadlines)
+        self.rfile = io.BufferedReader(self.reader)
+        self.requests = 0
+        self.service = None
+        self.close_connection = False
+        self.request_id = None
+        self.timings = []
+        self.handshake_time = None
+        # Pipelining: set up once the client sends requests ahead of responses
+        self.raw_wfile = self.wfile
+        self.sequencer = None
+        self.inflight = None
+        # Capture record of the current request, if sampled
+        self.capture_record = None
+        # Streamed RESPMOD response of the current request
+        self.trickle = None
+        self.trickle_header = b""
+        # Time the connection spent waiting for a handler thread
+        accepted_at = self.server.accept_times.pop(self.request, None)
+        self.queued = time.monotonic() - accepted_at if accepted_at is not None else 0.0
+        # Disable Nagle so small responses are not delayed
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     
     def handle(self):
-        """Handle incoming ICAP request"""
+        """Handle ICAP requests until the client closes the connection"""
+        if isinstance(self.connection, ssl.SSLSocket) and not self.tls_handshake():
+            return
         try:
-            # Read request line
-            request_line = self.rfile.readline().decode('utf-8', errors='ignore').strip()
-            logger.info(f"Request: {request_line}")
-            
+            while True:
+                if self.sequencer is not None:
+                    self.wfile = self.sequencer.reserve()
+                keep_open = self.handle_one_request()
+                if self.wfile is not self.raw_wfile:
+                    self.wfile.close()
+                if not keep_open:
+                    break
+        finally:
+            if self.sequencer is not None:
+                self.sequencer.wait()
+                self.wfile = self.raw_wfile
+    
+    def tls_handshake(self) -> bool:
+        """
+        Complete the TLS handshake of an ICAPS connection
+        
+        The listener wraps accepted sockets without handshaking, so slow
+        or failing handshakes only hold up this connection's thread.
+        
+        Returns:
+            True if the handshake succeeded
+        """
+        stats = self.server.tls_stats
+        self.connection.settimeout(self.server.handshake_timeout)
+        start = time.monotonic()
+        try:
+            self.connection.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            stats.fail()
+            logger.info(f"TLS handshake with {self.client_address[0]} failed: {e}")
+            return False
+        finally:
+            self.connection.settimeout(None)
+        self.handshake_time = time.monotonic() - start
+        stats.record(self.handshake_time, self.connection.session_reused)
+        return True
+    
+    def handle_one_request(self) -> bool:
+        """
+        Handle a single ICAP request on a persistent connection
+        
+        Returns:
+            True if the connection stays open for another request
+        """
+        try:
+            # Read request line; a new connection must start with it, an open one may
+            # idle (stray CRLF before it does not restart the deadline)
+            if self.reader.phase is None:
+                self.reader.begin('idle' if self.requests else 'request_line')
+            raw_line = self.rfile.readline()
+            if not raw_line:
+                return False
+            request_line = raw_line.decode('utf-8', errors='ignore').strip()
             if not request_line:
-                return
+                # Tolerate stray CRLF between requests
+                return True
+            received_at = time.monotonic()
+            self.requests += 1
+            self.reader.begin('headers')
+            self.request_id = None
+            self.timings = [('queue', self.queued)]
+            self.queued = 0.0
+            if self.handshake_time is not None:
+                self.timings.append(('handshake', self.handshake_time))
+                self.handshake_time = None
             
             parts = request_line.split()
             if len(parts) < 3:
                 self.send_error(400, "Bad Request")
-                return
+                return False
             
             method = parts[0]
+            headers = self.read_icap_headers()
+            self.close_connection = headers.get('connection', '').lower() == 'close'
+            request_id = headers.get('x-request-id', '')
+            self.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else uuid.uuid4().hex[:16]
+            self.received_at = received_at
+            capture = self.server.capture
+            self.capture_record = None
+            if capture is not None and capture.sample():
+                self.capture_record = {
+                    't': round(time.time() - (time.monotonic() - received_at), 6),
+                    'client': self.client_address[0], 'method': method,
+                    'service': service_name(parts[1]),
+                    'icap': {key: value for key, value in headers.items()
+                             if key not in ('host', 'x-request-id')}}
+            logger.info(f"Request: {request_line} [{self.request_id}]")
+            
+            # The body (if any) of a rejected request is not read, so the
+            # connection cannot be reused
+            if method not in ('OPTIONS', 'REQMOD', 'RESPMOD'):
+                self.send_error(405, "Method Not Allowed")
+                return False
+            services = self.server.services
+            name = service_name(parts[1])
+            self.service = services.get(name) or services.get('*')
+            if self.service is None:
+                self.send_error(404, "ICAP Service Not Found")
+                return False
             
             if method == 'OPTIONS':
-                self.handle_options()
-            elif method == 'REQMOD':
-                self.handle_reqmod()
-            elif method == 'RESPMOD':
-                self.handle_respmod()
+                self.reader.end()
+                self.handle_options(headers)
+            elif method in self.service.methods:
+                if method == 'REQMOD':
+                    self.handle_reqmod(headers)
+                else:
+                    self.handle_respmod(headers)
             else:
                 self.send_error(405, "Method Not Allowed")
+                return False
+            
+            return not self.close_connection
         
+        except SlowClientError as e:
+            if e.reason == 'idle':
+                logger.debug(f"Closing idle connection from {self.client_address[0]}")
+                return False
+            logger.warning(f"Closing slow client {self.client_address[0]}: {e}")
+            # Best effort: a client that does not read cannot hold the thread either
+            self.connection.settimeout(1.0)
+            try:
+                self.send_error(408, "Request Timeout")
+            except OSError:
+                pass
+            return False
+        except (ConnectionError, socket.timeout) as e:
+            logger.debug(f"Connection closed: {e}")
+            return False
         except Exception as e:
             logger.error(f"Error handling request: {e}", exc_info=True)
-            self.send_error(500, "Internal Server Error")
-    
-    def handle_options(self):
-        """Handle OPTIONS request"""
-        response = (
-            "ICAP/1.0 200 OK\r\n"
-            "Methods: REQMOD, RESPMOD\r\n"
-            "Service: Python ICAP Server with ClamAV\r\n"
-            "ISTag: \"python-icap-1.0\"\r\n"
-            "Encapsulated: null-body=0\r\n"
-            "Max-Connections: 100\r\n"
-            "Options-TTL: 3600\r\n"
-            "Preview: 0\r\n"
-            "\r\n"
-        )
-        self.wfile.write(response.encode('utf-8'))
-        logger.info("Sent OPTIONS response")
-    
-    def handle_reqmod(self):
-        """Handle REQMOD request (request modification)"""
-        self.handle_scan_request()
-    
-    def handle_respmod(self):
-        """Handle RESPMOD request (response modification)"""
-        self.handle_scan_request()
+            try:
+                self.send_error(500, "Internal Server Error")
+            except OSError:
+                pass
+            return False
     
-    def handle_scan_request(self):
-        """Common handler for scan requests"""
+    def read_icap_headers(self) -> Dict[str, str]:
+        """Read the ICAP header block following the request line"""
         headers = {}
-        body_data = b''
-        
-        # Read ICAP headers
         while True:
             line = self.rfile.readline().decode('utf-8', errors='ignore').strip()
             if not line:
@@ -185,96 +2383,615 @@ class ICAPRequestHandler(socketserver.StreamRequestHandler):
             if ':' in line:
                 key, value = line.split(':', 1)
                 headers[key.strip().lower()] = value.strip()
+        return headers
+    
+    def trace_headers(self) -> bytes:
+        """
+        X-Request-ID and Server-Timing header lines for the current request
+
+        Server-Timing lists the phases measured so far in milliseconds:
+        queue (connection waiting for a handler thread), handshake (TLS,
+        first request of an ICAPS connection only), receive (reading
+        headers and body), index (known-hash lookup), schedule (waiting for
+        a clamd slot) and clamd (scan). The write phase ends after the
+        headers are sent and is only logged.
+        """
+        lines = ""
+        if self.request_id:
+            lines += f"X-Request-ID: {self.request_id}\r\n"
+        if self.timings:
+            phases = ', '.join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.timings)
+            lines += f"Server-Timing: {phases}\r\n"
+        return lines.encode('ascii')
+    
+    def write_response(self, code: int, *parts: bytes):
+        """
+        Send a response assembled from encoded parts and log the request's phase timings
         
+        Args:
+            code: ICAP status code (for the log)
+            parts: Encoded status line and headers; the Date, ISTag and
+                trace headers and the final empty line are added here
+        """
+        if self.capture_record is not None and self.trickle is None:
+            # A streamed response is recorded by end_trickle(), once it is over
+            self.capture_record['status'] = code
+            self.server.capture.write(self.capture_record)
+            self.capture_record = None
+        log = self.request_id and logger.isEnabledFor(logging.INFO)
+        start = time.monotonic() if log else 0.0
+        self.wfile.write(b''.join((*parts, date_header(), self.server.istag.header,
+                                   self.trace_headers(), self.END)))
+        if log:
+            phases = ' '.join(f"{name}={seconds * 1000:.2f}ms" for name, seconds
+                              in self.timings + [('write', time.monotonic() - start)])
+            logger.info(f"[{self.request_id}] {code} {phases}")
+    
+    def budget_metric(self) -> bytes:
+        """X-Body-Budget header line with body budget usage"""
+        stats = '; '.join(f"{key}={value}" for key, value in self.server.body_budget.stats().items())
+        return f"X-Body-Budget: {stats}\r\n".encode('ascii')
+    
+    def hash_index_metric(self) -> bytes:
+        """X-Hash-Index header line with index counters, if an index is loaded"""
+        index = self.server.hash_index
+        if index is None:
+            return b""
+        stats = '; '.join(f"{key}={value}" for key, value in index.stats().items())
+        return f"X-Hash-Index: {stats}\r\n".encode('ascii')
+    
+    def scheduler_metric(self) -> bytes:
+        """X-Scan-Queue/X-Scan-Flows header lines for the service's clamd backends"""
+        schedulers = self.server.schedulers
+        queues, flows = [], []
+        for backend in self.service.backends:
+            address = f"{backend.host}:{backend.port}"
+            scheduler = schedulers.get((backend.host, backend.port))
+            if scheduler is None:
+                continue
+            stats = scheduler.stats()
+            queues.append(f"{address} " + ' '.join(f"{key}={value}" for key, value in stats.items()))
+            for key, metrics in scheduler.flow_stats():
+                flows.append(f"{address}/{key} " + ' '.join(
+                    f"{name}={value:.1f}" if isinstance(value, float) else f"{name}={value}"
+                    for name, value in metrics.items()))
+        if not queues:
+            return b""
+        lines = f"X-Scan-Queue: {', '.join(queues)}\r\n"
+        if flows:
+            lines += f"X-Scan-Flows: {', '.join(flows)}\r\n"
+        return lines.encode('ascii', errors='replace')
+    
+    def verdict_cache_metric(self) -> bytes:
+        """X-Verdict-Cache header line with local and peer cache counters, if enabled"""
+        cache = self.server.verdict_cache
+        if cache is None:
+            return b""
+        stats = '; '.join(f"{key}={value}" for key, value in cache.stats().items())
+        return f"X-Verdict-Cache: {stats}\r\n".encode('ascii')
+    
+    def slow_client_metric(self) -> bytes:
+        """X-Slow-Clients header line with connections closed per missed deadline"""
+        stats = '; '.join(f"{key}={value}" for key, value in self.server.read_deadlines.stats().items())
+        return f"X-Slow-Clients: {stats}\r\n".encode('ascii')
+    
+    def tls_metric(self) -> bytes:
+        """X-TLS header line with handshake counters, on ICAPS listeners"""
+        stats = self.server.tls_stats
+        if stats is None:
+            return b""
+        values = '; '.join(f"{key}={value}" for key, value in stats.stats().items())
+        return f"X-TLS: {values}\r\n".encode('ascii')
+    
+    def handle_options(self, headers: Dict[str, str]):
+        """Handle OPTIONS request"""
+        self.timings.append(('receive', time.monotonic() - self.received_at))
+        service = self.service
+        preview = service.preview if service.preview is not None else self.server.preview_size
+        load = '; '.join(f"{key}={value}" for key, value in service.stats().items())
+        self.write_response(200, self.OPTIONS_STATUS, service.options_header, self.NULL_BODY,
+                            f"Preview: {preview}\r\n"
+                            f"X-Service-Load: {load}\r\n".encode('ascii'),
+                            self.budget_metric(), self.hash_index_metric(),
+                            self.verdict_cache_metric(), self.scheduler_metric(),
+                            self.slow_client_metric(), self.tls_metric())
+        logger.info("Sent OPTIONS response")
+    
+    def handle_reqmod(self, headers: Dict[str, str]):
+        """Handle REQMOD request (request modification)"""
+        self.handle_scan_request(headers)
+    
+    def handle_respmod(self, headers: Dict[str, str]):
+        """Handle RESPMOD request (response modification)"""
+        self.handle_scan_request(headers)
+    
+    def handle_scan_request(self, headers: Dict[str, str]):
+        """Common handler for scan requests"""
         logger.debug(f"ICAP Headers: {headers}")
         
-        # Read HTTP headers (encapsulated)
+        encapsulated = parse_encapsulated(headers.get('encapsulated', ''))
+        if not encapsulated:
+            # Be lenient with clients that omit Encapsulated
+            encapsulated = {'req-hdr': 0, 'req-body': 0}
+        
+        # Read HTTP headers (encapsulated), one block per *-hdr section
         http_headers = {}
-        while True:
-            line = self.rfile.readline().decode('utf-8', errors='ignore').strip()
-            if not line:
-                break
-            if ':' in line:
-                key, value = line.split(':', 1)
-                http_headers[key.strip().lower()] = value.strip()
+        header_blocks = []
+        header_block = []
+        for _ in range(sum(1 for section in encapsulated if section.endswith('-hdr'))):
+            header_block = []
+            while True:
+                raw_line = self.rfile.readline()
+                header_block.append(raw_line)
+                line = raw_line.decode('utf-8', errors='ignore').strip()
+                if not line:
+                    break
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    http_headers[key.strip().lower()] = value.strip()
+            header_blocks.append(b''.join(header_block))
+        if self.capture_record is not None:
+            self.capture_record['http'] = b''.join(header_blocks).decode('latin-1')
+        if 'null-body' in encapsulated:
+            self.reader.end()
+        else:
+            self.reader.begin('body')
         
         logger.debug(f"HTTP Headers: {http_headers}")
         
-        # Read body (chunked encoding)
+        service = self.service
+        if not service.acquire():
+            logger.warning(f"Service '{service.name}' at its limit of {service.max_connections} requests")
+            if 'null-body' not in encapsulated:
+                # Without preview the whole body is drained; after a preview
+                # the 503 goes out before the rest is sent
+                self.read_chunked_body(_DiscardBody())
+                self.reader.end()
+            self.send_error(503, "Service Overloaded")
+            return
+        server = self.server
+        body = BodyBuffer(server.body_budget, server.request_memory, server.max_body_size,
+                          keep_head=server.oversize_policy == 'scan-head',
+                          wait=server.budget_wait if server.budget_policy == 'wait' else 0.0,
+                          spool_dir=server.spool_dir, store=service.pipeline == 'clamd')
+        window = self.trickle_window(encapsulated, http_headers)
+        if window:
+            # The last header block is the HTTP response header (res-hdr)
+            self.trickle = TrickleStream(self.wfile, body, window, server.request_memory)
+            self.trickle_header = b''.join(header_block)
+        try:
+            self.receive_body(headers, encapsulated, http_headers, body)
+            if self.capture_record is not None and self.trickle is None:
+                self.capture_record.update(self.server.capture.body_fields(body))
+            if self.trickle is None and service.pipeline == 'clamd' and self.request_pending():
+                self.scan_pipelined(body)
+                body = None
+                return
+            self.scan_body(body)
+        except Exception as e:
+            if self.trickle is None:
+                raise
+            logger.warning(f"Streamed request failed: {e}")
+            self.end_trickle(str(e))
+        finally:
+            if self.trickle is not None:
+                self.end_trickle("no verdict")
+            if body is not None:
+                body.close()
+                service.release()
+    
+    def trickle_window(self, encapsulated: Dict[str, int], http_headers: Dict[str, str]) -> int:
+        """
+        Tail window for streaming this request's response, 0 to answer it as a whole
+        
+        Only RESPMOD bodies are streamed, and not by the echo pipeline or
+        when the Content-Length already exceeds --max-body-size (those are
+        answered from the preview or blocked). Neither are responses queued
+        behind earlier pipelined ones: the sequencer would hold the whole
+        streamed body in memory until they are written.
+        """
+        service = self.service
+        window = service.trickle if service.trickle is not None else self.server.trickle_window
+        if (not window or service.pipeline == 'echo'
+                or 'res-hdr' not in encapsulated or 'res-body' not in encapsulated):
+            return 0
+        if self.wfile is not self.raw_wfile and not self.sequencer.at_head(self.wfile):
+            return 0
+        max_size = self.server.max_body_size
+        length = http_headers.get('content-length', '')
+        if (max_size and self.server.oversize_policy != 'scan-head' and length.isdigit()
+                and int(length) > max_size):
+            return 0
+        return window
+    
+    def begin_trickle(self):
+        """Send the 200 response head and start streaming the body back"""
+        header = self.trickle_header
+        self.write_response(200, self.TRICKLE_STATUS,
+                            f"Encapsulated: res-hdr=0, res-body={len(header)}\r\n".encode('ascii'))
+        self.wfile.write(header)
+        self.trickle.start()
+    
+    def end_trickle(self, reason: Optional[str] = None):
+        """
+        Complete the streamed response, or abort it
+        
+        An aborted response lacks its final chunk and the connection is
+        closed, so the client discards the partial object.
+        
+        Args:
+            reason: Why the response is aborted, None if the body is clean
+        """
+        stream, self.trickle = self.trickle, None
+        complete = reason is None and stream.finish()
+        if complete:
+            outcome = f"streamed {stream.sent} bytes"
+            self.service.count('streamed')
+        else:
+            stream.abort()
+            self.close_connection = True
+            self.service.count('aborted')
+            outcome = f"aborted after {stream.sent} of {stream.received} bytes"
+            logger.warning(f"Streamed response {outcome}: {reason or 'client gone'}")
+        if self.capture_record is not None:
+            self.capture_record.update(self.server.capture.body_fields(stream.body), status=200,
+                                       stream='streamed' if complete else 'aborted')
+            self.server.capture.write(self.capture_record)
+            self.capture_record = None
+        if self.request_id and logger.isEnabledFor(logging.INFO):
+            phases = ' '.join(f"{name}={seconds * 1000:.2f}ms" for name, seconds
+                              in self.timings + [('stream', time.monotonic() - self.received_at)])
+            logger.info(f"[{self.request_id}] 200 {outcome} {phases}")
+    
+    def request_pending(self) -> bool:
+        """
+        Whether the client has already sent (part of) its next request
+        
+        Only then is the scan handed to another thread, so clients that
+        wait for each response keep the plain sequential path.
+        """
+        if self.server.pipeline_depth <= 1:
+            return False
+        sock = self.connection
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+    
+    def scan_pipelined(self, body: 'BodyBuffer'):
+        """
+        Scan a received body in a new thread while the next request is read
+        
+        The thread works on a copy of the handler holding this request's
+        state and response slot; at most --pipeline-depth scans per
+        connection run at once, beyond that reading the next request waits.
+        """
+        if self.sequencer is None:
+            self.sequencer = ResponseSequencer(self.wfile)
+            self.wfile = self.sequencer.reserve()
+            self.inflight = threading.Semaphore(self.server.pipeline_depth)
+        self.inflight.acquire()
+        worker = copy.copy(self)
+        self.wfile = self.raw_wfile
+        threading.Thread(target=worker.finish_pipelined, args=(body,), daemon=True).start()
+    
+    def finish_pipelined(self, body: 'BodyBuffer'):
+        """Scan and respond for a pipelined request (runs in its own thread)"""
+        try:
+            self.scan_body(body)
+        except (ConnectionError, socket.timeout) as e:
+            logger.debug(f"Connection closed: {e}")
+        except Exception as e:
+            logger.error(f"Error handling request: {e}", exc_info=True)
+            try:
+                self.send_error(500, "Internal Server Error")
+            except OSError:
+                pass
+        finally:
+            body.close()
+            self.service.release()
+            self.wfile.close()
+            self.inflight.release()
+    
+    def receive_body(self, headers: Dict[str, str], encapsulated: Dict[str, int],
+                     http_headers: Dict[str, str], body: 'BodyBuffer'):
+        """Read the encapsulated body into the buffer"""
+        max_size = self.server.max_body_size
+        policy = self.server.oversize_policy
+        if 'null-body' not in encapsulated:
+            # A streamed response starts right away, or once the preview is in
+            sink = body if self.trickle is None else self.trickle
+            if self.trickle is not None and 'preview' not in headers:
+                self.begin_trickle()
+            ieof = self.read_chunked_body(sink)
+            
+            # Preview without ieof: ask the client for the rest of the body
+            if 'preview' in headers and not ieof:
+                length = http_headers.get('content-length', '')
+                if self.service.pipeline == 'echo':
+                    # Nothing to scan: answer from the preview
+                    pass
+                elif (max_size and policy != 'scan-head' and length.isdigit()
+                        and int(length) > max_size):
+                    # Answer oversized bodies from the preview, before they are sent
+                    body.oversized = True
+                    self.server.body_budget.count('oversized')
+                else:
+                    self.wfile.write(self.CONTINUE)
+                    if self.wfile is not self.raw_wfile:
+                        # The client cannot send the rest before the 100 Continue
+                        # is out, which waits for the earlier pipelined responses
+                        held = time.monotonic()
+                        self.sequencer.wait_head(self.wfile)
+                        self.reader.pause(time.monotonic() - held)
+                    if self.trickle is not None:
+                        self.begin_trickle()
+                    self.read_chunked_body(sink)
+            elif 'preview' in headers and self.trickle is not None:
+                self.begin_trickle()
+            self.reader.end()
+        
+        self.timings.append(('receive', time.monotonic() - self.received_at))
+        logger.info(f"Received {body.received} bytes to scan"
+                    f"{' (spooled to disk)' if body.spool is not None else ''}")
+    
+    def scan_body(self, body: 'BodyBuffer'):
+        """Scan a received body with the service's pipeline and respond"""
+        max_size = self.server.max_body_size
+        policy = self.server.oversize_policy
+        pipeline = self.service.pipeline
+        if pipeline == 'echo':
+            self.send_clean_response()
+            return
+        
+        if body.oversized and policy != 'scan-head':
+            logger.warning(f"Body exceeds {max_size} bytes, oversize policy '{policy}'")
+            if policy == 'allow':
+                self.send_clean_response()
+            else:
+                self.send_blocked_response(f"Body exceeds {max_size} bytes")
+            return
+        
+        # Known hashes are answered without clamd
+        index = self.server.hash_index
+        if index is not None and not body.oversized:
+            lookup_start = time.monotonic()
+            digest = body.sha256.digest()
+            verdict = index.lookup(digest)
+            self.timings.append(('index', time.monotonic() - lookup_start))
+            if verdict == 'allow':
+                logger.info(f"Known clean hash {digest.hex()}")
+                self.send_clean_response()
+                return
+            if verdict == 'deny':
+                logger.warning(f"KNOWN BAD HASH: {digest.hex()}")
+                self.send_threat_response(f"KnownBadHash.{digest.hex()[:16]}")
+                return
+        if pipeline == 'hash-only':
+            self.send_clean_response()
+            return
+        
+        # Content already scanned here or by a peer under the same signatures
+        cache = self.server.verdict_cache
+        if cache is not None and not body.oversized:
+            lookup_start = time.monotonic()
+            verdict, source = cache.lookup(body.sha256.digest())
+            self.timings.append(('cache', time.monotonic() - lookup_start))
+            if verdict is not None:
+                is_infected, result = verdict
+                if is_infected:
+                    logger.warning(f"THREAT DETECTED ({source} cache): {result}")
+                    self.send_threat_response(result)
+                else:
+                    logger.info(f"File clean ({source} cache)")
+                    self.send_clean_response()
+                return
+        
+        # Scan with ClamAV, once the backend's scheduler grants a slot
+        backend = self.service.next_backend()
+        scheduler = self.server.schedulers.get((backend.host, backend.port))
+        if scheduler is not None:
+            flow = self.client_address[0] if self.server.fair_key == 'client' else self.service.name
+            self.timings.append(('schedule', scheduler.acquire(flow, body.size)))
+        scan_start = time.monotonic()
+        ok = False
+        try:
+            is_infected, result = backend.scan_stream(body.iter_chunks())
+            ok = not result.startswith('Error')
+        finally:
+            scan_time = time.monotonic() - scan_start
+            if scheduler is not None:
+                scheduler.release(flow, body.size, scan_time, ok)
+        self.timings.append(('clamd', scan_time))
+        if self.server.health is not None:
+            self.server.health.observe(backend.host, backend.port, ok)
+        if cache is not None and not body.oversized and (is_infected or result == 'Clean'):
+            cache.store(body.sha256.digest(), (is_infected, result))
+        
+        if is_infected:
+            logger.warning(f"THREAT DETECTED: {result}")
+            self.send_threat_response(result)
+        else:
+            logger.info(f"File clean: {result}")
+            self.send_clean_response()
+    
+    def read_chunked_body(self, body: 'BodyBuffer') -> bool:
+        """
+        Read a chunked body up to the terminating zero-length chunk
+        
+        Chunks are read in pieces of at most 64 KiB, so a client announcing
+        a huge chunk cannot make the server allocate it at once.
+        
+        Args:
+            body: Buffer receiving the data
+        
+        Returns:
+            True if the terminating chunk carried the 'ieof' extension
+            (preview holds the whole body)
+        """
         try:
             while True:
                 chunk_size_line = self.rfile.readline().decode('utf-8', errors='ignore').strip()
                 if not chunk_size_line:
                     break
                 
-                # Parse chunk size (hex)
+                # Parse chunk size (hex) and extensions
+                size_part, _, extension = chunk_size_line.partition(';')
                 try:
-                    chunk_size = int(chunk_size_line, 16)
+                    chunk_size = int(size_part.strip(), 16)
                 except ValueError:
                     logger.warning(f"Invalid chunk size: {chunk_size_line}")
                     break
                 
                 if chunk_size == 0:
-                    break
+                    # Consume the CRLF closing the chunked body
+                    self.rfile.readline()
+                    return extension.strip() == 'ieof'
                 
                 # Read chunk data
-                chunk = self.rfile.read(chunk_size)
-                body_data += chunk
+                remaining = chunk_size
+                while remaining:
+                    data = self.rfile.read(min(remaining, 65536))
+                    if not data:
+                        raise ConnectionError("Connection closed inside chunk")
+                    body.write(data)
+                    remaining -= len(data)
                 
                 # Read trailing CRLF
                 self.rfile.readline()
+        except SlowClientError:
+            raise
         except Exception as e:
             logger.warning(f"Error reading body: {e}")
-        
-        logger.info(f"Received {len(body_data)} bytes to scan")
-        
-        # Scan with ClamAV
-        is_infected, result = self.clamav.scan_bytes(body_data)
-        
-        if is_infected:
-            logger.warning(f"THREAT DETECTED: {result}")
-            self.send_threat_response(result)
-        else:
-            logger.info(f"File clean: {result}")
-            self.send_clean_response()
+        # No terminating chunk: a streamed copy must not be completed
+        if isinstance(body, TrickleStream):
+            body.fail()
+        return False
     
     def send_clean_response(self):
         """Send response for clean file"""
-        response = (
-            "ICAP/1.0 204 No Modifications Needed\r\n"
-            "ISTag: \"python-icap-1.0\"\r\n"
-            "Date: Thu, 01 Jan 2026 00:00:00 GMT\r\n"
-            "\r\n"
-        )
-        self.wfile.write(response.encode('utf-8'))
+        if self.trickle is not None:
+            self.end_trickle()
+            return
+        self.write_response(204, self.CLEAN_STATUS)
     
     def send_threat_response(self, virus_name: str):
         """Send response for infected file"""
-        response = (
-            f"ICAP/1.0 403 Forbidden\r\n"
-            f"ISTag: \"python-icap-1.0\"\r\n"
-            f"X-Violations-Found: 1\r\n"
-            f"X-Virus-ID: {virus_name}\r\n"
-            f"Encapsulated: res-hdr=0, res-body=0\r\n"
-            f"\r\n"
-        )
-        self.wfile.write(response.encode('utf-8'))
+        if self.trickle is not None:
+            self.end_trickle(f"threat {virus_name}")
+            return
+        self.write_response(403, self.THREAT_STATUS,
+                            b"X-Virus-ID: " + header_value(virus_name) + self.END, self.NULL_BODY)
+    
+    def send_blocked_response(self, reason: str):
+        """Send response for a body blocked by policy rather than by a scan"""
+        if self.trickle is not None:
+            self.end_trickle(reason)
+            return
+        self.write_response(403, self.BLOCKED_STATUS,
+                            b"X-Block-Reason: " + header_value(reason) + self.END, self.NULL_BODY)
     
     def send_error(self, code: int, message: str):
         """Send ICAP error response"""
-        response = (
-            f"ICAP/1.0 {code} {message}\r\n"
-            f"ISTag: \"python-icap-1.0\"\r\n"
-            f"Encapsulated: null-body=0\r\n"
-            f"\r\n"
-        )
-        self.wfile.write(response.encode('utf-8'))
+        status = self.ERROR_STATUS.get((code, message))
+        if status is None:
+            status = self.ERROR_STATUS[(code, message)] = f"ICAP/1.0 {code} {message}\r\n".encode('ascii')
+        self.write_response(code, status, self.NULL_BODY)
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Multi-threaded TCP server"""
     allow_reuse_address = True
     daemon_threads = True
+    request_queue_size = 128
+    
+    # Preview size advertised in OPTIONS
+    preview_size = 0
+    
+    # ClamAV daemon address
+    clamd_host = 'clamav'
+    clamd_port = 3310
+    
+    # ISTag of the current signature version
+    istag = ISTagSource()
+    
+    # Service registry by path ('*' serves unknown paths)
+    services = {}
+    
+    # Known-hash index checked before clamd (None to scan everything)
+    hash_index = None
+    
+    # Verdicts by body hash, optionally shared with peers (None to disable)
+    verdict_cache = None
+    
+    # Read deadlines per request phase, shared by all connections
+    read_deadlines = ReadDeadlines()
+    
+    # Scans of pipelined requests running at once per connection
+    pipeline_depth = 8
+    
+    # Tail window of streamed RESPMOD responses (0 = answer after the scan)
+    trickle_window = 0
+    
+    # Handshake counters (ICAPS listeners only)
+    tls_stats = None
+    
+    # Cached backend health, fed by scan results (None to skip)
+    health = None
+    
+    # Sampled request recording (None to disable)
+    capture = None
+    
+    # Scan schedulers by clamd (host, port), and what scans are grouped by
+    schedulers = {}
+    fair_key = 'client'
+    
+    # Request body memory: server-wide budget, per-request share, and what
+    # happens when either is exhausted (see BodyBuffer)
+    body_budget = ByteBudget(256 * 1024 ** 2)
+    request_memory = 32 * 1024 ** 2
+    budget_policy = 'wait'
+    budget_wait = 5.0
+    spool_dir = None
+    max_body_size = 0
+    oversize_policy = 'block'
+    
+    def __init__(self, *args, **kwargs):
+        # Accept time per connection, consumed by the handler's setup()
+        self.accept_times = {}
+        super().__init__(*args, **kwargs)
+    
+    def process_request(self, request, client_address):
+        """Remember when the connection was accepted, then start its thread"""
+        self.accept_times[request] = time.monotonic()
+        super().process_request(request, client_address)
+
+
+class ThreadedTLSServer(ThreadedTCPServer):
+    """Multi-threaded ICAPS (ICAP over TLS) server"""
+    
+    # Seconds a client gets to complete the handshake
+    handshake_timeout = 10.0
+    
+    def __init__(self, server_address, handler_class, context: ssl.SSLContext):
+        """
+        Args:
+            server_address: (host, port) to listen on
+            handler_class: Request handler class
+            context: Server-side TLS context (see create_tls_context)
+        """
+        self.context = context
+        self.tls_stats = TLSStats()
+        super().__init__(server_address, handler_class)
+    
+    def get_request(self):
+        """Accept a connection and wrap it; the handler thread does the handshake"""
+        sock, client_address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), client_address
 
 
 def main():
@@ -294,6 +3011,122 @@ def main():
                         help='Server host (default: 0.0.0.0)')
     parser.add_argument('--port', type=int, default=1344,
                         help='Server port (default: 1344)')
+    parser.add_argument('--preview', type=int, default=0,
+                        help='Preview size advertised in OPTIONS (default: 0)')
+    parser.add_argument('--tls-cert', metavar='FILE',
+                        help='PEM certificate (chain) enabling the ICAPS listener on --tls-port')
+    parser.add_argument('--tls-key', metavar='FILE',
+                        help='PEM private key for --tls-cert (default: in the certificate file)')
+    parser.add_argument('--tls-port', type=int, default=11344,
+                        help='ICAPS (ICAP over TLS) port (default: 11344)')
+    parser.add_argument('--tls-only', action='store_true',
+                        help='Serve only ICAPS, no plaintext listener on --port')
+    parser.add_argument('--clamd-host', default='clamav',
+                        help='ClamAV daemon host (default: clamav)')
+    parser.add_argument('--clamd-port', type=int, default=3310,
+                        help='ClamAV daemon port (default: 3310)')
+    parser.add_argument('--istag-refresh', type=float, default=60.0,
+                        help='Seconds between clamd VERSION queries for the ISTag, 0 to query '
+                             'only at startup (default: 60)')
+    parser.add_argument('--body-budget', type=parse_size, default='256M',
+                        help='Request body bytes held in memory across all requests (default: 256M)')
+    parser.add_argument('--request-memory', type=parse_size, default='32M',
+                        help='Body bytes one request may hold in memory before spooling (default: 32M)')
+    parser.add_argument('--budget-policy', choices=['wait', 'spool'], default='wait',
+                        help='When the budget is exhausted: wait for room, then spool, '
+                             'or spool to disk at once (default: wait)')
+    parser.add_argument('--budget-wait', type=float, default=5.0,
+                        help='Seconds to wait for budget before spooling (default: 5)')
+    parser.add_argument('--spool-dir',
+                        help='Directory for spooled request bodies (default: system temp dir)')
+    parser.add_argument('--max-body-size', type=parse_size, default='0',
+                        help='Largest body accepted for scanning, 0 for no limit (default: 0)')
+    parser.add_argument('--oversize-policy', choices=['block', 'allow', 'scan-head'], default='block',
+                        help='Bodies above --max-body-size: block with 403, allow unscanned with 204, '
+                             'or scan only the first --max-body-size bytes (default: block)')
+    parser.add_argument('--idle-timeout', type=float, default=60.0,
+                        help='Seconds a keep-alive connection may wait for its next request (default: 60)')
+    parser.add_argument('--request-line-timeout', type=float, default=10.0,
+                        help='Seconds for the request line, on new connections counted from '
+                             'connect (default: 10)')
+    parser.add_argument('--header-timeout', type=float, default=20.0,
+                        help='Seconds from the first byte of a request to the end of its '
+                             'headers (default: 20)')
+    parser.add_argument('--body-timeout', type=float, default=600.0,
+                        help='Seconds for a whole request body, 0 for no limit (default: 600)')
+    parser.add_argument('--min-body-rate', type=parse_size, default='1K',
+                        help='Lowest average body rate per second after the first '
+                             f'{ReadDeadlines.RATE_GRACE:g}s, 0 for none (default: 1K)')
+    parser.add_argument('--services', metavar='FILE',
+                        help='JSON service registry mapping service paths to pipelines '
+                             '(default: avscan and echo, other paths like avscan)')
+    parser.add_argument('--trickle-window', type=parse_size, default='0',
+                        help='Stream RESPMOD bodies back while scanning, holding back this '
+                             'tail until the verdict, e.g. 1M (default: 0 = off)')
+    parser.add_argument('--pipeline-depth', type=int, default=8,
+                        help='Pipelined requests scanned at once per connection, 1 to scan them '
+                             'one after another (default: 8)')
+    parser.add_argument('--scan-slots', type=int, default=10,
+                        help='Concurrent scans per clamd backend (the starting point with '
+                             '--scan-limit adaptive), queued fairly beyond that; '
+                             '0 disables scheduling (default: 10, clamd\'s default MaxThreads)')
+    parser.add_argument('--scan-limit', choices=['adaptive', 'fixed'], default='adaptive',
+                        help='Adapt the concurrent scans per clamd to scan latency, starting '
+                             'at --scan-slots, or keep them fixed (default: adaptive)')
+    parser.add_argument('--scan-slots-max', type=int, default=100,
+                        help='Highest adaptive scan limit per clamd (default: 100)')
+    parser.add_argument('--fair-key', choices=['client', 'service'], default='client',
+                        help='Share clamd fairly between client addresses or services (default: client)')
+    parser.add_argument('--fair-weight', action='append', default=[], metavar='KEY=WEIGHT',
+                        help='Weight of a client address or service in the fair share, default 1 (repeatable)')
+    parser.add_argument('--hash-index', metavar='FILE',
+                        help='Known-hash index answered before clamd (see --build-hash-index)')
+    parser.add_argument('--hash-index-reload', type=float, default=5.0,
+                        help='Seconds between checks for a replaced hash index, 0 to disable (default: 5)')
+    parser.add_argument('--build-hash-index', metavar='FILE',
+                        help='Build a hash index from --allow-list/--deny-list files and exit')
+    parser.add_argument('--allow-list', action='append', default=[], metavar='FILE',
+                        help='Known-clean SHA-256 digests, one per line (repeatable)')
+    parser.add_argument('--deny-list', action='append', default=[], metavar='FILE',
+                        help='Known-bad SHA-256 digests, one per line (repeatable)')
+    parser.add_argument('--bloom-bits', type=int, default=10,
+                        help='Bloom filter bits per index entry, 0 for none (default: 10)')
+    parser.add_argument('--verdict-cache', type=int, default=0, metavar='ENTRIES',
+                        help='Remember this many scan verdicts by body SHA-256 for the current '
+                             'signature version (default: 0 = disabled)')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='Peer server asked for cached verdicts before clamd and sent fresh '
+                             'ones (UDP --peer-port of the peer, repeatable; needs --verdict-cache)')
+    parser.add_argument('--peer-port', type=int, default=1345,
+                        help='UDP port for peer verdict queries, bound with --peer (default: 1345)')
+    parser.add_argument('--peer-bind', default='127.0.0.1',
+                        help='Address the peer UDP socket binds to; set it to the fleet network\'s '
+                             'interface (default: 127.0.0.1)')
+    parser.add_argument('--peer-timeout', type=float, default=20.0,
+                        help='Milliseconds a local miss waits for the peers (default: 20)')
+    parser.add_argument('--peer-secret', default=os.environ.get('ICAP_PEER_SECRET'),
+                        help='Shared secret authenticating peer datagrams '
+                             '(default: $ICAP_PEER_SECRET)')
+    parser.add_argument('--peer-insecure', action='store_true',
+                        help='Allow --peer without a secret; anyone able to spoof a peer address '
+                             'can then plant verdicts')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Record sampled requests to FILE (JSON lines, gzip if .gz) '
+                             'for icap_test.py --replay')
+    parser.add_argument('--capture-rate', type=float, default=1.0,
+                        help='Fraction of requests recorded with --capture (default: 1.0)')
+    parser.add_argument('--capture-bodies', type=parse_size, default='0', metavar='SIZE',
+                        help='Store bodies up to SIZE in the capture, larger ones as '
+                             'SHA-256 and size only (default: 0 = never)')
+    parser.add_argument('--health-port', type=int, default=0,
+                        help='HTTP port for /live and /ready probes (default: 0 = disabled)')
+    parser.add_argument('--health-interval', type=float, default=5.0,
+                        help='Seconds between clamd PINGs when no scan confirmed it (default: 5)')
+    parser.add_argument('--ready-max-queue', type=int, default=50,
+                        help='Waiting scans per clamd above which /ready fails (default: 50)')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Logging level (default: INFO)')
 
     args = parser.parse_args()
 
@@ -322,27 +3155,156 @@ def main():
         print()
         return
 
+    logging.getLogger().setLevel(args.log_level)
+
+    if args.build_hash_index:
+        try:
+            count = build_hash_index(args.build_hash_index, args.allow_list, args.deny_list,
+                                     args.bloom_bits)
+        except (OSError, ValueError) as e:
+            logger.error(f"✗ {e}")
+            sys.exit(1)
+        logger.info(f"✓ Hash index with {count} entries written to {args.build_hash_index}")
+        return
+
+    hash_index = None
+    if args.hash_index:
+        try:
+            hash_index = HashIndex(args.hash_index)
+        except (OSError, ValueError) as e:
+            logger.error(f"✗ {e}")
+            sys.exit(1)
+        hash_index.start_watcher(args.hash_index_reload)
+
     host = args.host
     port = args.port
+    
+    tls_context = None
+    if args.tls_cert:
+        try:
+            tls_context = create_tls_context(args.tls_cert, args.tls_key)
+        except (OSError, ssl.SSLError) as e:
+            logger.error(f"✗ TLS certificate: {e}")
+            sys.exit(1)
+    elif args.tls_only:
+        logger.error("✗ --tls-only requires --tls-cert")
+        sys.exit(1)
 
-    # Test ClamAV connection
-    clamav = ClamAVClient()
-    logger.info("Testing ClamAV connection...")
-    if clamav.ping():
-        logger.info("✓ ClamAV connection successful")
-    else:
-        logger.error("✗ ClamAV connection failed - server will start anyway")
-    
-    # Start server
-    server = ThreadedTCPServer((host, port), ICAPRequestHandler)
-    logger.info(f"ICAP Server started on {host}:{port}")
+    clamav = ClamAVClient(args.clamd_host, args.clamd_port)
+    istag = ISTagSource(clamav, args.istag_refresh)
+    istag.start()
+    
+    try:
+        if args.services:
+            services = load_services(args.services, (args.clamd_host, args.clamd_port),
+                                     hash_index is not None)
+        else:
+            services = default_services((args.clamd_host, args.clamd_port))
+        weights = parse_weights(args.fair_weight)
+    except (OSError, ValueError) as e:
+        logger.error(f"✗ {e}")
+        sys.exit(1)
+    schedulers = {}
+    if args.scan_slots > 0:
+        schedulers = {(backend.host, backend.port): ScanScheduler(
+                          args.scan_slots, weights,
+                          AdaptiveLimit(args.scan_slots, maximum=args.scan_slots_max)
+                          if args.scan_limit == 'adaptive' else None)
+                      for service in services.values() for backend in service.backends}
+    logger.info(f"Services: {', '.join(f'{name} ({service.pipeline})' for name, service in services.items())}")
+    body_budget = ByteBudget(args.body_budget)
+    read_deadlines = ReadDeadlines(args.idle_timeout, args.request_line_timeout, args.header_timeout,
+                                   args.body_timeout, args.min_body_rate)
+    
+    verdict_cache = None
+    if args.verdict_cache > 0:
+        verdict_cache = VerdictCache(args.verdict_cache, istag)
+    if args.peer:
+        if verdict_cache is None:
+            logger.error("✗ --peer requires --verdict-cache")
+            sys.exit(1)
+        if not args.peer_secret and not args.peer_insecure:
+            logger.error("✗ --peer requires --peer-secret (or $ICAP_PEER_SECRET), "
+                         "or --peer-insecure to share unauthenticated verdicts")
+            sys.exit(1)
+        try:
+            peers = PeerVerdicts(verdict_cache, (args.peer_bind, args.peer_port),
+                                 [parse_backend(peer, args.peer_port) for peer in args.peer],
+                                 args.peer_timeout / 1000, args.peer_secret)
+        except (OSError, ValueError) as e:
+            logger.error(f"✗ Peer cache: {e}")
+            sys.exit(1)
+        peers.start()
+        logger.info(f"Sharing verdicts on UDP {args.peer_bind}:{args.peer_port} with {len(args.peer)} peer(s)"
+                    f"{'' if args.peer_secret else ' (unauthenticated, --peer-insecure)'}")
+    
+    capture = None
+    if args.capture:
+        try:
+            capture = CaptureWriter(args.capture, args.capture_rate, args.capture_bodies)
+        except OSError as e:
+            logger.error(f"✗ Capture file: {e}")
+            sys.exit(1)
+        logger.info(f"Capturing {args.capture_rate:.0%} of requests to {args.capture}")
+    
+    # Backends are checked in the background; readiness flips once they answer
+    health = HealthMonitor(services, schedulers, args.health_interval, max_queue=args.ready_max_queue)
+    
+    def refresh_istag():
+        istag.refresh()
+        logger.info(f"ISTag: {istag.tag}")
+    
+    health.on_ready(refresh_istag)
+    logger.info("Checking ClamAV connection in the background...")
+    health.start()
+    
+    # Start server: plaintext and/or ICAPS listeners sharing all state
+    listeners = []
+    if not args.tls_only:
+        listeners.append(ThreadedTCPServer((host, port), ICAPRequestHandler))
+    if tls_context is not None:
+        listeners.append(ThreadedTLSServer((host, args.tls_port), ICAPRequestHandler, tls_context))
+    for server in listeners:
+        server.preview_size = args.preview
+        server.clamd_host = args.clamd_host
+        server.clamd_port = args.clamd_port
+        server.istag = istag
+        server.hash_index = hash_index
+        server.verdict_cache = verdict_cache
+        server.services = services
+        server.schedulers = schedulers
+        server.fair_key = args.fair_key
+        server.body_budget = body_budget
+        server.read_deadlines = read_deadlines
+        server.request_memory = args.request_memory
+        server.budget_policy = args.budget_policy
+        server.budget_wait = args.budget_wait
+        server.spool_dir = args.spool_dir
+        server.max_body_size = args.max_body_size
+        server.oversize_policy = args.oversize_policy
+        server.pipeline_depth = args.pipeline_depth
+        server.trickle_window = args.trickle_window
+        server.health = health
+        server.capture = capture
+        scheme = 'ICAPS' if isinstance(server, ThreadedTLSServer) else 'ICAP'
+        logger.info(f"{scheme} Server started on {host}:{server.server_address[1]}")
+    if args.health_port:
+        health_server = HealthServer((host, args.health_port), health)
+        threading.Thread(target=health_server.serve_forever, daemon=True).start()
+        logger.info(f"Health probes on http://{host}:{args.health_port}/live and /ready")
     logger.info("Ready to handle requests...")
     
+    for server in listeners[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
     try:
-        server.serve_forever()
+        listeners[0].serve_forever()
     except KeyboardInterrupt:
         logger.info("Shutting down server...")
-        server.shutdown()
+        for server in listeners:
+            server.shutdown()
+        if capture is not None:
+            capture.close()
+            logger.info(f"✓ {capture.records} requests captured to {capture.path}")
         logger.info("Server stopped")
 
 
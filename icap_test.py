@@ -9,8 +9,28 @@ __author__ = "Roland Imme"
 
 import socket
 import argparse
+import base64
+import gzip
 import sys
-from typing import Tuple, Dict
+import os
+import json
+import csv
+import math
+import random
+import re
+import select
+import struct
+import zlib
+import itertools
+import threading
+import time
+import queue
+import multiprocessing
+import subprocess
+import ssl
+import uuid
+from collections import deque
+from typing import Tuple, Dict, List, Optional, Iterable, Iterator, Union
 
 
 # Colors for output
@@ -58,210 +78,3288 @@ EICAR_STRING = build_eicar_string()
 CLEAN_CONTENT = "This is a clean test file without any threats."
 
 
+class ICAPProtocolError(Exception):
+    """Raised when an ICAP response cannot be parsed"""
+
+
+class ICAPResponse:
+    """Structured view of a single ICAP response"""
+
+    def __init__(self, version: str, status_code: int, reason: str,
+                 header_lines: List[Tuple[str, str]], encapsulated: Dict[str, int],
+                 http_headers: bytes, body: bytes, head: bytes):
+        """
+        Args:
+            version: Protocol version from the status line (e.g. 'ICAP/1.0')
+            status_code: Numeric ICAP status code
+            reason: Reason phrase from the status line
+            header_lines: ICAP headers as (name, value) pairs in received order
+            encapsulated: Parsed Encapsulated header (section -> offset)
+            http_headers: Encapsulated HTTP header sections as raw bytes
+            body: De-chunked encapsulated body
+            head: Raw ICAP status line and header block
+        """
+        self.version = version
+        self.status_code = status_code
+        self.reason = reason
+        self.header_lines = header_lines
+        self.headers = {name.lower(): value for name, value in header_lines}
+        self.encapsulated = encapsulated
+        self.http_headers = http_headers
+        self.body = body
+        self.head = head
+        # Filled in by ICAPClient.send_request
+        self.elapsed = 0.0
+        self.preview_outcome = 'complete'
+        self.body_bytes_sent = 0
+        self.body_bytes_avoided = 0
+        self.request_id = None
+        self.connect_time = 0.0
+        # TLS handshake on this request's connection: None for plaintext,
+        # 0.0 and no resumption flag when the connection was reused
+        self.handshake_time = None
+        self.tls_resumed = None
+
+    @property
+    def status_line(self) -> str:
+        """Status line as received (e.g. 'ICAP/1.0 204 No Content')"""
+        return f"{self.version} {self.status_code} {self.reason}".rstrip()
+
+    @property
+    def server_timing(self) -> Dict[str, float]:
+        """
+        Phase durations in seconds from the Server-Timing header
+
+        Entries look like 'clamd;dur=2.5' with the duration in milliseconds;
+        entries without a duration are ignored.
+        """
+        phases = {}
+        for entry in self.headers.get('server-timing', '').split(','):
+            name, _, params = entry.strip().partition(';')
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'dur' and name:
+                    try:
+                        phases[name] = float(value) / 1000
+                    except ValueError:
+                        pass
+        return phases
+
+    def header_name(self, name: str) -> str:
+        """Return the header name with its original spelling"""
+        for original, _ in self.header_lines:
+            if original.lower() == name:
+                return original
+        return name
+
+    def to_text(self, body_limit: int = 256) -> str:
+        """Render the response for display, truncating the body"""
+        text = (self.head + self.http_headers).decode('latin-1', errors='ignore')
+        if self.body:
+            text += self.body[:body_limit].decode('latin-1', errors='ignore')
+            if len(self.body) > body_limit:
+                text += f"\n[... {len(self.body) - body_limit} more body bytes]"
+        return text
+
+
+class ICAPResponseParser:
+    """
+    Incremental ICAP response parser
+
+    Raw bytes are fed as they arrive from the socket. The parser consumes
+    exactly one response: status line and ICAP headers, then the encapsulated
+    HTTP header sections and chunked body as announced by the Encapsulated
+    header. Bytes received past the end of the response are kept in
+    ``leftover`` so a keep-alive connection can continue with the next one.
+    """
+
+    MAX_HEAD_SIZE = 65536
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._state = 'head'
+        self._head = b''
+        self._status = ('', 0, '')
+        self._header_lines = []
+        self._encapsulated = {}
+        self._http_header_length = 0
+        self._http_headers = b''
+        self._body = bytearray()
+        self._chunk_remaining = 0
+        self.response = None
+
+    @property
+    def done(self) -> bool:
+        """True once a complete response has been parsed"""
+        return self.response is not None
+
+    @property
+    def leftover(self) -> bytes:
+        """Bytes received after the end of the parsed response"""
+        return bytes(self._buffer)
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Feed received bytes into the parser
+
+        Args:
+            data: Bytes read from the connection
+
+        Returns:
+            True once the response is complete
+        """
+        self._buffer += data
+        while not self.done and self._step():
+            pass
+        return self.done
+
+    def _step(self) -> bool:
+        """Advance the state machine; returns False when more data is needed"""
+        buf = self._buffer
+
+        if self._state == 'head':
+            end = buf.find(b'\r\n\r\n')
+            if end < 0:
+                if len(buf) > self.MAX_HEAD_SIZE:
+                    raise ICAPProtocolError("ICAP header block too large")
+                return False
+            self._head = bytes(buf[:end + 4])
+            del buf[:end + 4]
+            self._parse_head()
+            return True
+
+        if self._state == 'http-headers':
+            if len(buf) < self._http_header_length:
+                return False
+            self._http_headers = bytes(buf[:self._http_header_length])
+            del buf[:self._http_header_length]
+            if 'null-body' in self._encapsulated:
+                self._finish()
+            else:
+                self._state = 'chunk-size'
+            return True
+
+        if self._state in ('chunk-size', 'trailer'):
+            end = buf.find(b'\r\n')
+            if end < 0:
+                return False
+            line = bytes(buf[:end])
+            del buf[:end + 2]
+            if self._state == 'trailer':
+                if not line:
+                    self._finish()
+                return True
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ICAPProtocolError(f"Invalid chunk size: {line!r}")
+            if size == 0:
+                self._state = 'trailer'
+            else:
+                self._chunk_remaining = size
+                self._state = 'chunk-data'
+            return True
+
+        if self._state == 'chunk-data':
+            if not buf:
+                return False
+            take = min(len(buf), self._chunk_remaining)
+            self._body += buf[:take]
+            del buf[:take]
+            self._chunk_remaining -= take
+            if self._chunk_remaining == 0:
+                self._state = 'chunk-end'
+            return True
+
+        if self._state == 'chunk-end':
+            if len(buf) < 2:
+                return False
+            del buf[:2]
+            self._state = 'chunk-size'
+            return True
+
+        return False
+
+    def _parse_head(self):
+        """Parse status line, ICAP headers and the Encapsulated header"""
+        lines = self._head[:-4].decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('ICAP/'):
+            raise ICAPProtocolError(f"Invalid status line: {lines[0]!r}")
+        try:
+            code = int(parts[1])
+        except ValueError:
+            raise ICAPProtocolError(f"Invalid status code: {parts[1]!r}")
+        self._status = (parts[0], code, parts[2] if len(parts) > 2 else '')
+
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                self._header_lines.append((name.strip(), value.strip()))
+
+        encapsulated = ''
+        for name, value in self._header_lines:
+            if name.lower() == 'encapsulated':
+                encapsulated = value
+        for entry in encapsulated.split(','):
+            if '=' in entry:
+                section, offset = entry.split('=', 1)
+                try:
+                    self._encapsulated[section.strip().lower()] = int(offset)
+                except ValueError:
+                    raise ICAPProtocolError(f"Invalid Encapsulated header: {encapsulated!r}")
+
+        # 100 Continue and bare error responses carry no encapsulated data
+        if code == 100 or not self._encapsulated:
+            self._finish()
+            return
+
+        # Header sections end where the body section starts
+        self._http_header_length = max(self._encapsulated.values())
+        self._state = 'http-headers'
+
+    def _finish(self):
+        """Build the response object"""
+        version, code, reason = self._status
+        self.response = ICAPResponse(version, code, reason, self._header_lines,
+                                     self._encapsulated, self._http_headers,
+                                     bytes(self._body), self._head)
+        self._state = 'done'
+
+
+# Size suffixes accepted by parse_size()
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a human readable size such as '512', '64K', '10M' or '2G'
+
+    Args:
+        value: Size with optional binary unit suffix
+
+    Returns:
+        Size in bytes
+    """
+    match = re.fullmatch(r'([0-9]*\.?[0-9]+)\s*([KMGT]?)(I?B)?', value.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size: float) -> str:
+    """Format a byte count with a binary unit suffix"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+class Payload:
+    """
+    Lazily generated synthetic request body
+
+    The body is produced chunk by chunk by iter_chunks() and never held in
+    memory as a whole, so sizes from a few bytes up to many GB are cheap.
+    A Payload is immutable and can be iterated any number of times, also
+    from several threads at once.
+
+    Kinds:
+        random: incompressible pseudo-random bytes
+        compressible: repetitive text
+        zip: a stored (uncompressed) ZIP archive of the given total size
+        gzip: gzip stream of compressible text; size is the uncompressed
+            size, the encoded length is not known in advance
+
+    The EICAR test string can be embedded at an offset into the
+    (uncompressed) content: 'start', 'middle', 'end', 'beyond-limit'
+    (just past the clamd StreamMaxLength) or a byte offset.
+    """
+
+    KINDS = ('random', 'compressible', 'zip', 'gzip')
+    EXTENSIONS = {'random': 'bin', 'compressible': 'txt', 'zip': 'zip', 'gzip': 'gz'}
+    CHUNK_SIZE = 64 * 1024
+    POOL_SIZE = 1024 * 1024
+    STREAM_LIMIT = 25 * 1024 * 1024
+    TEXT = (b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod "
+            b"tempor incididunt ut labore et dolore magna aliqua.\n")
+    ZIP_NAME = b'payload.bin'
+    # Local header + data descriptor + central directory entry + end record
+    ZIP_OVERHEAD = 30 + 16 + 46 + 22 + 2 * len(ZIP_NAME)
+    ZIP_MAX_SIZE = 0xFFFFFFFF
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, size: int, kind: str = 'random', eicar_at: Optional[str] = None,
+                 stream_limit: int = STREAM_LIMIT):
+        """
+        Args:
+            size: Body size in bytes (uncompressed size for gzip)
+            kind: One of Payload.KINDS
+            eicar_at: Where to embed EICAR, or None for a clean payload
+            stream_limit: clamd StreamMaxLength used by 'beyond-limit'
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown payload kind: {kind}")
+        if kind == 'zip' and not self.ZIP_OVERHEAD <= size <= self.ZIP_MAX_SIZE:
+            raise ValueError(f"ZIP payloads must be between {self.ZIP_OVERHEAD} bytes and 4 GiB")
+        self.size = size
+        self.kind = kind
+        self.eicar_at = eicar_at
+        self.stream_limit = stream_limit
+        self.eicar_offset = self._resolve_offset(eicar_at) if eicar_at else None
+
+    @property
+    def content_size(self) -> int:
+        """Size of the content EICAR offsets refer to"""
+        return self.size - self.ZIP_OVERHEAD if self.kind == 'zip' else self.size
+
+    @property
+    def length(self) -> Optional[int]:
+        """Encoded body length, or None if only known after generation"""
+        return None if self.kind == 'gzip' else self.size
+
+    @property
+    def filename(self) -> str:
+        """File name matching the payload kind"""
+        infix = '-eicar' if self.eicar_at else ''
+        return f"synthetic{infix}-{self.size}.{self.EXTENSIONS[self.kind]}"
+
+    def _resolve_offset(self, eicar_at: str) -> int:
+        """Translate a placement name or number into a content offset"""
+        eicar_length = len(EICAR_STRING)
+        limit = self.content_size - eicar_length
+        if eicar_at == 'start':
+            offset = 0
+        elif eicar_at == 'middle':
+            offset = limit // 2
+        elif eicar_at == 'end':
+            offset = limit
+        elif eicar_at == 'beyond-limit':
+            offset = self.stream_limit
+        else:
+            offset = parse_size(eicar_at)
+        if offset < 0 or offset > limit:
+            raise ValueError(f"EICAR offset {offset} does not fit into {self.content_size} bytes of content")
+        return offset
+
+    @classmethod
+    def _random_pool(cls) -> bytes:
+        """Shared block of pseudo-random bytes the random kind is cut from"""
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = random.Random(0x1CA9).randbytes(cls.POOL_SIZE)
+            return cls._pool
+
+    def _base_chunks(self, size: int) -> Iterator[bytes]:
+        """Generate raw content of the given size"""
+        if self.kind in ('random', 'zip'):
+            pool = memoryview(self._random_pool())
+            window = self.POOL_SIZE - self.CHUNK_SIZE
+            position = 0
+            while position < size:
+                length = min(self.CHUNK_SIZE, size - position)
+                start = (position // self.CHUNK_SIZE * 7919) % window
+                yield pool[start:start + length]
+                position += length
+        else:
+            block = memoryview(self.TEXT * (self.CHUNK_SIZE // len(self.TEXT) + 2))
+            position = 0
+            while position < size:
+                length = min(self.CHUNK_SIZE, size - position)
+                offset = position % len(self.TEXT)
+                yield block[offset:offset + length]
+                position += length
+
+    def _content_chunks(self) -> Iterator[bytes]:
+        """Generate the content with EICAR spliced in at its offset"""
+        chunks = self._base_chunks(self.content_size)
+        if self.eicar_offset is None:
+            yield from chunks
+            return
+        eicar = EICAR_STRING.encode('latin-1')
+        start, end = self.eicar_offset, self.eicar_offset + len(eicar)
+        position = 0
+        for chunk in chunks:
+            chunk_end = position + len(chunk)
+            if chunk_end > start and position < end:
+                data = bytearray(chunk)
+                lo, hi = max(start, position), min(end, chunk_end)
+                data[lo - position:hi - position] = eicar[lo - start:hi - start]
+                chunk = bytes(data)
+            yield chunk
+            position = chunk_end
+
+    def _zip_chunks(self) -> Iterator[bytes]:
+        """Wrap the content in a single-entry stored ZIP archive"""
+        name = self.ZIP_NAME
+        dos_time, dos_date = 0, (2026 - 1980) << 9 | 1 << 5 | 1
+        yield struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 0, dos_time, dos_date,
+                          0, 0, 0, len(name), 0) + name
+        crc = 0
+        size = 0
+        for chunk in self._content_chunks():
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            yield chunk
+        descriptor = struct.pack('<IIII', 0x08074b50, crc, size, size)
+        central = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x08, 0, dos_time, dos_date,
+                              crc, size, size, len(name), 0, 0, 0, 0, 0, 0) + name
+        central_offset = 30 + len(name) + size + len(descriptor)
+        end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(central), central_offset, 0)
+        yield descriptor + central + end
+
+    def _gzip_chunks(self) -> Iterator[bytes]:
+        """Compress the content as a gzip stream"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in self._content_chunks():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Generate the body as a sequence of byte chunks"""
+        if self.kind == 'zip':
+            return self._zip_chunks()
+        if self.kind == 'gzip':
+            return self._gzip_chunks()
+        return self._content_chunks()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.iter_chunks()
+
+
+def iter_body_chunks(content: Union[bytes, Payload], chunk_size: int = Payload.CHUNK_SIZE) -> Iterator[bytes]:
+    """Iterate over a request body given as bytes or as a Payload"""
+    if isinstance(content, Payload):
+        yield from content.iter_chunks()
+        return
+    for i in range(0, len(content), chunk_size):
+        yield content[i:i + chunk_size]
+
+
+def body_length(content: Union[bytes, Payload]) -> Optional[int]:
+    """Body length if known in advance"""
+    return content.length if isinstance(content, Payload) else len(content)
+
+
+class ICAPOptions:
+    """Capabilities advertised by an ICAP service in its OPTIONS response"""
+
+    def __init__(self, response: ICAPResponse, fetched_at: Optional[float] = None):
+        """
+        Args:
+            response: Parsed OPTIONS response
+            fetched_at: Wall-clock time the response was received (default: now)
+        """
+        headers = response.headers
+        self.response = response
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.methods = [m.strip().upper() for m in headers.get('methods', '').split(',') if m.strip()]
+        self.istag = headers.get('istag', '').strip('"')
+        self.preview = _parse_int_header(headers.get('preview'))
+        self.max_connections = _parse_int_header(headers.get('max-connections'))
+        self.options_ttl = _parse_int_header(headers.get('options-ttl'))
+        self.allow_204 = '204' in headers.get('allow', '')
+        self.transfer_preview = _parse_extension_list(headers.get('transfer-preview'))
+        self.transfer_ignore = _parse_extension_list(headers.get('transfer-ignore'))
+        self.transfer_complete = _parse_extension_list(headers.get('transfer-complete'))
+
+    @property
+    def expires_at(self) -> Optional[float]:
+        """Wall-clock expiry time, or None if no Options-TTL was sent"""
+        if self.options_ttl is None:
+            return None
+        return self.fetched_at + self.options_ttl
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        """True while the Options-TTL has not elapsed"""
+        expires_at = self.expires_at
+        return expires_at is None or (time.time() if now is None else now) < expires_at
+
+    def transfer_policy(self, filename: str) -> str:
+        """
+        Decide how a file should be sent according to the Transfer-* lists
+
+        An explicitly listed extension wins over the '*' wildcard (RFC 3507
+        section 4.10.2). Without any Transfer-* headers a preview is used
+        whenever the service advertises one.
+
+        Args:
+            filename: Name of the file being sent
+
+        Returns:
+            'preview', 'complete' or 'ignore'
+        """
+        extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        lists = (
+            ('ignore', self.transfer_ignore),
+            ('complete', self.transfer_complete),
+            ('preview', self.transfer_preview),
+        )
+        for policy, extensions in lists:
+            if extension and extension in extensions:
+                return policy
+        for policy, extensions in lists:
+            if '*' in extensions:
+                return policy
+        return 'preview' if self.preview is not None else 'complete'
+
+
+def _parse_int_header(value: Optional[str]) -> Optional[int]:
+    """Parse a numeric header value, returning None if absent or invalid"""
+    if value is None:
+        return None
+    try:
+        return int(value.strip())
+    except ValueError:
+        return None
+
+
+def _parse_extension_list(value: Optional[str]) -> List[str]:
+    """Parse a comma separated Transfer-* extension list"""
+    if not value:
+        return []
+    return [ext.strip().lower() for ext in value.split(',') if ext.strip()]
+
+
+class OptionsCache:
+    """
+    Cache of OPTIONS results keyed by service URL
+
+    Entries expire after the service's Options-TTL and are dropped as soon
+    as a response carries a different ISTag than the cached OPTIONS. The
+    cache is shared by all clients of a run and may be persisted to a JSON
+    file so consecutive runs skip the OPTIONS round-trip.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: Optional JSON file to load from and save to
+        """
+        self.path = path
+        self._entries = {}
+        self._lock = threading.RLock()
+        if path:
+            self._load()
+
+    def get(self, url: str) -> Optional[ICAPOptions]:
+        """Return fresh cached options for a service URL, or None"""
+        with self._lock:
+            options = self._entries.get(url)
+            if options is not None and not options.is_fresh():
+                del self._entries[url]
+                self._save()
+                return None
+            return options
+
+    def put(self, url: str, options: ICAPOptions):
+        """Store options for a service URL"""
+        with self._lock:
+            self._entries[url] = options
+            self._save()
+
+    def invalidate(self, url: str):
+        """Drop the cached options for a service URL"""
+        with self._lock:
+            if self._entries.pop(url, None) is not None:
+                self._save()
+
+    def get_or_fetch(self, url: str, fetch) -> Tuple[ICAPOptions, bool]:
+        """
+        Return cached options or fetch and store them
+
+        Concurrent misses for the same cache wait for a single fetch.
+
+        Args:
+            url: Service URL
+            fetch: Callable returning fresh ICAPOptions
+
+        Returns:
+            Tuple of (options, served_from_cache)
+        """
+        with self._lock:
+            options = self.get(url)
+            if options is not None:
+                return options, True
+            options = fetch()
+            self.put(url, options)
+            return options, False
+
+    def observe_istag(self, url: str, istag: Optional[str]):
+        """Invalidate the entry if a response reports a different ISTag"""
+        if not istag:
+            return
+        with self._lock:
+            options = self._entries.get(url)
+            if options is not None and options.istag != istag.strip('"'):
+                self.invalidate(url)
+
+    def _load(self):
+        """Load persisted entries, ignoring a missing or corrupt file"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for url, entry in data.items():
+            try:
+                parser = ICAPResponseParser()
+                parser.feed(entry['head'].encode('latin-1'))
+                if parser.done:
+                    self._entries[url] = ICAPOptions(parser.response, entry['fetched_at'])
+            except (KeyError, TypeError, ICAPProtocolError):
+                continue
+
+    def _save(self):
+        """Persist entries if a path is configured"""
+        if not self.path:
+            return
+        data = {
+            url: {'fetched_at': options.fetched_at,
+                  'head': options.response.head.decode('latin-1')}
+            for url, options in self._entries.items()
+        }
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        except OSError as e:
+            print(f"{Colors.WARNING}Could not write OPTIONS cache {self.path}: {e}{Colors.ENDC}")
+
+
+_TLS_CONTEXTS = {}
+_TLS_CONTEXTS_LOCK = threading.Lock()
+
+
+def tls_client_context(ca_file: Optional[str] = None, verify: bool = True) -> ssl.SSLContext:
+    """
+    Shared client-side TLS context for ICAPS
+
+    Contexts are cached per settings, since sessions can only be resumed
+    with the context that created them.
+
+    Args:
+        ca_file: PEM CA certificates to trust (default: system store)
+        verify: Verify the server certificate and hostname
+    """
+    key = (ca_file, verify)
+    with _TLS_CONTEXTS_LOCK:
+        context = _TLS_CONTEXTS.get(key)
+        if context is None:
+            context = ssl.create_default_context(cafile=ca_file)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _TLS_CONTEXTS[key] = context
+        return context
+
+
 class ICAPClient:
-    def __init__(self, host: str, port: int, service: str):
+    METHODS = ('REQMOD', 'RESPMOD')
+
+    def __init__(self, host: str, port: int, service: str, preview: bool = False,
+                 options_cache: Optional[OptionsCache] = None, method: str = 'REQMOD',
+                 keep_alive: bool = False, tls: bool = False, tls_ca: Optional[str] = None,
+                 tls_verify: bool = True, tls_resume: bool = True):
+        """
+        Initialize ICAP client
+        
+        Args:
+            host: ICAP server hostname or IP
+            port: ICAP server port (usually 1344)
+            service: ICAP service path (e.g., 'avscan')
+            preview: Emulate proxy Preview/100-Continue behaviour based on
+                the service's OPTIONS response
+            options_cache: Shared OPTIONS cache (default: private cache)
+            method: 'REQMOD' to wrap bodies in an HTTP upload request or
+                'RESPMOD' to wrap them in an HTTP download response
+            keep_alive: Reuse one connection for consecutive requests
+            tls: Connect with ICAPS (ICAP over TLS)
+            tls_ca: PEM CA certificates trusted for the server certificate
+            tls_verify: Verify the server certificate and hostname
+            tls_resume: Resume the previous TLS session on new connections
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Unsupported method: {method}")
+        self.host = host
+        self.port = port
+        self.service = service
+        self.preview = preview
+        self.options_cache = options_cache if options_cache is not None else OptionsCache()
+        self.method = method
+        self.keep_alive = keep_alive
+        self.tls = tls
+        self.tls_ca = tls_ca
+        self.tls_verify = tls_verify
+        self.tls_resume = tls_resume
+        self._tls_session = None
+        self._sock = None
+        self._leftover = b''
+
+    @property
+    def service_url(self) -> str:
+        """ICAP URL of the configured service"""
+        scheme = 'icaps' if self.tls else 'icap'
+        return f"{scheme}://{self.host}:{self.port}/{self.service}"
+
+    def _connect(self, timeout: float = 10) -> socket.socket:
+        """Open a connection to the ICAP server"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        sock.connect((self.host, self.port))
+        return sock
+
+    def _open(self) -> Tuple[socket.socket, float, Optional[float], Optional[bool]]:
+        """
+        Connect, with a TLS handshake for ICAPS
+
+        Returns:
+            Tuple of (socket, connect time, handshake time, resumed), the
+            TLS values None for plaintext
+        """
+        start = time.monotonic()
+        sock = self._connect()
+        connect_time = time.monotonic() - start
+        if not self.tls:
+            return sock, connect_time, None, None
+        context = tls_client_context(self.tls_ca, self.tls_verify)
+        start = time.monotonic()
+        try:
+            sock = context.wrap_socket(sock, server_hostname=self.host,
+                                       session=self._tls_session if self.tls_resume else None)
+        except BaseException:
+            sock.close()
+            raise
+        return sock, connect_time, time.monotonic() - start, sock.session_reused
+
+    def _release(self, sock: socket.socket):
+        """Close a connection, keeping its TLS session for resumption"""
+        if self.tls and self.tls_resume and sock.session is not None:
+            self._tls_session = sock.session
+        sock.close()
+
+    def close(self):
+        """Close the persistent connection, if any"""
+        if self._sock is not None:
+            self._release(self._sock)
+            self._sock = None
+            self._leftover = b''
+
+    def _round_trip(self, exchange) -> 'ICAPResponse':
+        """
+        Run one request/response exchange on a connection
+
+        With keep-alive the previous connection is reused. If the server
+        closed it in the meantime the exchange is retried once on a new
+        connection.
+
+        Args:
+            exchange: Callable(sock, leftover) returning (response, leftover)
+
+        Returns:
+            The final response of the exchange
+        """
+        sock, reused = self._sock, self._sock is not None
+        leftover = self._leftover
+        self._sock, self._leftover = None, b''
+        connect_time = 0.0
+        handshake_time, resumed = (0.0 if self.tls else None), None
+        if sock is None:
+            sock, connect_time, handshake_time, resumed = self._open()
+        try:
+            response, leftover = exchange(sock, leftover)
+        except ConnectionError:
+            sock.close()
+            if not reused:
+                raise
+            sock, connect_time, handshake_time, resumed = self._open()
+            try:
+                response, leftover = exchange(sock, b'')
+            except BaseException:
+                sock.close()
+                raise
+        except BaseException:
+            sock.close()
+            raise
+        response.connect_time = connect_time
+        response.handshake_time = handshake_time
+        response.tls_resumed = resumed
+        if self.keep_alive and response.headers.get('connection', '').lower() != 'close':
+            self._sock, self._leftover = sock, leftover
+        else:
+            self._release(sock)
+        return response
+
+    def _request_head(self, filename: str, content_length: Optional[int],
+                      preview_size: Optional[int] = None,
+                      request_id: Optional[str] = None) -> bytes:
+        """
+        Build the ICAP header block and encapsulated HTTP request headers
+
+        Args:
+            filename: Name of the file being scanned
+            content_length: Body length, or None if unknown
+            preview_size: Preview size to announce, or None for no preview
+            request_id: Value of the X-Request-ID header, or None to omit it
+
+        Returns:
+            Request bytes up to the start of the chunked body
+        """
+        length_header = f"Content-Length: {content_length}\r\n" if content_length is not None else ""
+        
+        if self.method == 'RESPMOD':
+            # HTTP download: request headers plus response headers
+            http_request = (
+                f"GET /download/{filename} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"\r\n"
+            )
+            http_response = (
+                f"HTTP/1.1 200 OK\r\n"
+                f"Content-Type: application/octet-stream\r\n"
+                f"{length_header}"
+                f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
+                f"\r\n"
+            )
+            encapsulated = (f"req-hdr=0, res-hdr={len(http_request)}, "
+                            f"res-body={len(http_request) + len(http_response)}")
+            http_request += http_response
+        else:
+            # HTTP request encapsulated in ICAP
+            http_request = (
+                f"POST /upload HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"{length_header}"
+                f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
+                f"\r\n"
+            )
+            encapsulated = f"req-hdr=0, req-body={len(http_request)}"
+        
+        preview_header = f"Preview: {preview_size}\r\n" if preview_size is not None else ""
+        request_id_header = f"X-Request-ID: {request_id}\r\n" if request_id else ""
+        
+        # ICAP request
+        icap_request = (
+            f"{self.method} {self.service_url} ICAP/1.0\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Allow: 204\r\n"
+            f"{preview_header}"
+            f"{request_id_header}"
+            f"Encapsulated: {encapsulated}\r\n"
+            f"\r\n"
+        )
+        
+        return (icap_request + http_request).encode('latin-1')
+
+    def create_icap_request(self, content: bytes, filename: str,
+                            preview_size: Optional[int] = None) -> Tuple[bytes, bytes]:
+        """
+        Create ICAP REQMOD/RESPMOD request with file content
+        
+        Args:
+            content: File content as bytes
+            filename: Name of the file being scanned
+            preview_size: Number of body bytes to send as preview, or None
+                to send the complete body
+            
+        Returns:
+            Tuple of (initial request bytes, remainder to send after
+            '100 Continue'); the remainder is empty unless a preview is
+            sent that does not cover the whole body
+        """
+        head = self._request_head(filename, len(content), preview_size)
+        
+        if preview_size is None:
+            return head + _chunk(content) + b"0\r\n\r\n", b""
+        
+        preview = content[:preview_size]
+        if len(preview) == len(content):
+            # The preview holds the whole body - no 100 Continue needed
+            return head + _chunk(preview) + b"0; ieof\r\n\r\n", b""
+        
+        remainder = content[preview_size:]
+        return head + _chunk(preview) + b"0\r\n\r\n", _chunk(remainder) + b"0\r\n\r\n"
+    
+    def _read_response(self, sock: socket.socket, leftover: bytes = b'') -> Tuple['ICAPResponse', bytes]:
+        """
+        Read exactly one ICAP response from a socket
+
+        Args:
+            sock: Connected socket
+            leftover: Bytes already received but not yet consumed
+
+        Returns:
+            Tuple of (parsed response, bytes received past the response)
+        """
+        parser = ICAPResponseParser()
+        if leftover:
+            parser.feed(leftover)
+        while not parser.done:
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Connection closed before response was complete")
+            parser.feed(chunk)
+        return parser.response, parser.leftover
+
+    @staticmethod
+    def _send_chunks(sock: socket.socket, chunks: Iterator[bytes]) -> int:
+        """Send body chunks with chunked encoding; returns the bytes sent"""
+        sent = 0
+        for data in chunks:
+            if data:
+                _send_buffers(sock, (f"{len(data):x}\r\n".encode('latin-1'), data, b"\r\n"))
+                sent += len(data)
+        return sent
+
+    @staticmethod
+    def _take_preview(chunks: Iterator[bytes], preview_size: int) -> Tuple[bytes, Iterator[bytes], bool]:
+        """
+        Split the first preview_size bytes off a chunk iterator
+
+        Returns:
+            Tuple of (preview bytes, iterator over the rest, exhausted) where
+            exhausted is True if the preview holds the whole body
+        """
+        preview = bytearray()
+        rest = b""
+        for data in chunks:
+            need = preview_size - len(preview)
+            preview += data[:need]
+            if len(data) > need:
+                rest = data[need:]
+                break
+        else:
+            return bytes(preview), iter(()), True
+        if not rest:
+            # Peek ahead to find out whether the preview is the whole body
+            rest = next((data for data in chunks if data), b"")
+            if not rest:
+                return bytes(preview), iter(()), True
+        return bytes(preview), itertools.chain((rest,), chunks), False
+
+    def send_request(self, content: Union[bytes, Payload],
+                     filename: str) -> Tuple[bool, str, Optional['ICAPResponse']]:
+        """
+        Send ICAP request and parse response
+        
+        The body is streamed chunk by chunk, so a lazily generated Payload
+        of any size is never held in memory. In preview mode the service's
+        OPTIONS response decides whether the file is sent with a preview,
+        sent complete or not sent at all. The returned response records how
+        many body bytes were sent and how many were avoided by an early
+        answer.
+
+        Args:
+            content: File content to scan, as bytes or a Payload
+            filename: Name of the file
+            
+        Returns:
+            Tuple of (success, status, parsed response)
+        """
+        try:
+            preview_size = None
+            if self.preview:
+                options = self.get_options()
+                policy = options.transfer_policy(filename)
+                if policy == 'ignore':
+                    return True, "Skipped (Transfer-Ignore)", None
+                if policy == 'preview':
+                    preview_size = options.preview
+            
+            request_id = new_request_id()
+            start = time.monotonic()
+            response = self._round_trip(
+                lambda sock, leftover: self._exchange(sock, leftover, content, filename,
+                                                      preview_size, request_id))
+            
+            self.options_cache.observe_istag(self.service_url, response.headers.get('istag'))
+            response.elapsed = time.monotonic() - start
+            
+            return True, response.status_line, response
+            
+        except socket.timeout:
+            self.close()
+            return False, "Connection timeout", None
+        except ConnectionRefusedError:
+            return False, "Connection refused", None
+        except Exception as e:
+            self.close()
+            return False, f"Error: {str(e)}", None
+
+    def _exchange(self, sock: socket.socket, leftover: bytes, content: Union[bytes, Payload],
+                  filename: str, preview_size: Optional[int],
+                  request_id: Optional[str] = None) -> Tuple['ICAPResponse', bytes]:
+        """
+        Send one request on a connection and read its final response
+
+        Returns:
+            Tuple of (response, bytes received past the response)
+        """
+        length = body_length(content)
+        chunks = iter_body_chunks(content)
+        
+        # Send request
+        sock.sendall(self._request_head(filename, length, preview_size, request_id))
+        if preview_size is None:
+            bytes_sent = self._send_chunks(sock, chunks)
+            sock.sendall(b"0\r\n\r\n")
+            rest = None
+        else:
+            preview, rest, exhausted = self._take_preview(chunks, preview_size)
+            terminator = b"0; ieof\r\n\r\n" if exhausted else b"0\r\n\r\n"
+            sock.sendall(_chunk(preview) + terminator)
+            bytes_sent = len(preview)
+            if exhausted:
+                rest = None
+        
+        # Receive exactly one response
+        response, leftover = self._read_response(sock, leftover)
+        if preview_size is None:
+            outcome = 'complete'
+        elif rest is None:
+            outcome = 'ieof'
+        elif response.status_code == 100:
+            outcome = '100-continue'
+            bytes_sent += self._send_chunks(sock, rest)
+            sock.sendall(b"0\r\n\r\n")
+            response, leftover = self._read_response(sock, leftover)
+        else:
+            outcome = f'early-{response.status_code}'
+        
+        response.preview_outcome = outcome
+        response.request_id = request_id
+        response.body_bytes_sent = bytes_sent
+        response.body_bytes_avoided = length - bytes_sent if length is not None else 0
+        return response, leftover
+
+    def pipeline(self, items: Iterable[Tuple[Union[bytes, Payload], str]],
+                 depth: int = 8) -> Iterator[Tuple[bool, str, Optional['ICAPResponse']]]:
+        """
+        Send requests pipelined on one connection
+
+        A sender thread keeps up to depth requests on the wire ahead of
+        their responses, which are read and yielded in request order.
+        Items are pulled from the iterable only when the window has room,
+        so it may be a lazy generator. Bodies are always sent complete,
+        since a preview would stall the pipeline until 100 Continue.
+
+        Args:
+            items: (content, filename) pairs
+            depth: Maximum requests sent but not yet answered
+
+        Yields:
+            (success, status, parsed response) per sent item, like
+            send_request(); after a connection failure the requests in
+            flight fail and no further items are sent
+        """
+        sock, connect_time, handshake_time, resumed = None, 0.0, None, None
+        leftover = b''
+        if self._sock is not None:
+            sock, leftover = self._sock, self._leftover
+            self._sock, self._leftover = None, b''
+            handshake_time = 0.0 if self.tls else None
+        else:
+            try:
+                sock, connect_time, handshake_time, resumed = self._open()
+            except Exception as e:
+                for _ in items:
+                    yield False, f"Error: {str(e)}", None
+                return
+
+        window = threading.Semaphore(depth)
+        sent = queue.Queue()
+        counts = {'sent': 0, 'answered': 0}
+        failed = threading.Event()
+        send_error = []
+
+        def sender():
+            try:
+                for content, filename in items:
+                    while not window.acquire(timeout=0.5):
+                        if failed.is_set():
+                            return
+                    if failed.is_set():
+                        return
+                    request_id = new_request_id()
+                    length = body_length(content)
+                    start = time.monotonic()
+                    sock.sendall(self._request_head(filename, length, None, request_id))
+                    bytes_sent = self._send_chunks(sock, iter_body_chunks(content))
+                    sock.sendall(b"0\r\n\r\n")
+                    counts['sent'] += 1
+                    sent.put((request_id, start, bytes_sent))
+            except Exception as e:
+                send_error.append(e)
+            finally:
+                sent.put(None)
+
+        thread = threading.Thread(target=sender, daemon=True)
+        thread.start()
+        keep = self.keep_alive
+        error = None
+        try:
+            while True:
+                entry = sent.get()
+                if entry is None:
+                    if send_error:
+                        error = send_error[0]
+                    break
+                request_id, start, bytes_sent = entry
+                if error is not None:
+                    yield False, f"Error: {str(error)}", None
+                    continue
+                try:
+                    response, leftover = self._read_response(sock, leftover)
+                except Exception as e:
+                    error = e
+                    failed.set()
+                    sock.close()
+                    yield False, f"Error: {str(e)}", None
+                    continue
+                window.release()
+                counts['answered'] += 1
+                response.elapsed = time.monotonic() - start
+                response.request_id = request_id
+                response.body_bytes_sent = bytes_sent
+                response.connect_time, connect_time = connect_time, 0.0
+                response.handshake_time = handshake_time
+                response.tls_resumed, resumed = resumed, None
+                handshake_time = 0.0 if self.tls else None
+                if response.headers.get('connection', '').lower() == 'close':
+                    keep = False
+                self.options_cache.observe_istag(self.service_url, response.headers.get('istag'))
+                yield True, response.status_line, response
+        finally:
+            failed.set()
+            thread.join()
+            if error is None and send_error:
+                error = send_error[0]
+            if counts['answered'] != counts['sent']:
+                # Stopped early: unread responses are still on the connection
+                keep = False
+            if keep and error is None:
+                self._sock, self._leftover = sock, leftover
+            elif error is None:
+                self._release(sock)
+            else:
+                sock.close()
+
+    def send_batch(self, items: Iterable[Tuple[Union[bytes, Payload], str]],
+                   depth: int = 8) -> List[Tuple[bool, str, Optional['ICAPResponse']]]:
+        """
+        Send requests pipelined on one connection and collect the results
+
+        Args:
+            items: (content, filename) pairs
+            depth: Maximum requests sent but not yet answered
+
+        Returns:
+            (success, status, parsed response) per item, in item order
+        """
+        return list(self.pipeline(items, depth))
+
+    def _options_exchange(self, sock: socket.socket, leftover: bytes) -> Tuple['ICAPResponse', bytes]:
+        """Send an OPTIONS request on a connection and read the response"""
+        request_id = new_request_id()
+        options_request = (
+            f"OPTIONS {self.service_url} ICAP/1.0\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"X-Request-ID: {request_id}\r\n"
+            f"\r\n"
+        )
+        sock.sendall(options_request.encode('latin-1'))
+        response, leftover = self._read_response(sock, leftover)
+        response.request_id = request_id
+        return response, leftover
+
+    def fetch_options(self) -> ICAPOptions:
+        """
+        Send an OPTIONS request to the service
+
+        Returns:
+            Parsed service options
+        """
+        response = self._round_trip(self._options_exchange)
+        if response.status_code != 200:
+            raise ICAPProtocolError(f"OPTIONS failed: {response.status_line}")
+        return ICAPOptions(response)
+
+    def send_options(self) -> Tuple[bool, str, Optional['ICAPResponse']]:
+        """
+        Send an OPTIONS request, bypassing the cache
+
+        Returns:
+            Tuple of (success, status, parsed response) like send_request()
+        """
+        try:
+            start = time.monotonic()
+            response = self._round_trip(self._options_exchange)
+            response.elapsed = time.monotonic() - start
+            return True, response.status_line, response
+        except Exception as e:
+            self.close()
+            return False, f"Error: {str(e)}", None
+
+    def get_options(self) -> ICAPOptions:
+        """Return the service options from the cache, fetching them when stale"""
+        options, _ = self.options_cache.get_or_fetch(self.service_url, self.fetch_options)
+        return options
+    
+    def test_options(self) -> Tuple[bool, str]:
+        """
+        Test ICAP OPTIONS request
+        
+        A fresh cached result (see OptionsCache) is reused instead of
+        sending another OPTIONS request.
+
+        Returns:
+            Tuple of (success, response)
+        """
+        try:
+            options, cached = self.options_cache.get_or_fetch(self.service_url, self.fetch_options)
+            text = options.response.to_text()
+            if cached:
+                expires_at = options.expires_at
+                remaining = 'no expiry' if expires_at is None else f'expires in {int(expires_at - time.time())}s'
+                text = f"[cached, {remaining}]\n{text}"
+            return True, text
+        except Exception as e:
+            return False, f"Error: {str(e)}"
+
+
+def new_request_id() -> str:
+    """Return a random request ID for the X-Request-ID header"""
+    return uuid.uuid4().hex[:16]
+
+
+def _send_buffers(sock: socket.socket, buffers: Tuple[bytes, ...]):
+    """
+    Send several buffers without concatenating them first
+
+    Uses scatter/gather sendmsg() where available so large body chunks are
+    handed to the kernel without an extra copy in Python.
+    """
+    if not hasattr(sock, 'sendmsg') or isinstance(sock, ssl.SSLSocket):
+        sock.sendall(b"".join(buffers))
+        return
+    pending = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while pending:
+        sent = sock.sendmsg(pending)
+        while sent:
+            if sent >= len(pending[0]):
+                sent -= len(pending[0])
+                pending.pop(0)
+            else:
+                pending[0] = pending[0][sent:]
+                sent = 0
+
+
+def _chunk(data: bytes) -> bytes:
+    """Encode data as a single HTTP chunk (empty data yields nothing)"""
+    if not data:
+        return b""
+    return f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n"
+
+
+# ICAP headers that carry a scan verdict
+THREAT_HEADERS = ('x-virus-id', 'x-violations-found', 'x-infection-found')
+
+
+def analyze_response(response: 'ICAPResponse', filename: str) -> Dict[str, any]:
+    """
+    Analyze ICAP response
+    
+    Classification only looks at the status code and the verdict headers,
+    never at the encapsulated body.
+
+    Args:
+        response: Parsed ICAP response
+        filename: Name of tested file
+        
+    Returns:
+        Dictionary with analysis results
+    """
+    result = {
+        'filename': filename,
+        'status': response.status_line,
+        'threat_found': False,
+        'clean': False,
+        'details': '',
+        'elapsed': response.elapsed,
+        'preview_outcome': response.preview_outcome,
+        'body_bytes_sent': response.body_bytes_sent,
+        'body_bytes_avoided': response.body_bytes_avoided,
+        'request_id': response.request_id,
+        'server_timing': response.server_timing
+    }
+    
+    # Check status code
+    code = response.status_code
+    if code == 200:
+        result['clean'] = True
+        result['details'] = 'File passed scan - no threats detected'
+    elif code == 204:
+        result['clean'] = True
+        result['details'] = 'No modification needed - file is clean'
+    elif code in (403, 451):
+        result['threat_found'] = True
+        result['details'] = 'Threat detected - file blocked'
+    
+    # Verdict headers override a 200 that carries a block page
+    for name in THREAT_HEADERS:
+        value = response.headers.get(name)
+        if value is None:
+            continue
+        if name == 'x-violations-found' and value.strip() == '0':
+            continue
+        result['threat_found'] = True
+        result['clean'] = False
+        if not result['details'] or code == 200:
+            result['details'] = 'Threat detected - file replaced'
+        result['details'] += f' | {response.header_name(name)}: {value}'
+    
+    return result
+
+
+def print_results(test_name: str, result: Dict[str, any]):
+    """Print test results in a formatted way"""
+    print(f"\n{'='*60}")
+    print(f"Test: {test_name}")
+    print(f"{'='*60}")
+    print(f"Filename: {result['filename']}")
+    print(f"Status: {result['status']}")
+    print(f"Threat Found: {'YES' if result['threat_found'] else 'NO'}")
+    print(f"Clean: {'YES' if result['clean'] else 'NO'}")
+    print(f"Details: {result['details']}")
+    if result['request_id']:
+        print(f"Request ID: {result['request_id']}")
+    if result['server_timing']:
+        phases = '  '.join(f"{name} {seconds * 1000:.2f}ms" for name, seconds in result['server_timing'].items())
+        print(f"Timing: total {result['elapsed'] * 1000:.2f}ms  {phases}")
+    if result['preview_outcome'] != 'complete':
+        print(f"Preview: {result['preview_outcome']} - {result['body_bytes_sent']} body bytes sent, "
+              f"{result['body_bytes_avoided']} avoided")
+    print(f"{'='*60}")
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram with microsecond resolution
+
+    Each power of two is split into 32 sub-buckets (about 3% relative
+    error). Bucket boundaries are fixed, so histograms recorded in separate
+    threads or processes merge exactly by adding counts.
+    """
+
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total_us = 0
+        self.min_us = None
+        self.max_us = 0
+
+    @classmethod
+    def _index(cls, value_us: int) -> int:
+        """Map a value in microseconds to its bucket index"""
+        if value_us < cls.SUB_BUCKETS:
+            return value_us
+        shift = value_us.bit_length() - cls.SUB_BUCKETS.bit_length()
+        return (shift + 1) * cls.SUB_BUCKETS + (value_us >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _bounds(cls, index: int) -> Tuple[int, int]:
+        """Return the [lower, upper) bounds of a bucket in microseconds"""
+        if index < cls.SUB_BUCKETS:
+            return index, index + 1
+        shift = index // cls.SUB_BUCKETS - 1
+        mantissa = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, seconds: float):
+        """Record one latency sample"""
+        value_us = max(0, int(seconds * 1_000_000))
+        index = self._index(value_us)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total_us += value_us
+        self.min_us = value_us if self.min_us is None else min(self.min_us, value_us)
+        self.max_us = max(self.max_us, value_us)
+
+    def merge(self, other: 'LatencyHistogram'):
+        """Add all samples of another histogram"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total_us += other.total_us
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        self.max_us = max(self.max_us, other.max_us)
+
+    def since(self, earlier: 'LatencyHistogram') -> 'LatencyHistogram':
+        """
+        Samples recorded after an earlier snapshot of this histogram
+
+        Min and max are approximated by the bounds of the occupied buckets.
+        """
+        histogram = LatencyHistogram()
+        for index, count in self.counts.items():
+            count -= earlier.counts.get(index, 0)
+            if count > 0:
+                histogram.counts[index] = count
+        histogram.count = self.count - earlier.count
+        histogram.total_us = self.total_us - earlier.total_us
+        if histogram.counts:
+            histogram.min_us = self._bounds(min(histogram.counts))[0]
+            histogram.max_us = self._bounds(max(histogram.counts))[1] - 1
+        return histogram
+
+    def percentile(self, p: float) -> float:
+        """Return the p-th percentile (0-100) in seconds"""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lower, upper = self._bounds(index)
+                value_us = min(max((lower + upper - 1) / 2, self.min_us), self.max_us)
+                return value_us / 1_000_000
+        return self.max_us / 1_000_000
+
+    @property
+    def mean(self) -> float:
+        """Mean latency in seconds"""
+        return self.total_us / self.count / 1_000_000 if self.count else 0.0
+
+    def to_dict(self) -> Dict[str, any]:
+        """Serialize for transfer between processes or to a result file"""
+        return {
+            'counts': {str(index): count for index, count in self.counts.items()},
+            'count': self.count,
+            'total_us': self.total_us,
+            'min_us': self.min_us,
+            'max_us': self.max_us,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, any]) -> 'LatencyHistogram':
+        """Rebuild a histogram serialized with to_dict()"""
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in data['counts'].items()}
+        histogram.count = data['count']
+        histogram.total_us = data['total_us']
+        histogram.min_us = data['min_us']
+        histogram.max_us = data['max_us']
+        return histogram
+
+
+class LoadStats:
+    """Counters and latency histograms collected during a load run"""
+
+    COUNTERS = ('requests', 'clean', 'threats', 'errors', 'skipped',
+                'body_bytes_sent', 'body_bytes_avoided', 'tls_handshakes', 'tls_resumed')
+
+    # Latency phases in request order: client connect and TLS handshake,
+    # the server phases from its Server-Timing header, and whatever remains
+    # of the end-to-end latency (transfer, server write, client overhead)
+    PHASES = ('connect', 'handshake', 'queue', 'receive', 'clamd', 'other')
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.phases = {}
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.status_codes = {}
+        self.preview_outcomes = {}
+        self.elapsed = 0.0
+        self.hedging = None
+        self._lock = threading.Lock()
+
+    def record(self, success: bool, response: Optional[ICAPResponse], filename: str):
+        """Record the outcome of one ICAPClient.send_request() call"""
+        with self._lock:
+            self.counters['requests'] += 1
+            if not success:
+                self.counters['errors'] += 1
+                return
+            if response is None:
+                self.counters['skipped'] += 1
+                return
+            result = analyze_response(response, filename)
+            if result['threat_found']:
+                self.counters['threats'] += 1
+            elif result['clean']:
+                self.counters['clean'] += 1
+            code = str(response.status_code)
+            self.status_codes[code] = self.status_codes.get(code, 0) + 1
+            outcome = response.preview_outcome
+            self.preview_outcomes[outcome] = self.preview_outcomes.get(outcome, 0) + 1
+            self.counters['body_bytes_sent'] += response.body_bytes_sent
+            self.counters['body_bytes_avoided'] += response.body_bytes_avoided
+            if response.tls_resumed is not None:
+                self.counters['tls_handshakes'] += 1
+                self.counters['tls_resumed'] += response.tls_resumed
+            self.histogram.record(response.elapsed)
+            server_timing = response.server_timing
+            if server_timing:
+                phases = dict(server_timing, connect=response.connect_time)
+                if response.handshake_time is not None:
+                    phases['handshake'] = response.handshake_time
+                phases['other'] = max(0.0, response.elapsed - sum(phases.values()))
+                for name, seconds in phases.items():
+                    self.phases.setdefault(name, LatencyHistogram()).record(seconds)
+
+    def merge(self, other: 'LoadStats'):
+        """Add the counters and samples of another LoadStats"""
+        with self._lock:
+            self.histogram.merge(other.histogram)
+            for name, histogram in other.phases.items():
+                self.phases.setdefault(name, LatencyHistogram()).merge(histogram)
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for code, count in other.status_codes.items():
+                self.status_codes[code] = self.status_codes.get(code, 0) + count
+            for outcome, count in other.preview_outcomes.items():
+                self.preview_outcomes[outcome] = self.preview_outcomes.get(outcome, 0) + count
+            self.elapsed = max(self.elapsed, other.elapsed)
+            if other.hedging is not None:
+                self.hedging = self.hedging or HedgeStats()
+                self.hedging.merge(other.hedging)
+
+    @property
+    def throughput(self) -> float:
+        """Completed requests per second"""
+        return self.counters['requests'] / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def byte_rate(self) -> float:
+        """Body bytes sent per second"""
+        return self.counters['body_bytes_sent'] / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self) -> Dict[str, any]:
+        """Serialize for transfer between processes or to a result file"""
+        return {
+            'counters': dict(self.counters),
+            'status_codes': dict(self.status_codes),
+            'preview_outcomes': dict(self.preview_outcomes),
+            'elapsed': self.elapsed,
+            'histogram': self.histogram.to_dict(),
+            'phases': {name: histogram.to_dict() for name, histogram in self.phases.items()},
+            'hedging': self.hedging.to_dict() if self.hedging is not None else None,
+        }
+
+    def summary(self) -> Dict[str, any]:
+        """Flat metrics of the run as stored in result files"""
+        histogram = self.histogram
+        summary = {
+            'requests': self.counters['requests'],
+            'clean': self.counters['clean'],
+            'threats': self.counters['threats'],
+            'errors': self.counters['errors'],
+            'skipped': self.counters['skipped'],
+            'elapsed': round(self.elapsed, 3),
+            'throughput': round(self.throughput, 2),
+            'byte_rate': round(self.byte_rate, 1),
+            'body_bytes_sent': self.counters['body_bytes_sent'],
+            'body_bytes_avoided': self.counters['body_bytes_avoided'],
+            'latency_mean_ms': round(histogram.mean * 1000, 3),
+            'latency_p50_ms': round(histogram.percentile(50) * 1000, 3),
+            'latency_p90_ms': round(histogram.percentile(90) * 1000, 3),
+            'latency_p99_ms': round(histogram.percentile(99) * 1000, 3),
+            'latency_max_ms': round(histogram.max_us / 1000, 3),
+        }
+        handshakes = self.counters['tls_handshakes']
+        if handshakes:
+            summary['tls_handshakes'] = handshakes
+            summary['tls_resumption_pct'] = round(self.counters['tls_resumed'] / handshakes * 100, 2)
+        for name, phase in self.phases.items():
+            summary[f'phase_{name}_mean_ms'] = round(phase.mean * 1000, 3)
+            summary[f'phase_{name}_p99_ms'] = round(phase.percentile(99) * 1000, 3)
+        if self.hedging is not None and self.hedging.requests:
+            hedging = self.hedging
+            summary['hedges'] = hedging.hedges
+            summary['hedge_wins'] = hedging.hedge_wins
+            summary['hedge_extra_load_pct'] = round(hedging.hedges / hedging.requests * 100, 2)
+            summary['unhedged_p99_ms'] = round(hedging.unhedged.percentile(99) * 1000, 3)
+        return summary
+
+    def snapshot(self) -> 'LoadStats':
+        """Consistent copy of the stats while recording continues"""
+        with self._lock:
+            return LoadStats.from_dict(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, any]) -> 'LoadStats':
+        """Rebuild stats serialized with to_dict()"""
+        stats = cls()
+        stats.counters.update(data['counters'])
+        stats.status_codes = dict(data['status_codes'])
+        stats.preview_outcomes = dict(data['preview_outcomes'])
+        stats.elapsed = data['elapsed']
+        stats.histogram = LatencyHistogram.from_dict(data['histogram'])
+        stats.phases = {name: LatencyHistogram.from_dict(phase)
+                        for name, phase in data.get('phases', {}).items()}
+        if data.get('hedging'):
+            stats.hedging = HedgeStats.from_dict(data['hedging'])
+        return stats
+
+
+class HedgeStats:
+    """Outcome of hedged requests: achieved versus unhedged latency and the extra load"""
+
+    def __init__(self):
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Latency the caller saw versus the latency of the first attempt alone
+        self.achieved = LatencyHistogram()
+        self.unhedged = LatencyHistogram()
+        self.endpoints = {}
+
+    def count(self, endpoint: str, key: str):
+        """Increment a per-endpoint counter (requests, wins or errors)"""
+        counters = self.endpoints.setdefault(endpoint, {'requests': 0, 'wins': 0, 'errors': 0})
+        counters[key] += 1
+
+    def merge(self, other: 'HedgeStats'):
+        """Add the counts and samples of another HedgeStats"""
+        self.requests += other.requests
+        self.hedges += other.hedges
+        self.hedge_wins += other.hedge_wins
+        self.achieved.merge(other.achieved)
+        self.unhedged.merge(other.unhedged)
+        for endpoint, counters in other.endpoints.items():
+            own = self.endpoints.setdefault(endpoint, {'requests': 0, 'wins': 0, 'errors': 0})
+            for key, value in counters.items():
+                own[key] += value
+
+    def to_dict(self) -> Dict[str, any]:
+        """Serialize for transfer between processes"""
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'achieved': self.achieved.to_dict(),
+            'unhedged': self.unhedged.to_dict(),
+            'endpoints': {endpoint: dict(counters) for endpoint, counters in self.endpoints.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, any]) -> 'HedgeStats':
+        """Rebuild stats serialized with to_dict()"""
+        stats = cls()
+        stats.requests = data['requests']
+        stats.hedges = data['hedges']
+        stats.hedge_wins = data['hedge_wins']
+        stats.achieved = LatencyHistogram.from_dict(data['achieved'])
+        stats.unhedged = LatencyHistogram.from_dict(data['unhedged'])
+        stats.endpoints = {endpoint: dict(counters) for endpoint, counters in data['endpoints'].items()}
+        return stats
+
+
+def parse_endpoints(value: str, default_port: int = 1344) -> List[Tuple[str, int]]:
+    """
+    Parse a comma separated endpoint list
+
+    Args:
+        value: Endpoints like 'icap1:1344,icap2,10.0.0.5:11344'
+        default_port: Port used for entries without one
+
+    Returns:
+        List of (host, port) tuples
+    """
+    endpoints = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(':') if ':' in entry else (entry, '', '')
+        try:
+            endpoints.append((host, int(port) if port else default_port))
+        except ValueError:
+            raise ValueError(f"Invalid endpoint: {entry}") from None
+    if not endpoints:
+        raise ValueError("No endpoints given")
+    return endpoints
+
+
+class ICAPEndpointPool:
+    """
+    Client for several ICAP servers offering the same service
+
+    Provides the request methods of ICAPClient and picks an endpoint per
+    request, either round-robin or the one with the lowest recent latency.
+    With hedging enabled, a request that has not been answered after the
+    hedge percentile of previous latencies is duplicated to a second
+    endpoint and the first answer wins. The slower attempt runs to
+    completion so its latency is known; it counts as extra load.
+
+    The pool is thread-safe: each attempt borrows an idle ICAPClient for
+    its endpoint or creates a new one.
+    """
+
+    POLICIES = ('round-robin', 'least-latency')
+
+    # Weight of the newest sample in the per-endpoint latency average
+    EWMA_WEIGHT = 0.2
+
+    def __init__(self, endpoints: List[Tuple[str, int]], service: str, policy: str = 'round-robin',
+                 hedge_percentile: Optional[float] = None, hedge_min_samples: int = 20,
+                 **client_args):
+        """
+        Args:
+            endpoints: (host, port) of each server
+            service: ICAP service path
+            policy: 'round-robin' or 'least-latency'
+            hedge_percentile: Send a hedge once a request has been pending
+                longer than this percentile of previous latencies, or None
+                to disable hedging
+            hedge_min_samples: Latency samples needed before hedging starts
+            client_args: Further ICAPClient arguments (preview, method, ...)
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unsupported policy: {policy}")
+        self.endpoints = list(endpoints)
+        self.service = service
+        self.policy = policy
+        self.hedge_percentile = hedge_percentile if len(self.endpoints) > 1 else None
+        self.hedge_min_samples = hedge_min_samples
+        self.client_args = client_args
+        self.stats = HedgeStats()
+        self._latency = {endpoint: None for endpoint in self.endpoints}
+        self._in_flight = {endpoint: 0 for endpoint in self.endpoints}
+        self._idle = {endpoint: [] for endpoint in self.endpoints}
+        self._next = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name(endpoint: Tuple[str, int]) -> str:
+        return f"{endpoint[0]}:{endpoint[1]}"
+
+    def _select(self, exclude: Optional[Tuple[str, int]] = None) -> Tuple[str, int]:
+        """Pick the endpoint for the next attempt (caller holds the lock)"""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint != exclude] or self.endpoints
+        if self.policy == 'least-latency':
+            # Untried endpoints first, then lowest average, then least busy
+            return min(candidates, key=lambda endpoint: (
+                self._latency[endpoint] is not None, self._latency[endpoint] or 0.0,
+                self._in_flight[endpoint]))
+        endpoint = candidates[self._next % len(candidates)]
+        self._next += 1
+        return endpoint
+
+    def _acquire(self, endpoint: Tuple[str, int]) -> ICAPClient:
+        with self._lock:
+            self._in_flight[endpoint] += 1
+            if self._idle[endpoint]:
+                return self._idle[endpoint].pop()
+        return ICAPClient(endpoint[0], endpoint[1], self.service, **self.client_args)
+
+    def _release(self, endpoint: Tuple[str, int], client: ICAPClient, elapsed: Optional[float]):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+            self._idle[endpoint].append(client)
+            if elapsed is not None:
+                average = self._latency[endpoint]
+                self._latency[endpoint] = elapsed if average is None else (
+                    average + self.EWMA_WEIGHT * (elapsed - average))
+
+    def _attempt(self, endpoint: Tuple[str, int], call) -> Tuple[bool, str, Optional[ICAPResponse]]:
+        """Run one call on a borrowed client for the endpoint"""
+        client = self._acquire(endpoint)
+        start = time.monotonic()
+        outcome = (False, "Not sent", None)
+        try:
+            outcome = call(client)
+        finally:
+            self._release(endpoint, client, time.monotonic() - start if outcome[0] else None)
+        with self._lock:
+            self.stats.count(self._name(endpoint), 'requests' if outcome[0] else 'errors')
+        return outcome
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while hedging is off"""
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            if self.stats.unhedged.count < self.hedge_min_samples:
+                return None
+            return self.stats.unhedged.percentile(self.hedge_percentile)
+
+    def _run(self, call) -> Tuple[bool, str, Optional[ICAPResponse]]:
+        """Send a call to one endpoint, hedging it to a second one if it is slow"""
+        start = time.monotonic()
+        with self._lock:
+            primary = self._select()
+        delay = self._hedge_delay()
+        if delay is None:
+            outcome = self._attempt(primary, call)
+            with self._lock:
+                self.stats.requests += 1
+                elapsed = time.monotonic() - start
+                self.stats.achieved.record(elapsed)
+                self.stats.unhedged.record(elapsed)
+                self.stats.count(self._name(primary), 'wins')
+            return outcome
+
+        results = queue.Queue()
+
+        def attempt(endpoint, hedge):
+            outcome = self._attempt(endpoint, call)
+            elapsed = time.monotonic() - start
+            if not hedge:
+                with self._lock:
+                    self.stats.unhedged.record(elapsed)
+            results.put((endpoint, hedge, outcome))
+
+        first = threading.Thread(target=attempt, args=(primary, False), daemon=True)
+        first.start()
+        threads = [first]
+        try:
+            endpoint, hedge, outcome = results.get(timeout=delay)
+        except queue.Empty:
+            with self._lock:
+                secondary = self._select(exclude=primary)
+                self.stats.hedges += 1
+            second = threading.Thread(target=attempt, args=(secondary, True), daemon=True)
+            second.start()
+            threads.append(second)
+            endpoint, hedge, outcome = results.get()
+            if not outcome[0]:
+                # A failed attempt does not win while the other may succeed
+                endpoint, hedge, outcome = results.get()
+        with self._lock:
+            self.stats.requests += 1
+            self.stats.achieved.record(time.monotonic() - start)
+            self.stats.hedge_wins += hedge
+            self.stats.count(self._name(endpoint), 'wins')
+            self._pending = [thread for thread in self._pending if thread.is_alive()] + threads
+        return outcome
+
+    def send_request(self, content: Union[bytes, Payload],
+                     filename: str) -> Tuple[bool, str, Optional[ICAPResponse]]:
+        """Send a scan request like ICAPClient.send_request()"""
+        return self._run(lambda client: client.send_request(content, filename))
+
+    def send_options(self) -> Tuple[bool, str, Optional[ICAPResponse]]:
+        """Send an OPTIONS request like ICAPClient.send_options()"""
+        return self._run(lambda client: client.send_options())
+
+    def get_options(self) -> ICAPOptions:
+        """Service options of the first endpoint"""
+        endpoint = self.endpoints[0]
+        client = self._acquire(endpoint)
+        try:
+            return client.get_options()
+        finally:
+            self._release(endpoint, client, None)
+
+    def close(self):
+        """Wait for outstanding hedge attempts and close all connections"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for thread in pending:
+            thread.join()
+        with self._lock:
+            for clients in self._idle.values():
+                for client in clients:
+                    client.close()
+                clients.clear()
+
+
+class LoadGenerator:
+    """
+    Multi-threaded load generator
+
+    Behaves like a production proxy: the service's OPTIONS response (from
+    the shared OptionsCache) caps concurrency at Max-Connections and
+    selects the preview size for every request.
+    """
+
+    def __init__(self, host: str, port: int, service: str, concurrency: int = 10,
+                 requests: Optional[int] = 1000, duration: Optional[float] = None,
+                 eicar_ratio: float = 0.0, options_cache: Optional[OptionsCache] = None,
+                 payload: Optional[Payload] = None, threat_payload: Optional[Payload] = None,
+                 method: str = 'REQMOD', keep_alive: bool = False,
+                 endpoints: Optional[List[Tuple[str, int]]] = None, policy: str = 'round-robin',
+                 hedge_percentile: Optional[float] = None, tls: bool = False,
+                 tls_ca: Optional[str] = None, tls_verify: bool = True, tls_resume: bool = True,
+                 pipeline_depth: Optional[int] = None):
+        """
+        Args:
+            host: ICAP server hostname or IP
+            port: ICAP server port
+            service: ICAP service path
+            concurrency: Number of concurrent requests
+            requests: Total number of requests (ignored if duration is set)
+            duration: Run for this many seconds instead of a request count
+            eicar_ratio: Fraction of requests carrying the EICAR test file
+            options_cache: Shared OPTIONS cache
+            payload: Synthetic body sent instead of the clean test file
+            threat_payload: Synthetic body sent instead of the EICAR file
+            method: 'REQMOD', 'RESPMOD' or 'OPTIONS'
+            keep_alive: Reuse one connection per worker thread
+            endpoints: Spread requests over these (host, port) servers
+                instead of host and port (see ICAPEndpointPool)
+            policy: Endpoint selection, 'round-robin' or 'least-latency'
+            hedge_percentile: Hedge requests slower than this percentile
+                of previous latencies to a second endpoint
+            tls: Connect with ICAPS (see ICAPClient for the tls_* options)
+            pipeline_depth: Pipeline up to this many requests per worker
+                connection (see ICAPClient.pipeline) instead of waiting
+                for each response
+        """
+        if pipeline_depth and (endpoints or method == 'OPTIONS'):
+            raise ValueError("Pipelining needs a single endpoint and REQMOD or RESPMOD")
+        self.host = host
+        self.port = port
+        self.service = service
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.eicar_ratio = eicar_ratio
+        self.options_cache = options_cache if options_cache is not None else OptionsCache()
+        self.payload = payload
+        self.threat_payload = threat_payload
+        self.method = method
+        self.keep_alive = keep_alive
+        self.endpoints = endpoints
+        self.policy = policy
+        self.hedge_percentile = hedge_percentile
+        self.tls_args = {'tls': tls, 'tls_ca': tls_ca, 'tls_verify': tls_verify,
+                         'tls_resume': tls_resume}
+        self.pipeline_depth = pipeline_depth
+        self._pool = None
+        self._issued = 0
+        self._issue_lock = threading.Lock()
+        self._deadline = None
+
+    def _new_client(self) -> Union[ICAPClient, ICAPEndpointPool]:
+        """
+        Create a client sharing the generator's OPTIONS cache
+
+        With several endpoints all workers share one ICAPEndpointPool.
+        """
+        method = 'REQMOD' if self.method == 'OPTIONS' else self.method
+        if self.endpoints:
+            if self._pool is None:
+                self._pool = ICAPEndpointPool(self.endpoints, self.service, self.policy,
+                                              self.hedge_percentile, preview=True,
+                                              options_cache=self.options_cache, method=method,
+                                              keep_alive=self.keep_alive, **self.tls_args)
+            return self._pool
+        return ICAPClient(self.host, self.port, self.service, preview=True,
+                          options_cache=self.options_cache, method=method,
+                          keep_alive=self.keep_alive, **self.tls_args)
+
+    def _next_ticket(self) -> bool:
+        """Reserve the next request; False once the run is complete"""
+        if self._deadline is not None:
+            return time.monotonic() < self._deadline
+        with self._issue_lock:
+            if self._issued >= self.requests:
+                return False
+            self._issued += 1
+            return True
+
+    def _worker(self, stats: LoadStats):
+        """Send requests until the run is complete"""
+        client = self._new_client()
+        if self.payload is not None:
+            clean = (self.payload, self.payload.filename)
+        else:
+            clean = (CLEAN_CONTENT.encode('utf-8'), 'clean.txt')
+        if self.threat_payload is not None:
+            eicar = (self.threat_payload, self.threat_payload.filename)
+        else:
+            eicar = (EICAR_STRING.encode('latin-1'), 'eicar.com')
+        if self.pipeline_depth:
+            filenames = deque()
+            exhausted = []
+
+            def items():
+                while self._next_ticket():
+                    item = eicar if self.eicar_ratio and random.random() < self.eicar_ratio else clean
+                    filenames.append(item[1])
+                    yield item
+                exhausted.append(True)
+
+            # One pipeline per connection, and a new one after a failure
+            while not exhausted:
+                filenames.clear()
+                for success, _, response in client.pipeline(items(), self.pipeline_depth):
+                    stats.record(success, response, filenames.popleft())
+            client.close()
+            return
+        while self._next_ticket():
+            if self.method == 'OPTIONS':
+                success, _, response = client.send_options()
+                stats.record(success, response, '')
+                continue
+            if self.eicar_ratio and random.random() < self.eicar_ratio:
+                content, filename = eicar
+            else:
+                content, filename = clean
+            success, _, response = client.send_request(content, filename)
+            stats.record(success, response, filename)
+        if client is not self._pool:
+            client.close()
+
+    def effective_concurrency(self) -> int:
+        """Concurrency capped at the service's advertised Max-Connections"""
+        try:
+            options = self._new_client().get_options()
+        except Exception as e:
+            print(f"{Colors.WARNING}OPTIONS failed, using requested concurrency: {e}{Colors.ENDC}")
+            return self.concurrency
+        if options.max_connections and options.max_connections < self.concurrency:
+            print(f"{Colors.WARNING}Concurrency capped at Max-Connections: "
+                  f"{options.max_connections}{Colors.ENDC}")
+            return options.max_connections
+        return self.concurrency
+
+    def run(self, stats: Optional[LoadStats] = None) -> LoadStats:
+        """
+        Run the load test and return the collected statistics
+
+        Args:
+            stats: Stats object to record into, so progress can be observed
+                while the run is in flight (default: a new one)
+        """
+        stats = LoadStats() if stats is None else stats
+        concurrency = self.effective_concurrency()
+        self._issued = 0
+        start = time.monotonic()
+        self._deadline = start + self.duration if self.duration else None
+        workers = [threading.Thread(target=self._worker, args=(stats,), daemon=True)
+                   for _ in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats.elapsed = time.monotonic() - start
+        if self._pool is not None:
+            self._pool.close()
+            with stats._lock:
+                stats.hedging = stats.hedging or HedgeStats()
+                stats.hedging.merge(self._pool.stats)
+            self._pool = None
+        return stats
+
+
+class ProgressReporter:
+    """Print aggregated load progress at a fixed interval"""
+
+    def __init__(self, interval: float = 1.0):
+        """
+        Args:
+            interval: Seconds between progress lines
+        """
+        self.interval = interval
+        self._start = time.monotonic()
+        self._next = self._start + interval
+        self._last_requests = 0
+        self._last_time = self._start
+
+    def due(self) -> bool:
+        """True when the next progress line should be printed"""
+        return time.monotonic() >= self._next
+
+    def report(self, stats: LoadStats):
+        """Print one progress line for the aggregated stats"""
+        now = time.monotonic()
+        requests = stats.counters['requests']
+        rate = (requests - self._last_requests) / (now - self._last_time) if now > self._last_time else 0.0
+        histogram = stats.histogram
+        print(f"[{now - self._start:7.1f}s] {requests:>9} req ({rate:9.1f}/s)  "
+              f"errors {stats.counters['errors']}  "
+              f"p50 {histogram.percentile(50) * 1000:.2f}ms  p99 {histogram.percentile(99) * 1000:.2f}ms  "
+              f"{format_size(stats.counters['body_bytes_sent'] / (now - self._start))}/s", flush=True)
+        self._last_requests = requests
+        self._last_time = now
+        while self._next <= now:
+            self._next += self.interval
+
+
+def _load_worker(index: int, generator_args: Dict[str, any], options_cache_path: Optional[str],
+                 results, interval: float):
+    """
+    Entry point of a load worker process
+
+    Runs a threaded LoadGenerator and sends cumulative stats snapshots to
+    the parent every interval, followed by the final stats.
+    """
+    generator = LoadGenerator(options_cache=OptionsCache(options_cache_path), **generator_args)
+    stats = LoadStats()
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(interval):
+            results.put(('progress', index, stats.snapshot().to_dict()))
+
+    reporter = threading.Thread(target=report, daemon=True)
+    reporter.start()
+    try:
+        generator.run(stats)
+    finally:
+        stop.set()
+        results.put(('done', index, stats.snapshot().to_dict()))
+
+
+def _split(total: int, parts: int) -> List[int]:
+    """Split total into parts that differ by at most one"""
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def run_load(generator_args: Dict[str, any], processes: int = 1,
+             options_cache_path: Optional[str] = None, interval: float = 1.0) -> LoadStats:
+    """
+    Run a load test in one or more worker processes
+
+    A single Python process runs out of CPU long before a server fleet
+    saturates, so the load can be fanned out to several processes, each
+    with its own thread pool. Workers report cumulative LoadStats; the
+    parent merges histograms and counters exactly and prints aggregated
+    progress every interval.
+
+    Args:
+        generator_args: Keyword arguments for LoadGenerator (without
+            options_cache)
+        processes: Number of worker processes
+        options_cache_path: OPTIONS cache file shared by the workers
+        interval: Seconds between progress lines
+
+    Returns:
+        Merged statistics of all workers
+    """
+    options_cache = OptionsCache(options_cache_path)
+    progress = ProgressReporter(interval)
+
+    if processes <= 1:
+        generator = LoadGenerator(options_cache=options_cache, **generator_args)
+        stats = LoadStats()
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                progress.report(stats.snapshot())
+
+        reporter = threading.Thread(target=report, daemon=True)
+        reporter.start()
+        try:
+            return generator.run(stats)
+        finally:
+            stop.set()
+
+    # Cap at Max-Connections once, then split the concurrency
+    concurrency = LoadGenerator(options_cache=options_cache, **generator_args).effective_concurrency()
+    processes = min(processes, concurrency)
+    worker_args = []
+    requests = generator_args.get('requests') or 0
+    for worker_concurrency, worker_requests in zip(_split(concurrency, processes),
+                                                   _split(requests, processes)):
+        args = dict(generator_args)
+        args['concurrency'] = worker_concurrency
+        args['requests'] = worker_requests
+        worker_args.append(args)
+
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    workers = [context.Process(target=_load_worker, args=(i, args, options_cache_path, results, interval),
+                               daemon=True)
+               for i, args in enumerate(worker_args)]
+    for worker in workers:
+        worker.start()
+
+    latest = {}
+    finished = set()
+    while len(finished) < len(workers):
+        try:
+            kind, index, data = results.get(timeout=0.2)
+            latest[index] = LoadStats.from_dict(data)
+            if kind == 'done':
+                finished.add(index)
+        except queue.Empty:
+            for index, worker in enumerate(workers):
+                if index not in finished and worker.exitcode is not None:
+                    print(f"{Colors.WARNING}Load worker {index} exited with code {worker.exitcode}{Colors.ENDC}")
+                    finished.add(index)
+        if progress.due():
+            merged = LoadStats()
+            for stats in latest.values():
+                merged.merge(stats)
+            progress.report(merged)
+
+    for worker in workers:
+        worker.join()
+
+    merged = LoadStats()
+    for stats in latest.values():
+        merged.merge(stats)
+    return merged
+
+
+def print_load_results(stats: LoadStats):
+    """Print load test results in a formatted way"""
+    counters = stats.counters
+    histogram = stats.histogram
+    print(f"\n{'='*60}")
+    print("Load Test Results")
+    print(f"{'='*60}")
+    print(f"Requests: {counters['requests']} in {stats.elapsed:.2f}s "
+          f"({stats.throughput:.1f} req/s)")
+    print(f"Clean: {counters['clean']}  Threats: {counters['threats']}  "
+          f"Errors: {counters['errors']}  Skipped: {counters['skipped']}")
+    print(f"Status codes: {', '.join(f'{code}={count}' for code, count in sorted(stats.status_codes.items()))}")
+    print(f"Latency: mean {histogram.mean * 1000:.2f}ms  "
+          f"p50 {histogram.percentile(50) * 1000:.2f}ms  "
+          f"p90 {histogram.percentile(90) * 1000:.2f}ms  "
+          f"p99 {histogram.percentile(99) * 1000:.2f}ms  "
+          f"max {histogram.max_us / 1000:.2f}ms")
+    if stats.preview_outcomes:
+        outcomes = ', '.join(f'{name}={count}' for name, count in sorted(stats.preview_outcomes.items()))
+        print(f"Preview: {outcomes}")
+    print(f"Body bytes: {counters['body_bytes_sent']} sent, "
+          f"{counters['body_bytes_avoided']} avoided ({format_size(stats.byte_rate)}/s)")
+    if counters['tls_handshakes']:
+        print(f"TLS handshakes: {counters['tls_handshakes']}, "
+              f"{counters['tls_resumed'] / counters['tls_handshakes'] * 100:.1f}% resumed")
+    if stats.phases:
+        print_phase_breakdown(stats)
+    if stats.hedging is not None and stats.hedging.requests:
+        print_hedging(stats.hedging)
+    print(f"{'='*60}")
+
+
+def print_hedging(hedging: HedgeStats):
+    """Print endpoint usage and what hedging gained and cost"""
+    print(f"\nEndpoints")
+    for endpoint, counters in sorted(hedging.endpoints.items()):
+        print(f"  {endpoint:<24} {counters['requests']:>8} attempts  {counters['wins']:>8} answers  "
+              f"{counters['errors']:>6} errors")
+    if not hedging.hedges:
+        return
+    print(f"Hedging: {hedging.hedges} hedges ({hedging.hedges / hedging.requests * 100:.1f}% extra load), "
+          f"{hedging.hedge_wins} won by the hedge")
+    print(f"{'':<12} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for label, histogram in (('unhedged', hedging.unhedged), ('hedged', hedging.achieved)):
+        print(f"{label:<12} {histogram.percentile(50) * 1000:>9.2f} {histogram.percentile(90) * 1000:>9.2f} "
+              f"{histogram.percentile(99) * 1000:>9.2f} {histogram.max_us / 1000:>9.2f}")
+
+
+def print_phase_breakdown(stats: LoadStats):
+    """Print where the end-to-end latency was spent, phase by phase"""
+    names = [name for name in LoadStats.PHASES if name in stats.phases]
+    names += sorted(name for name in stats.phases if name not in LoadStats.PHASES)
+    total = sum(stats.phases[name].mean for name in names)
+    print(f"\nLatency breakdown ({stats.phases[names[0]].count} requests with Server-Timing)")
+    print(f"{'Phase':<10} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'share':>7}")
+    for name in names:
+        phase = stats.phases[name]
+        share = phase.mean / total * 100 if total else 0.0
+        print(f"{name:<10} {phase.mean * 1000:>9.2f} {phase.percentile(50) * 1000:>9.2f} "
+              f"{phase.percentile(99) * 1000:>9.2f} {share:>6.1f}%")
+
+
+def run_size_sweep(generator_args: Dict[str, any], sizes: List[int], kind: str,
+                   eicar_at: Optional[str], stream_limit: int) -> List[Tuple[int, LoadStats]]:
+    """
+    Run one load test per object size
+
+    Args:
+        generator_args: Keyword arguments for LoadGenerator
+        sizes: Object sizes in bytes
+        kind: Payload kind
+        eicar_at: EICAR placement for threat payloads
+        stream_limit: clamd StreamMaxLength
+
+    Returns:
+        List of (size, stats) in sweep order
+    """
+    results = []
+    for size in sizes:
+        payload = Payload(size, kind, stream_limit=stream_limit)
+        threat_payload = Payload(size, kind, eicar_at, stream_limit) if eicar_at else None
+        print(f"Sweeping {format_size(size)}...")
+        generator = LoadGenerator(payload=payload, threat_payload=threat_payload, **generator_args)
+        results.append((size, generator.run()))
+    return results
+
+
+def print_sweep_results(results: List[Tuple[int, LoadStats]], width: int = 30):
+    """Print latency and throughput against object size as a text chart"""
+    max_latency = max((stats.histogram.percentile(50) for _, stats in results), default=0) or 1
+    max_rate = max((stats.byte_rate for _, stats in results), default=0) or 1
+    print(f"\n{'='*100}")
+    print("Size Sweep Results")
+    print(f"{'='*100}")
+    print(f"{'Size':>10} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'MiB/s':>8}  "
+          f"{'p50 latency':<{width}} {'throughput':<{width}}")
+    for size, stats in results:
+        p50 = stats.histogram.percentile(50)
+        latency_bar = '#' * max(1, round(p50 / max_latency * width)) if p50 else ''
+        rate_bar = '=' * max(1, round(stats.byte_rate / max_rate * width)) if stats.byte_rate else ''
+        print(f"{format_size(size):>10} {stats.throughput:>8.1f} {p50 * 1000:>9.2f} "
+              f"{stats.histogram.percentile(99) * 1000:>9.2f} {stats.byte_rate / 1024 ** 2:>8.2f}  "
+              f"{latency_bar:<{width}} {rate_bar:<{width}}")
+    print(f"{'='*100}")
+
+
+def run_tls_comparison(generator_args: Dict[str, any], tls_port: int, processes: int = 1,
+                       options_cache_path: Optional[str] = None) -> List[Tuple[str, LoadStats]]:
+    """
+    Run the same load in plaintext and over TLS
+
+    The TLS run is repeated without session resumption, so the cost of
+    full handshakes and the saving of resumption show side by side.
+
+    Args:
+        generator_args: Keyword arguments for LoadGenerator (without
+            options_cache), port being the plaintext port
+        tls_port: ICAPS port of the same server
+        processes: Number of worker processes
+        options_cache_path: OPTIONS cache file shared by the workers
+
+    Returns:
+        List of (label, stats) in run order
+    """
+    variants = [
+        ('plaintext', {}),
+        ('tls', {'port': tls_port, 'tls': True}),
+        ('tls-full-handshake', {'port': tls_port, 'tls': True, 'tls_resume': False}),
+    ]
+    results = []
+    for label, overrides in variants:
+        print(f"Running {label}...")
+        results.append((label, run_load(dict(generator_args, **overrides), processes,
+                                        options_cache_path)))
+    return results
+
+
+def print_tls_comparison(results: List[Tuple[str, LoadStats]]):
+    """Print throughput, latency and handshake cost of plaintext and TLS runs"""
+    print(f"\n{'='*100}")
+    print("Plaintext vs. TLS")
+    print(f"{'='*100}")
+    print(f"{'Run':<20} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'connect ms':>11} "
+          f"{'handshake ms':>13} {'hs p99 ms':>10} {'handshakes':>11} {'resumed':>8}")
+    baseline = results[0][1].throughput if results else 0
+    for label, stats in results:
+        connect = stats.phases.get('connect')
+        handshake = stats.phases.get('handshake')
+        handshakes = stats.counters['tls_handshakes']
+        resumed = f"{stats.counters['tls_resumed'] / handshakes * 100:.0f}%" if handshakes else '-'
+        print(f"{label:<20} {stats.throughput:>8.1f} {stats.histogram.percentile(50) * 1000:>9.2f} "
+              f"{stats.histogram.percentile(99) * 1000:>9.2f} "
+              f"{connect.mean * 1000 if connect else 0:>11.3f} "
+              f"{handshake.mean * 1000 if handshake else 0:>13.3f} "
+              f"{handshake.percentile(99) * 1000 if handshake else 0:>10.3f} "
+              f"{handshakes:>11} {resumed:>8}")
+    for label, stats in results[1:]:
+        if baseline:
+            print(f"{label}: {(1 - stats.throughput / baseline) * 100:.1f}% less throughput than plaintext")
+    print(f"{'='*100}")
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icap_server.py')
+
+
+def read_capture(path: str) -> List[Dict[str, any]]:
+    """
+    Read the request records of a capture written by icap_server.py --capture
+
+    A gzip capture cut off by a killed server is read up to its last
+    complete record.
+
+    Args:
+        path: Capture file (gzip-compressed if it ends in .gz)
+
+    Returns:
+        Records in arrival order
+    """
+    records = []
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        except EOFError:
+            pass
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+class CaptureReplayer:
+    """
+    Play captured requests against a server with their recorded timing
+
+    Each record is sent at its offset from the first record divided by
+    `speed` (0 sends them back to back), whether or not earlier requests
+    are still waiting for their response, so arrival bursts are
+    reproduced. Connections are kept open and reused. Recorded bodies are
+    sent as they were; records holding only a hash and size, or all
+    records with synthetic=True, get a random body of the same size.
+    Requests that used a preview send the same preview size and wait for
+    100 Continue.
+    """
+
+    # ICAP headers not copied from the capture
+    SKIP_HEADERS = ('host', 'connection', 'x-request-id')
+
+    def __init__(self, host: str, port: int, speed: float = 1.0, synthetic: bool = False,
+                 max_in_flight: int = 256, tls: bool = False, tls_ca: Optional[str] = None,
+                 tls_verify: bool = True):
+        """
+        Args:
+            host: ICAP server hostname or IP
+            port: ICAP server port
+            speed: Replay speed factor (2.0 = twice as fast, 0 = no pauses)
+            synthetic: Send same-size random bodies even where the capture has the body
+            max_in_flight: Requests in flight at once; later ones wait and are counted late
+            tls: Connect with ICAPS
+            tls_ca: PEM CA file for the server certificate
+            tls_verify: Verify the server certificate
+        """
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.synthetic = synthetic
+        self.tls = tls
+        self.tls_ca = tls_ca
+        self.tls_verify = tls_verify
+        self.slots = threading.Semaphore(max_in_flight)
+        self.stats = LoadStats()
+        self.lag = LatencyHistogram()
+        self.counters = {'late': 0, 'status_mismatch': 0, 'synthetic_bodies': 0}
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def _body(self, record: Dict[str, any]) -> Optional[Union[bytes, Payload]]:
+        """Body to send for a record, None for requests without one"""
+        if 'size' not in record or 'null-body' in record.get('icap', {}).get('encapsulated', 'null-body'):
+            return None
+        if 'body' in record and not self.synthetic:
+            return base64.b64decode(record['body'])
+        with self._lock:
+            self.counters['synthetic_bodies'] += 1
+        return Payload(record['size'])
+
+    def _head(self, record: Dict[str, any], request_id: str) -> bytes:
+        """ICAP header block and encapsulated HTTP headers of a record"""
+        scheme = 'icaps' if self.tls else 'icap'
+        lines = [f"{record['method']} {scheme}://{self.host}:{self.port}/{record['service']} ICAP/1.0",
+                 f"Host: {self.host}:{self.port}"]
+        for name, value in record.get('icap', {}).items():
+            if name not in self.SKIP_HEADERS:
+                lines.append(f"{'-'.join(part.capitalize() for part in name.split('-'))}: {value}")
+        lines.append(f"X-Request-ID: {request_id}")
+        return ('\r\n'.join(lines) + '\r\n\r\n' + record.get('http', '')).encode('latin-1')
+
+    def _exchange(self, client: ICAPClient, sock: socket.socket, leftover: bytes,
+                  record: Dict[str, any], body: Optional[Union[bytes, Payload]],
+                  request_id: str) -> Tuple[ICAPResponse, bytes]:
+        """Send one recorded request and read its final response"""
+        sock.sendall(self._head(record, request_id))
+        preview = record.get('icap', {}).get('preview', '')
+        bytes_sent, rest = 0, None
+        if body is not None:
+            chunks = iter_body_chunks(body)
+            if preview.isdigit():
+                data, rest, exhausted = client._take_preview(chunks, int(preview))
+                sock.sendall(_chunk(data) + (b"0; ieof\r\n\r\n" if exhausted else b"0\r\n\r\n"))
+                bytes_sent = len(data)
+                if exhausted:
+                    rest = None
+            else:
+                bytes_sent = client._send_chunks(sock, chunks)
+                sock.sendall(b"0\r\n\r\n")
+        response, leftover = client._read_response(sock, leftover)
+        outcome = 'complete' if rest is None else f'early-{response.status_code}'
+        if rest is not None and response.status_code == 100:
+            outcome = '100-continue'
+            bytes_sent += client._send_chunks(sock, rest)
+            sock.sendall(b"0\r\n\r\n")
+            response, leftover = client._read_response(sock, leftover)
+        response.preview_outcome = outcome
+        response.request_id = request_id
+        response.body_bytes_sent = bytes_sent
+        return response, leftover
+
+    def _send(self, record: Dict[str, any], due: float):
+        """Send one record on an idle connection and record the outcome"""
+        try:
+            lag = time.monotonic() - due
+            with self._lock:
+                self.lag.record(max(0.0, lag))
+                client = self._idle.pop() if self._idle else None
+                if lag > 0.1:
+                    self.counters['late'] += 1
+            if client is None:
+                # The request line is built per record; the client only provides connections
+                client = ICAPClient(self.host, self.port, '', keep_alive=True, tls=self.tls,
+                                    tls_ca=self.tls_ca, tls_verify=self.tls_verify)
+            body = self._body(record)
+            request_id = new_request_id()
+            start = time.monotonic()
+            try:
+                response = client._round_trip(
+                    lambda sock, leftover: self._exchange(client, sock, leftover, record, body, request_id))
+                response.elapsed = time.monotonic() - start
+                self.stats.record(True, response, record['service'])
+                if record.get('status') and response.status_code != record['status']:
+                    with self._lock:
+                        self.counters['status_mismatch'] += 1
+            except Exception:
+                client.close()
+                self.stats.record(False, None, record['service'])
+            with self._lock:
+                self._idle.append(client)
+        finally:
+            self.slots.release()
+
+    def run(self, records: List[Dict[str, any]]) -> LoadStats:
+        """
+        Replay the records and wait for all responses
+
+        Returns:
+            Load statistics of the replay; lateness and status mismatches
+            against the capture are in `lag` and `counters`
+        """
+        threads = []
+        start = time.monotonic()
+        first = records[0]['t'] if records else 0.0
+        for record in records:
+            due = start + (record['t'] - first) / self.speed if self.speed > 0 else time.monotonic()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.slots.acquire()
+            thread = threading.Thread(target=self._send, args=(record, due), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.stats.elapsed = time.monotonic() - start
+        for client in self._idle:
+            client.close()
+        return self.stats
+
+
+def print_replay_results(replayer: CaptureReplayer, records: List[Dict[str, any]]):
+    """Print how closely the replay followed the capture"""
+    if not records:
+        return
+    span = records[-1]['t'] - records[0]['t']
+    methods = {}
+    for record in records:
+        methods[record['method']] = methods.get(record['method'], 0) + 1
+    lag = replayer.lag
+    counters = replayer.counters
+    print(f"\nCapture: {len(records)} requests over {span:.1f}s "
+          f"({', '.join(f'{name}={count}' for name, count in sorted(methods.items()))})")
+    print(f"Send lag: p50 {lag.percentile(50) * 1000:.1f}ms  p99 {lag.percentile(99) * 1000:.1f}ms  "
+          f"late (>100ms): {counters['late']}")
+    print(f"Synthetic bodies: {counters['synthetic_bodies']}  "
+          f"Status differs from capture: {counters['status_mismatch']}")
+
+
+class SlowClientAttack:
+    """
+    Slowloris-style clients held open against a server, next to normal requests
+
+    Each connection plays one style, sending one byte per interval for as
+    long as the server keeps it open (at most `duration`):
+        connect: connect and send nothing
+        request-line: an endless request line
+        headers: a request line, then an endless header line
+        body: a complete REQMOD head, then a large body
+        idle: one OPTIONS request with keep-alive, then silence
+    Meanwhile a probe sends a small clean request every probe_interval
+    seconds on a fresh connection, so the report shows whether the slow
+    clients cost normal traffic anything and how long each style held its
+    connection before the server closed it.
+    """
+
+    STYLES = ('connect', 'request-line', 'headers', 'body', 'idle')
+
+    def __init__(self, host: str, port: int, service: str, connections: int = 100,
+                 styles: Iterable[str] = STYLES, interval: float = 1.0, duration: float = 60.0,
+                 probe_interval: float = 0.5):
         """
-        Initialize ICAP client
-        
         Args:
             host: ICAP server hostname or IP
-            port: ICAP server port (usually 1344)
-            service: ICAP service path (e.g., 'avscan')
+            port: ICAP server port (plaintext)
+            service: ICAP service path
+            connections: Slow connections, spread evenly over the styles
+            styles: Styles to play (see STYLES)
+            interval: Seconds between the bytes a slow client sends
+            duration: Seconds the attack lasts at most
+            probe_interval: Seconds between normal probe requests
         """
+        styles = list(styles)
+        unknown = [style for style in styles if style not in self.STYLES]
+        if unknown or not styles:
+            raise ValueError(f"Unknown slow client style(s): {', '.join(unknown) or '(none)'}")
         self.host = host
         self.port = port
         self.service = service
-        
-    def create_icap_request(self, content: bytes, filename: str) -> str:
+        self.connections = connections
+        self.styles = styles
+        self.interval = interval
+        self.duration = duration
+        self.probe_interval = probe_interval
+        self.results = []
+        self.probe = LatencyHistogram()
+        self.probe_counters = {'ok': 0, 'failed': 0, 'statuses': {}}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def _prefix(self, style: str) -> bytes:
+        """Bytes sent at once before the slow part of a style"""
+        url = f"icap://{self.host}:{self.port}/{self.service}"
+        if style == 'headers':
+            return f"REQMOD {url} ICAP/1.0\r\nHost: {self.host}\r\nX-Slow: ".encode('ascii')
+        if style == 'body':
+            http = "POST /upload HTTP/1.1\r\nHost: slow.example\r\nContent-Length: 1000000\r\n\r\n"
+            return (f"REQMOD {url} ICAP/1.0\r\nHost: {self.host}\r\n"
+                    f"Encapsulated: req-hdr=0, req-body={len(http)}\r\n\r\n{http}"
+                    f"{1000000:x}\r\n").encode('ascii')
+        if style == 'request-line':
+            return f"REQMOD {url}?".encode('ascii')
+        if style == 'idle':
+            return f"OPTIONS {url} ICAP/1.0\r\nHost: {self.host}\r\nEncapsulated: null-body=0\r\n\r\n".encode('ascii')
+        return b''
+
+    def _client(self, style: str):
+        """Play one slow connection and record how it ended"""
+        result = {'style': style, 'closed': False, 'held': 0.0, 'status': None, 'error': None}
+        start = time.monotonic()
+        end = start + self.duration
+        response = b''
+        try:
+            with socket.create_connection((self.host, self.port), timeout=10) as sock:
+                sock.sendall(self._prefix(style))
+                answered = style != 'idle'
+                while time.monotonic() < end:
+                    readable, _, _ = select.select([sock], [], [],
+                                                   max(0.0, min(self.interval, end - time.monotonic())))
+                    if readable:
+                        data = sock.recv(4096)
+                        if not data:
+                            result['closed'] = True
+                            break
+                        if not answered and b'\r\n\r\n' in response + data:
+                            # The OPTIONS answer; from here on the connection idles
+                            answered, response = True, b''
+                            continue
+                        response += data
+                    elif style != 'idle' and style != 'connect':
+                        sock.send(b'a')
+        except (ConnectionError, socket.timeout) as e:
+            result['closed'] = True
+            result['error'] = type(e).__name__
+        except OSError as e:
+            result['error'] = str(e)
+        result['held'] = time.monotonic() - start
+        if response.startswith(b'ICAP/'):
+            result['status'] = int(response.split(b' ', 2)[1])
+        with self._lock:
+            self.results.append(result)
+
+    def _probe(self):
+        """Send normal requests until the attack is over"""
+        while not self._done.wait(self.probe_interval):
+            client = ICAPClient(self.host, self.port, self.service)
+            success, status, response = client.send_request(b"slow client probe\n", 'probe.txt')
+            with self._lock:
+                if success and response.status_code in (200, 204):
+                    self.probe_counters['ok'] += 1
+                    self.probe.record(response.elapsed)
+                else:
+                    self.probe_counters['failed'] += 1
+                key = str(response.status_code) if success else status
+                statuses = self.probe_counters['statuses']
+                statuses[key] = statuses.get(key, 0) + 1
+
+    def run(self) -> List[Dict[str, any]]:
         """
-        Create ICAP REQMOD request with file content
-        
-        Args:
-            content: File content as bytes
-            filename: Name of the file being scanned
-            
+        Open all slow connections, probe until they end, and wait for them
+
         Returns:
-            Complete ICAP request as string
+            One result per connection: style, whether the server closed it,
+            seconds held, the status the server answered with, and errors
         """
-        content_length = len(content)
-        
-        # HTTP request encapsulated in ICAP
-        http_request = (
-            f"POST /upload HTTP/1.1\r\n"
-            f"Host: {self.host}\r\n"
-            f"Content-Length: {content_length}\r\n"
-            f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
-            f"\r\n"
-        )
-        
-        http_body = content
-        
-        encapsulated = f"req-hdr=0, req-body={len(http_request)}"
-        
-        # ICAP request
-        icap_request = (
-            f"REQMOD icap://{self.host}:{self.port}/{self.service} ICAP/1.0\r\n"
-            f"Host: {self.host}:{self.port}\r\n"
-            f"Encapsulated: {encapsulated}\r\n"
-            f"\r\n"
-        )
-        
-        # Combine ICAP header + HTTP request + chunked body
-        full_request = icap_request + http_request
-        
-        # Add chunked encoding for body
-        chunk_size = hex(content_length)[2:]  # Remove '0x' prefix
-        full_request += f"{chunk_size}\r\n"
-        full_request += http_body.decode('latin-1')  # Use latin-1 to preserve bytes
-        full_request += "\r\n0\r\n\r\n"  # End chunk
-        
-        return full_request
-    
-    def send_request(self, content: bytes, filename: str) -> Tuple[bool, str, str]:
+        probe = threading.Thread(target=self._probe, daemon=True)
+        probe.start()
+        threads = [threading.Thread(target=self._client, args=(self.styles[index % len(self.styles)],),
+                                    daemon=True)
+                   for index in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._done.set()
+        probe.join()
+        return self.results
+
+    def summary(self) -> Dict[str, Dict[str, any]]:
+        """Per style: connections, closed by the server, held p50/max seconds and 408 answers"""
+        summary = {}
+        for style in self.styles:
+            results = [result for result in self.results if result['style'] == style]
+            held = sorted(result['held'] for result in results)
+            summary[style] = {
+                'connections': len(results),
+                'closed': sum(result['closed'] for result in results),
+                'held_p50_s': round(held[len(held) // 2], 2) if held else 0.0,
+                'held_max_s': round(held[-1], 2) if held else 0.0,
+                'timeouts_408': sum(result['status'] == 408 for result in results),
+            }
+        return summary
+
+
+def print_slow_client_results(attack: SlowClientAttack, server_before: str, server_after: str):
+    """Print how long each slow client style was held and how the probe fared"""
+    print(f"\n{'style':<14} {'conns':>6} {'closed':>7} {'held p50':>9} {'held max':>9} {'408':>5}")
+    for style, result in attack.summary().items():
+        color = Colors.OKGREEN if result['closed'] == result['connections'] else Colors.FAIL
+        print(f"{style:<14} {result['connections']:>6} {color}{result['closed']:>7}{Colors.ENDC} "
+              f"{result['held_p50_s']:>8.1f}s {result['held_max_s']:>8.1f}s {result['timeouts_408']:>5}")
+    counters = attack.probe_counters
+    probe = attack.probe
+    statuses = ', '.join(f"{key}={value}" for key, value in sorted(counters['statuses'].items()))
+    print(f"\nProbe requests during the attack: {counters['ok']} ok, {counters['failed']} failed "
+          f"({statuses or 'none'})")
+    if probe.count:
+        print(f"Probe latency: p50 {probe.percentile(50) * 1000:.1f}ms  p99 {probe.percentile(99) * 1000:.1f}ms")
+    if server_after:
+        print(f"Server X-Slow-Clients: {server_before or '(none)'} -> {server_after}")
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10.0) -> bool:
+    """Wait until a TCP port accepts connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def launch_server(port: int, extra_args: List[str], host: str = '127.0.0.1') -> subprocess.Popen:
+    """
+    Launch icap_server.py from this directory as a child process
+
+    Args:
+        port: Port the server listens on
+        extra_args: Additional icap_server.py arguments (e.g. --clamd-host)
+        host: Address the server listens on
+
+    Returns:
+        The running server process
+    """
+    command = [sys.executable, SERVER_SCRIPT, '--host', host, '--port', str(port),
+               '--log-level', 'WARNING'] + list(extra_args)
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(host, port):
+        process.kill()
+        raise RuntimeError("ICAP server did not start")
+    return process
+
+
+class ProcessSampler:
+    """Sample RSS, thread count and open file descriptors of a process from /proc"""
+
+    def __init__(self, pid: int):
         """
-        Send ICAP request and parse response
-        
         Args:
-            content: File content to scan
-            filename: Name of the file
-            
-        Returns:
-            Tuple of (success, status, response_text)
+            pid: Process to observe (must be on this host)
         """
-        try:
-            # Create socket connection
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect((self.host, self.port))
-            
-            # Send request
-            request = self.create_icap_request(content, filename)
-            sock.sendall(request.encode('latin-1'))
-            
-            # Receive response
-            response = b""
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-                # Check if we have complete response
-                if b"\r\n\r\n" in response or b"0\r\n\r\n" in response:
-                    break
-            
-            sock.close()
-            
-            # Parse response
-            response_text = response.decode('latin-1', errors='ignore')
-            lines = response_text.split('\r\n')
-            
-            if lines:
-                status_line = lines[0]
-                return True, status_line, response_text
-            
-            return False, "Empty response", response_text
-            
-        except socket.timeout:
-            return False, "Connection timeout", ""
-        except ConnectionRefusedError:
-            return False, "Connection refused", ""
-        except Exception as e:
-            return False, f"Error: {str(e)}", ""
-    
-    def test_options(self) -> Tuple[bool, str]:
+        self.pid = pid
+        if not os.path.isdir(f"/proc/{pid}"):
+            raise ValueError(f"No such process in /proc: {pid}")
+
+    def sample(self) -> Dict[str, int]:
         """
-        Test ICAP OPTIONS request
-        
+        Read the current resource usage
+
         Returns:
-            Tuple of (success, response)
+            Dictionary with rss_kb, threads and fds
         """
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)
-            sock.connect((self.host, self.port))
-            
-            options_request = (
-                f"OPTIONS icap://{self.host}:{self.port}/{self.service} ICAP/1.0\r\n"
-                f"Host: {self.host}:{self.port}\r\n"
-                f"\r\n"
-            )
-            
-            sock.sendall(options_request.encode('latin-1'))
-            response = sock.recv(4096).decode('latin-1', errors='ignore')
-            sock.close()
-            
-            return True, response
-            
-        except Exception as e:
-            return False, f"Error: {str(e)}"
+        result = {'rss_kb': 0, 'threads': 0, 'fds': 0}
+        with open(f"/proc/{self.pid}/status", 'r', encoding='ascii', errors='ignore') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    result['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    result['threads'] = int(line.split()[1])
+        result['fds'] = len(os.listdir(f"/proc/{self.pid}/fd"))
+        return result
 
 
-def analyze_response(status: str, response: str, filename: str) -> Dict[str, any]:
+def analyze_growth(samples: List[Dict[str, any]], key: str, tolerance: float = 0.0) -> Dict[str, any]:
     """
-    Analyze ICAP response
-    
+    Check a resource time series for sustained growth
+
+    The series is split into quarters. Growth is flagged as monotonic when
+    the quarter medians never decrease and the last quarter is more than
+    tolerance above the first, which ignores short-lived spikes. Growth is
+    also related to the number of requests served to tell leaks per request
+    from one-off warm-up.
+
     Args:
-        status: Status line from response
-        response: Full response text
-        filename: Name of tested file
-        
+        samples: Soak samples with 'elapsed', 'requests' and the resource
+        key: Resource to analyze (rss_kb, threads or fds)
+        tolerance: Relative increase ignored as noise
+
     Returns:
-        Dictionary with analysis results
+        Growth statistics for the resource
     """
-    result = {
-        'filename': filename,
-        'status': status,
-        'threat_found': False,
-        'clean': False,
-        'details': ''
-    }
-    
-    # Check status code
-    if 'ICAP/1.0 200' in status or 'HTTP/1.1 200' in status:
-        result['clean'] = True
-        result['details'] = 'File passed scan - no threats detected'
-    elif 'ICAP/1.0 204' in status:
-        result['clean'] = True
-        result['details'] = 'No modification needed - file is clean'
-    elif 'ICAP/1.0 403' in status or 'ICAP/1.0 451' in status:
-        result['threat_found'] = True
-        result['details'] = 'Threat detected - file blocked'
-    
-    # Look for virus signatures in response
-    threat_keywords = ['virus', 'malware', 'threat', 'infected', 'eicar']
-    response_lower = response.lower()
-    
-    for keyword in threat_keywords:
-        if keyword in response_lower:
-            result['threat_found'] = True
-            if not result['details']:
-                result['details'] = f'Threat indicator found: {keyword}'
-            break
-    
-    # Extract X-Violations or X-Virus-ID headers
-    for line in response.split('\r\n'):
-        if line.startswith('X-Violations:') or line.startswith('X-Virus-ID:'):
-            result['details'] += f' | {line}'
-    
+    values = [sample[key] for sample in samples]
+    result = {'start': values[0] if values else 0, 'end': values[-1] if values else 0,
+              'slope_per_hour': 0.0, 'per_1k_requests': 0.0, 'correlation': 0.0,
+              'monotonic': False}
+    if len(values) < 8:
+        return result
+    times = [sample['elapsed'] for sample in samples]
+    requests = [sample['requests'] for sample in samples]
+    mean_t, mean_v, mean_r = sum(times) / len(times), sum(values) / len(values), sum(requests) / len(requests)
+    var_t = sum((t - mean_t) ** 2 for t in times)
+    var_v = sum((v - mean_v) ** 2 for v in values)
+    var_r = sum((r - mean_r) ** 2 for r in requests)
+    if var_t:
+        slope = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / var_t
+        result['slope_per_hour'] = round(slope * 3600, 3)
+    if requests[-1] > requests[0]:
+        result['per_1k_requests'] = round((values[-1] - values[0]) / (requests[-1] - requests[0]) * 1000, 4)
+    if var_v and var_r:
+        covariance = sum((r - mean_r) * (v - mean_v) for r, v in zip(requests, values))
+        result['correlation'] = round(covariance / math.sqrt(var_v * var_r), 3)
+    quarter = len(values) // 4
+    medians = [sorted(values[i * quarter:(i + 1) * quarter])[quarter // 2] for i in range(4)]
+    result['monotonic'] = (all(b >= a for a, b in zip(medians, medians[1:]))
+                           and medians[-1] > medians[0] * (1 + tolerance))
     return result
 
 
-def print_results(test_name: str, result: Dict[str, any]):
-    """Print test results in a formatted way"""
+# Relative increase ignored per resource when flagging growth
+SOAK_TOLERANCE = {'rss_kb': 0.05, 'threads': 0.0, 'fds': 0.0}
+
+
+def run_soak(generator_args: Dict[str, any], duration: float, interval: float,
+             sampler: Optional[ProcessSampler], output: str) -> Tuple[LoadStats, Dict[str, any]]:
+    """
+    Run steady load while sampling the server's resource usage
+
+    Args:
+        generator_args: Keyword arguments for LoadGenerator
+        duration: Soak duration in seconds
+        interval: Seconds between samples
+        sampler: Server process sampler, or None for load-only samples
+        output: CSV file receiving the time series
+
+    Returns:
+        Tuple of (load stats, growth analysis per resource)
+    """
+    generator = LoadGenerator(duration=duration, **generator_args)
+    stats = LoadStats()
+    runner = threading.Thread(target=generator.run, args=(stats,), daemon=True)
+    start = time.monotonic()
+    runner.start()
+
+    samples = []
+    columns = ['timestamp', 'elapsed', 'requests', 'throughput', 'errors', 'p50_ms', 'p99_ms',
+               'rss_kb', 'threads', 'fds']
+    last_requests, last_time = 0, start
+    last_histogram = LatencyHistogram()
+    with open(output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        while runner.is_alive():
+            runner.join(interval)
+            now = time.monotonic()
+            snapshot = stats.snapshot()
+            requests = snapshot.counters['requests']
+            interval_latency = snapshot.histogram.since(last_histogram)
+            sample = {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'elapsed': round(now - start, 1),
+                'requests': requests,
+                'throughput': round((requests - last_requests) / (now - last_time), 1) if now > last_time else 0,
+                'errors': snapshot.counters['errors'],
+                'p50_ms': round(interval_latency.percentile(50) * 1000, 2),
+                'p99_ms': round(interval_latency.percentile(99) * 1000, 2),
+                'rss_kb': '', 'threads': '', 'fds': '',
+            }
+            if sampler is not None:
+                try:
+                    sample.update(sampler.sample())
+                except OSError as e:
+                    print(f"{Colors.FAIL}✗ Server process vanished: {e}{Colors.ENDC}")
+                    sampler = None
+            last_requests, last_time, last_histogram = requests, now, snapshot.histogram
+            samples.append(sample)
+            writer.writerow(sample)
+            f.flush()
+            print(f"[{sample['elapsed']:8.1f}s] {requests:>9} req ({sample['throughput']:8.1f}/s)  "
+                  f"errors {sample['errors']}  p99 {sample['p99_ms']}ms  "
+                  f"rss {sample['rss_kb'] or '-'} kB  threads {sample['threads'] or '-'}  "
+                  f"fds {sample['fds'] or '-'}", flush=True)
+
+    growth = {}
+    sampled = [sample for sample in samples if sample['rss_kb'] != '']
+    for key, tolerance in SOAK_TOLERANCE.items():
+        if sampled:
+            growth[key] = analyze_growth(sampled, key, tolerance)
+    return stats, growth
+
+
+def print_soak_results(stats: LoadStats, growth: Dict[str, any], output: str):
+    """Print the soak verdict per resource"""
+    print_load_results(stats)
+    print("Soak Resource Analysis")
+    print(f"{'='*60}")
+    if not growth:
+        print("No server process sampled (use --server-pid or --launch-server)")
+    for key, result in growth.items():
+        flag = f"{Colors.FAIL}GROWING{Colors.ENDC}" if result['monotonic'] else f"{Colors.OKGREEN}stable{Colors.ENDC}"
+        print(f"{key:<8} {result['start']:>10} -> {result['end']:<10} {flag}  "
+              f"slope {result['slope_per_hour']:+.1f}/h  "
+              f"{result['per_1k_requests']:+.3f} per 1k req  corr(requests) {result['correlation']:+.2f}")
+    print(f"{'='*60}")
+    print(f"Time series written to {output}")
+
+
+# Metrics compared by 'compare' and checked against regression thresholds
+HIGHER_IS_BETTER = ('throughput', 'byte_rate')
+LOWER_IS_BETTER = ('latency_mean_ms', 'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms',
+                   'latency_max_ms', 'latency_ms', 'errors')
+LATENCY_GATES = ('latency_p50_ms', 'latency_p99_ms', 'latency_ms')
+EXPORT_FORMATS = ('json', 'csv', 'prometheus')
+
+
+def new_result_document(mode: str, target: str) -> Dict[str, any]:
+    """
+    Create an empty result document
+
+    Every run of the tool (functional, load or sweep) is recorded as a set
+    of named runs, each a flat dictionary of metrics, so all result files
+    can be exported and compared the same way.
+
+    Args:
+        mode: 'functional', 'load', 'sweep' or 'benchmark'
+        target: ICAP service URL
+    """
+    return {
+        'tool': os.path.basename(sys.argv[0]) or 'icap_test.py',
+        'version': __version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'mode': mode,
+        'target': target,
+        'runs': {},
+    }
+
+
+def _export_filename_format(path: str) -> str:
+    """Guess the export format from a file extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.prom', '.txt'):
+        return 'prometheus'
+    return 'json'
+
+
+def _metric_columns(document: Dict[str, any]) -> List[str]:
+    """All metric names used by any run, in first-seen order"""
+    columns = []
+    for metrics in document['runs'].values():
+        for name in metrics:
+            if name not in columns:
+                columns.append(name)
+    return columns
+
+
+def _prometheus_label(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(document: Dict[str, any]) -> str:
+    """
+    Render a result document in the Prometheus text exposition format
+
+    Numeric and boolean metrics become gauges named icap_test_<metric>;
+    millisecond latencies are converted to seconds.
+    """
+    lines = []
+    base_labels = (f'mode="{_prometheus_label(document["mode"])}",'
+                   f'target="{_prometheus_label(document["target"])}"')
+    for column in _metric_columns(document):
+        samples = []
+        for run, metrics in document['runs'].items():
+            value = metrics.get(column)
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            name = column
+            if name.endswith('_ms'):
+                name, value = name[:-3] + '_seconds', value / 1000
+            samples.append((name, run, value))
+        if not samples:
+            continue
+        name = f"icap_test_{samples[0][0]}"
+        lines.append(f"# TYPE {name} gauge")
+        for _, run, value in samples:
+            # Full precision: counters and byte totals must not be rounded
+            text = str(value) if isinstance(value, int) else repr(float(value))
+            lines.append(f'{name}{{run="{_prometheus_label(run)}",{base_labels}}} {text}')
+    lines.append("# TYPE icap_test_last_run_timestamp_seconds gauge")
+    lines.append(f"icap_test_last_run_timestamp_seconds{{{base_labels}}} {time.time():.0f}")
+    return '\n'.join(lines) + '\n'
+
+
+def export_results(document: Dict[str, any], path: str, fmt: Optional[str] = None):
+    """
+    Write a result document as JSON, CSV or Prometheus textfile
+
+    The file is written to a temporary name and renamed into place so the
+    node_exporter textfile collector never reads a partial file.
+
+    Args:
+        document: Result document from new_result_document()
+        path: Output file
+        fmt: 'json', 'csv' or 'prometheus' (default: from the extension)
+    """
+    fmt = fmt or _export_filename_format(path)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+        if fmt == 'json':
+            json.dump(document, f, indent=2)
+            f.write('\n')
+        elif fmt == 'csv':
+            columns = _metric_columns(document)
+            writer = csv.writer(f)
+            writer.writerow(['run', 'mode', 'target', 'timestamp'] + columns)
+            for run, metrics in document['runs'].items():
+                writer.writerow([run, document['mode'], document['target'], document['timestamp']]
+                                + [metrics.get(column, '') for column in columns])
+        elif fmt == 'prometheus':
+            f.write(format_prometheus(document))
+        else:
+            raise ValueError(f"Unknown export format: {fmt}")
+    os.replace(temp_path, path)
+
+
+def _csv_value(value: str) -> any:
+    """Convert a CSV cell back to a number or boolean where possible"""
+    if value in ('True', 'False'):
+        return value == 'True'
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def load_results(path: str) -> Dict[str, any]:
+    """Load a result document written by export_results() as JSON or CSV"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if _export_filename_format(path) != 'csv':
+            return json.load(f)
+        rows = list(csv.DictReader(f))
+    first = rows[0] if rows else {}
+    document = {'version': '', 'mode': first.get('mode', ''), 'target': first.get('target', ''),
+                'timestamp': first.get('timestamp', ''), 'runs': {}}
+    for row in rows:
+        document['runs'][row['run']] = {
+            key: _csv_value(value) for key, value in row.items()
+            if key not in ('run', 'mode', 'target', 'timestamp') and value != ''
+        }
+    return document
+
+
+def compare_results(current: Dict[str, any], baseline: Dict[str, any],
+                    max_throughput_drop: Optional[float] = None,
+                    max_latency_increase: Optional[float] = None) -> Tuple[List[str], List[str]]:
+    """
+    Compare the runs of two result documents
+
+    Args:
+        current: Newer result document
+        baseline: Older result document
+        max_throughput_drop: Allowed throughput decrease in percent, or None
+        max_latency_increase: Allowed p50/p99 latency increase in percent, or None
+
+    Returns:
+        Tuple of (report lines, regression descriptions)
+    """
+    lines = []
+    regressions = []
+    for name, metrics in current['runs'].items():
+        base = baseline.get('runs', {}).get(name)
+        if base is None:
+            lines.append(f"{name:<24} (not in baseline)")
+            continue
+        deltas = []
+        for metric, new in metrics.items():
+            old = base.get(metric)
+            if old is None or old == new:
+                continue
+            if isinstance(new, bool) or not isinstance(new, (int, float)) \
+                    or not isinstance(old, (int, float)):
+                deltas.append(f"{metric} {old} -> {Colors.WARNING}{new}{Colors.ENDC}")
+                continue
+            if metric not in HIGHER_IS_BETTER and metric not in LOWER_IS_BETTER:
+                continue
+            change = (new - old) / old * 100 if old else float('inf')
+            better = change > 0 if metric in HIGHER_IS_BETTER else change < 0
+            regressed = False
+            if metric in HIGHER_IS_BETTER and max_throughput_drop is not None:
+                regressed = change < -max_throughput_drop
+            elif metric in LATENCY_GATES and max_latency_increase is not None:
+                regressed = change > max_latency_increase
+            color = Colors.FAIL if regressed else (Colors.OKGREEN if better else Colors.WARNING)
+            deltas.append(f"{metric} {old:g} -> {new:g} ({color}{change:+.1f}%{Colors.ENDC})")
+            if regressed:
+                limit = -max_throughput_drop if metric in HIGHER_IS_BETTER else max_latency_increase
+                regressions.append(f"{name}: {metric} changed {change:+.1f}% (limit {limit:+.1f}%)")
+        lines.append(f"{name:<24} " + (', '.join(deltas) if deltas else 'no change'))
+    for name in baseline.get('runs', {}):
+        if name not in current['runs']:
+            lines.append(f"{name:<24} (missing in new results)")
+    return lines, regressions
+
+
+def compare_main(argv: List[str]):
+    """Entry point of the 'compare' subcommand"""
+    parser = argparse.ArgumentParser(
+        prog='icap_test.py compare',
+        description='Compare two result files written with --export'
+    )
+    parser.add_argument('old', help='Baseline result file (JSON or CSV)')
+    parser.add_argument('new', help='New result file (JSON or CSV)')
+    parser.add_argument('--max-throughput-drop', type=float, metavar='PERCENT',
+                        help='Fail if throughput drops by more than PERCENT')
+    parser.add_argument('--max-latency-increase', type=float, metavar='PERCENT',
+                        help='Fail if p50/p99 latency grows by more than PERCENT')
+    args = parser.parse_args(argv)
+
+    try:
+        old = load_results(args.old)
+        new = load_results(args.new)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"✗ Could not read result file: {e}")
+        sys.exit(2)
+
     print(f"\n{'='*60}")
-    print(f"Test: {test_name}")
+    print("Result Comparison")
     print(f"{'='*60}")
-    print(f"Filename: {result['filename']}")
-    print(f"Status: {result['status']}")
-    print(f"Threat Found: {'YES' if result['threat_found'] else 'NO'}")
-    print(f"Clean: {'YES' if result['clean'] else 'NO'}")
-    print(f"Details: {result['details']}")
+    print(f"Old: {args.old} ({old.get('mode', '?')}, {old.get('timestamp', '?')})")
+    print(f"New: {args.new} ({new.get('mode', '?')}, {new.get('timestamp', '?')})")
+    print()
+    lines, regressions = compare_results(new, old, args.max_throughput_drop, args.max_latency_increase)
+    for line in lines:
+        print(f"  {line}")
     print(f"{'='*60}")
+    if regressions:
+        print(f"\n{Colors.FAIL}✗ Regressions:{Colors.ENDC}")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+
+
+def run_functional_tests(client: ICAPClient, args: argparse.Namespace, document: Dict[str, any]):
+    """Run the OPTIONS, EICAR and clean file tests and record them in document"""
+    runs = document['runs']
+    
+    # Test OPTIONS if requested
+    if args.test_options:
+        print("\n[1] Testing ICAP OPTIONS...")
+        success, response = client.test_options()
+        runs['options'] = {'passed': success}
+        if success:
+            print("✓ OPTIONS request successful")
+            if args.verbose:
+                print(f"\nResponse:\n{response}")
+        else:
+            print(f"✗ OPTIONS request failed: {response}")
+            runs['options']['error'] = response
+            return
+    
+    tests = [
+        ('eicar', "[2] Testing EICAR virus test file...", "EICAR Virus Test",
+         EICAR_STRING.encode('latin-1'), 'eicar.com'),
+        ('clean', "[3] Testing clean file...", "Clean File Test",
+         CLEAN_CONTENT.encode('utf-8'), 'clean.txt'),
+    ]
+    for name, banner, title, content, filename in tests:
+        print(f"\n{banner}")
+        success, status, response = client.send_request(content, filename)
+        
+        if success and response is None:
+            print(f"- {status}")
+            runs[name] = {'filename': filename, 'status': status, 'passed': True, 'skipped': True}
+            continue
+        if not success:
+            print(f"✗ Request failed: {status}")
+            runs[name] = {'filename': filename, 'status': status, 'passed': False}
+            return
+        
+        result = analyze_response(response, filename)
+        print_results(title, result)
+        
+        if args.verbose:
+            print(f"\nFull Response:\n{response.to_text()[:500]}...")
+        
+        if name == 'eicar':
+            result['passed'] = result['threat_found']
+            if result['passed']:
+                print("\n✓ EICAR detection: PASSED - Threat correctly identified")
+            else:
+                print("\n✗ EICAR detection: FAILED - Threat not detected!")
+        else:
+            result['passed'] = result['clean'] and not result['threat_found']
+            if result['passed']:
+                print("\n✓ Clean file test: PASSED - File correctly identified as clean")
+            else:
+                print("\n✗ Clean file test: FAILED - False positive detected!")
+        
+        result['latency_ms'] = round(result.pop('elapsed') * 1000, 3)
+        runs[name] = result
+    
+    print(f"\n{'='*60}")
+    print("Test completed!")
+    print(f"{'='*60}\n")
 
 
 def main():
+    if sys.argv[1:2] == ['compare']:
+        compare_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(
-        description='ICAP Protocol Test Script - Tests virus detection with EICAR and clean files'
+        description='ICAP Protocol Test Script - Tests virus detection with EICAR and clean files',
+        epilog="Use 'icap_test.py compare OLD NEW' to compare two exported result files"
     )
     parser.add_argument('--version', action='version',
                         version=f'%(prog)s {__version__}')
@@ -281,6 +3379,89 @@ def main():
                         help='Test OPTIONS request first')
     parser.add_argument('--verbose', action='store_true',
                         help='Show full response details')
+    parser.add_argument('--preview', action='store_true',
+                        help='Use Preview/100-Continue as advertised by OPTIONS')
+    parser.add_argument('--options-cache', metavar='FILE',
+                        help='Persist OPTIONS results in FILE and reuse them until Options-TTL expires')
+    parser.add_argument('--load', action='store_true',
+                        help='Run a load test instead of the functional tests')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Concurrent requests in load mode (default: 10)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Total requests in load mode (default: 1000)')
+    parser.add_argument('--method', choices=['REQMOD', 'RESPMOD', 'OPTIONS'], default='REQMOD',
+                        help='ICAP method used in load mode (default: REQMOD)')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='Reuse connections between requests')
+    parser.add_argument('--endpoints', metavar='HOST:PORT,...',
+                        help='Spread load mode over several ICAP servers instead of --host/--port')
+    parser.add_argument('--select', choices=list(ICAPEndpointPool.POLICIES), default='round-robin',
+                        help='Endpoint selection with --endpoints (default: round-robin)')
+    parser.add_argument('--hedge-percentile', type=float, metavar='P',
+                        help='Duplicate requests pending longer than the P-th latency percentile '
+                             'to a second endpoint (e.g. 95)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes in load mode, each with its own thread pool (default: 1)')
+    parser.add_argument('--duration', type=float,
+                        help='Run load mode for this many seconds instead of --requests')
+    parser.add_argument('--eicar-ratio', type=float, default=0.0,
+                        help='Fraction of load requests carrying EICAR (default: 0.0)')
+    parser.add_argument('--payload-size', type=parse_size, metavar='SIZE',
+                        help='Send a synthetic body of SIZE (e.g. 64K, 10M, 4G) in load mode')
+    parser.add_argument('--payload-kind', choices=Payload.KINDS, default='random',
+                        help='Synthetic body content (default: random)')
+    parser.add_argument('--eicar-at', default='middle', metavar='WHERE',
+                        help='EICAR position in synthetic threat bodies: start, middle, end, '
+                             'beyond-limit or a byte offset (default: middle)')
+    parser.add_argument('--stream-limit', type=parse_size, default=Payload.STREAM_LIMIT, metavar='SIZE',
+                        help='clamd StreamMaxLength used by --eicar-at beyond-limit (default: 25M)')
+    parser.add_argument('--soak', action='store_true',
+                        help='Run steady load for --duration seconds while sampling server resources')
+    parser.add_argument('--sample-interval', type=float, default=10.0,
+                        help='Seconds between soak samples (default: 10)')
+    parser.add_argument('--soak-output', metavar='FILE',
+                        help='CSV time series written in soak mode (default: soak-<timestamp>.csv)')
+    parser.add_argument('--server-pid', type=int,
+                        help='PID of a local icap_server.py to sample in soak mode')
+    parser.add_argument('--launch-server', action='store_true',
+                        help='Start icap_server.py locally on --port and sample it in soak mode')
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help='Extra argument for the launched icap_server.py (repeatable)')
+    parser.add_argument('--export', metavar='FILE',
+                        help='Export results to FILE (format from extension: .json, .csv, .prom)')
+    parser.add_argument('--export-format', choices=EXPORT_FORMATS,
+                        help='Override the export format')
+    parser.add_argument('--sweep', metavar='SIZES',
+                        help='Run the load test once per size (e.g. 1K,64K,1M,16M) and chart the results')
+    parser.add_argument('--tls', action='store_true',
+                        help='Connect with ICAPS (ICAP over TLS), e.g. --port 11344')
+    parser.add_argument('--tls-ca', metavar='FILE',
+                        help='PEM CA certificates trusted for the server certificate (default: system store)')
+    parser.add_argument('--insecure', action='store_true',
+                        help='Do not verify the server certificate')
+    parser.add_argument('--no-tls-resume', action='store_true',
+                        help='Do a full TLS handshake on every connection')
+    parser.add_argument('--pipeline', type=int, metavar='DEPTH',
+                        help='Pipeline up to DEPTH requests per connection in the load test')
+    parser.add_argument('--replay', metavar='CAPTURE',
+                        help='Replay a capture recorded with icap_server.py --capture against '
+                             '--host/--port with the recorded timing')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Replay speed factor, e.g. 2 for twice as fast, 0 without pauses (default: 1)')
+    parser.add_argument('--replay-synthetic', action='store_true',
+                        help='Send same-size random bodies instead of the captured ones')
+    parser.add_argument('--replay-in-flight', type=int, default=256,
+                        help='Replayed requests in flight at once (default: 256)')
+    parser.add_argument('--slow-clients', type=int, metavar='N',
+                        help='Hold N slowloris-style connections open against --host/--port for '
+                             '--duration seconds (default: 60) while probing with normal requests')
+    parser.add_argument('--slow-styles', default=','.join(SlowClientAttack.STYLES),
+                        help=f'Slow client styles, comma separated (default: {",".join(SlowClientAttack.STYLES)})')
+    parser.add_argument('--slow-interval', type=float, default=1.0,
+                        help='Seconds between the bytes a slow client sends (default: 1)')
+    parser.add_argument('--compare-tls', type=int, metavar='TLS_PORT',
+                        help='Run the load test on --port in plaintext and on TLS_PORT over TLS, '
+                             'with and without session resumption, and compare')
     
     args = parser.parse_args()
     
@@ -309,72 +3490,190 @@ def main():
         print()
         return
 
-    # Initialize ICAP client
-    client = ICAPClient(args.host, args.port, args.service)
+    options_cache = OptionsCache(args.options_cache)
+    target = f"{'icaps' if args.tls else 'icap'}://{args.host}:{args.port}/{args.service}"
     
-    print(f"\nICAP Test Script")
-    print(f"Target: icap://{args.host}:{args.port}/{args.service}")
-    print(f"{'='*60}")
+    generator_args = {
+        'host': args.host, 'port': args.port, 'service': args.service,
+        'concurrency': args.concurrency, 'requests': args.requests,
+        'duration': args.duration, 'eicar_ratio': args.eicar_ratio,
+        'options_cache': options_cache, 'method': args.method,
+        'keep_alive': args.keep_alive, 'tls': args.tls, 'tls_ca': args.tls_ca,
+        'tls_verify': not args.insecure, 'tls_resume': not args.no_tls_resume,
+        'pipeline_depth': args.pipeline,
+    }
+    if args.pipeline and (args.endpoints or args.method == 'OPTIONS'):
+        print("✗ --pipeline needs a single endpoint and REQMOD or RESPMOD")
+        sys.exit(2)
+    if args.endpoints:
+        try:
+            generator_args['endpoints'] = parse_endpoints(args.endpoints, args.port)
+        except ValueError as e:
+            print(f"✗ {e}")
+            sys.exit(2)
+        generator_args['policy'] = args.select
+        generator_args['hedge_percentile'] = args.hedge_percentile
+        target = ', '.join(f"icap://{host}:{port}/{args.service}"
+                           for host, port in generator_args['endpoints'])
+    threat_at = args.eicar_at if args.eicar_ratio else None
     
-    # Test OPTIONS if requested
-    if args.test_options:
-        print("\n[1] Testing ICAP OPTIONS...")
-        success, response = client.test_options()
-        if success:
-            print("✓ OPTIONS request successful")
-            if args.verbose:
-                print(f"\nResponse:\n{response}")
-        else:
-            print(f"✗ OPTIONS request failed: {response}")
+    if args.soak:
+        print(f"\nICAP Soak Test")
+        print(f"Target: {target}")
+        document = new_result_document('soak', target)
+        duration = args.duration or 3600
+        output = args.soak_output or time.strftime('soak-%Y%m%d-%H%M%S.csv')
+        server = None
+        sampler = None
+        try:
+            if args.launch_server:
+                server = launch_server(args.port, args.server_arg, host=args.host)
+                sampler = ProcessSampler(server.pid)
+            elif args.server_pid:
+                sampler = ProcessSampler(args.server_pid)
+            else:
+                print(f"{Colors.WARNING}No --server-pid given, sampling load only{Colors.ENDC}")
+            if args.payload_size is not None:
+                generator_args['payload'] = Payload(args.payload_size, args.payload_kind,
+                                                    stream_limit=args.stream_limit)
+            del generator_args['duration']
+            generator_args['requests'] = None
+            stats, growth = run_soak(generator_args, duration, args.sample_interval, sampler, output)
+        except (ValueError, RuntimeError, OSError) as e:
+            print(f"✗ {e}")
+            sys.exit(1)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        print_soak_results(stats, growth, output)
+        summary = stats.summary()
+        for key, result in growth.items():
+            summary[f"{key}_start"] = result['start']
+            summary[f"{key}_end"] = result['end']
+            summary[f"{key}_slope_per_hour"] = result['slope_per_hour']
+            summary[f"{key}_growing"] = result['monotonic']
+        document['runs']['soak'] = summary
+    
+    elif args.sweep:
+        print(f"\nICAP Size Sweep")
+        print(f"Target: {target}")
+        document = new_result_document('sweep', target)
+        try:
+            sizes = [parse_size(size) for size in args.sweep.split(',')]
+            results = run_size_sweep(generator_args, sizes, args.payload_kind,
+                                     threat_at, args.stream_limit)
+        except ValueError as e:
+            print(f"✗ {e}")
             return
+        print_sweep_results(results)
+        for size, stats in results:
+            document['runs'][f"size-{size}"] = dict(stats.summary(), size=size)
     
-    # Test 1: EICAR test file
-    print("\n[2] Testing EICAR virus test file...")
-    success, status, response = client.send_request(
-        EICAR_STRING.encode('latin-1'), 
-        'eicar.com'
-    )
+    elif args.replay:
+        print(f"\nICAP Capture Replay")
+        print(f"Target: {'icaps' if args.tls else 'icap'}://{args.host}:{args.port} "
+              f"at {args.replay_speed:g}x")
+        document = new_result_document('replay', target)
+        try:
+            records = read_capture(args.replay)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"✗ Could not read capture: {e}")
+            sys.exit(2)
+        replayer = CaptureReplayer(args.host, args.port, args.replay_speed, args.replay_synthetic,
+                                   args.replay_in_flight, tls=args.tls, tls_ca=args.tls_ca,
+                                   tls_verify=not args.insecure)
+        stats = replayer.run(records)
+        print_load_results(stats)
+        print_replay_results(replayer, records)
+        document['runs']['replay'] = dict(stats.summary(), speed=args.replay_speed,
+                                          send_lag_p99_ms=round(replayer.lag.percentile(99) * 1000, 3),
+                                          **replayer.counters)
     
-    if success:
-        result = analyze_response(status, response, 'eicar.com')
-        print_results("EICAR Virus Test", result)
-        
-        if args.verbose:
-            print(f"\nFull Response:\n{response[:500]}...")
-        
-        if result['threat_found']:
-            print("\n✓ EICAR detection: PASSED - Threat correctly identified")
-        else:
-            print("\n✗ EICAR detection: FAILED - Threat not detected!")
-    else:
-        print(f"✗ Request failed: {status}")
-        return
+    elif args.slow_clients:
+        print(f"\nICAP Slow Client Test")
+        print(f"Target: {target}, {args.slow_clients} slow connections, "
+              f"one byte every {args.slow_interval:g}s")
+        document = new_result_document('slow-clients', target)
+
+        def slow_client_counters() -> str:
+            success, _, response = ICAPClient(args.host, args.port, args.service).send_options()
+            return response.headers.get('x-slow-clients', '') if success else ''
+
+        try:
+            attack = SlowClientAttack(args.host, args.port, args.service, args.slow_clients,
+                                      [style.strip() for style in args.slow_styles.split(',') if style.strip()],
+                                      args.slow_interval, args.duration or 60.0)
+        except ValueError as e:
+            print(f"✗ {e}")
+            sys.exit(2)
+        before = slow_client_counters()
+        attack.run()
+        print_slow_client_results(attack, before, slow_client_counters())
+        for style, result in attack.summary().items():
+            document['runs'][f"slow-{style}"] = dict(result, interval=args.slow_interval)
+        probe = attack.probe
+        document['runs']['slow-probe'] = {
+            'ok': attack.probe_counters['ok'], 'failed': attack.probe_counters['failed'],
+            'p50_ms': round(probe.percentile(50) * 1000, 3), 'p99_ms': round(probe.percentile(99) * 1000, 3),
+        }
     
-    # Test 2: Clean file
-    print("\n[3] Testing clean file...")
-    success, status, response = client.send_request(
-        CLEAN_CONTENT.encode('utf-8'),
-        'clean.txt'
-    )
+    elif args.compare_tls:
+        print(f"\nICAP Plaintext vs. TLS")
+        print(f"Target: {target} and icaps://{args.host}:{args.compare_tls}/{args.service}")
+        document = new_result_document('tls-comparison', target)
+        if args.payload_size is not None:
+            generator_args['payload'] = Payload(args.payload_size, args.payload_kind,
+                                                stream_limit=args.stream_limit)
+        del generator_args['options_cache']
+        generator_args['tls'] = False
+        results = run_tls_comparison(generator_args, args.compare_tls, args.processes,
+                                     args.options_cache)
+        print_tls_comparison(results)
+        for label, stats in results:
+            document['runs'][label] = dict(stats.summary(), concurrency=args.concurrency,
+                                           keep_alive=args.keep_alive)
     
-    if success:
-        result = analyze_response(status, response, 'clean.txt')
-        print_results("Clean File Test", result)
+    elif args.load:
+        print(f"\nICAP Load Test")
+        print(f"Target: {target}")
+        document = new_result_document('load', target)
+        if args.payload_size is not None:
+            try:
+                generator_args['payload'] = Payload(args.payload_size, args.payload_kind,
+                                                    stream_limit=args.stream_limit)
+                if threat_at:
+                    generator_args['threat_payload'] = Payload(args.payload_size, args.payload_kind,
+                                                               threat_at, args.stream_limit)
+            except ValueError as e:
+                print(f"✗ {e}")
+                return
+        del generator_args['options_cache']
+        stats = run_load(generator_args, args.processes, args.options_cache)
+        print_load_results(stats)
+        document['runs']['load'] = dict(stats.summary(), method=args.method,
+                                        concurrency=args.concurrency, processes=args.processes)
+    
+    else:
+        # Initialize ICAP client
+        client = ICAPClient(args.host, args.port, args.service, preview=args.preview,
+                            options_cache=options_cache, tls=args.tls, tls_ca=args.tls_ca,
+                            tls_verify=not args.insecure, tls_resume=not args.no_tls_resume)
         
-        if args.verbose:
-            print(f"\nFull Response:\n{response[:500]}...")
+        print(f"\nICAP Test Script")
+        print(f"Target: {target}")
+        print(f"{'='*60}")
         
-        if result['clean'] and not result['threat_found']:
-            print("\n✓ Clean file test: PASSED - File correctly identified as clean")
-        else:
-            print("\n✗ Clean file test: FAILED - False positive detected!")
-    else:
-        print(f"✗ Request failed: {status}")
-        return
+        document = new_result_document('functional', target)
+        run_functional_tests(client, args, document)
     
-    print(f"\n{'='*60}")
-    print("Test completed!")
-    print(f"{'='*60}\n")
+    if args.export:
+        try:
+            export_results(document, args.export, args.export_format)
+            print(f"✓ Results exported to {args.export}")
+        except (OSError, ValueError) as e:
+            print(f"✗ Export failed: {e}")
+            sys.exit(1)
 
 
 if __name__ == '__main__':
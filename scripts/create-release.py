@@ -58,6 +58,18 @@ class VersionManager:
             'pattern': r'(__version__ = ")(\d+\.\d+\.\d+)(")',
             'replacement': r'\g<1>{version}\g<3>'
         },
+        # icap_bench.py - __version__
+        {
+            'file': 'icap_bench.py',
+            'pattern': r'(__version__ = ")(\d+\.\d+\.\d+)(")',
+            'replacement': r'\g<1>{version}\g<3>'
+        },
+        # icap_faultproxy.py - __version__
+        {
+            'file': 'icap_faultproxy.py',
+            'pattern': r'(__version__ = ")(\d+\.\d+\.\d+)(")',
+            'replacement': r'\g<1>{version}\g<3>'
+        },
         # VERSION file
         {
             'file': 'VERSION',